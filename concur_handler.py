@@ -1,12 +1,21 @@
 from log_x import LogX
+import Queue
+import collections
 import errno
 import fcntl
+import functools
+import math
 import os
 import resource
 import select
+import json
 import signal
+import socket
+import stat
 import string
+import struct
 import sys
+import threading
 import time
 
 Log = LogX(__name__)
@@ -22,7 +31,7 @@ class pipe_link_exception(Exception):
 
 class msg_trans_proto(object):
     '''
-    Msg format:
+    Msg format(version 1):
         +----------------------------+
         |\0...|*|size|\0| ...load... |
         +----------------------------+
@@ -37,69 +46,204 @@ class msg_trans_proto(object):
                 +-----------------------+
         msg --> |\0\0|*|0d|hello, world!|
                 +-----------------------+
+
+    Msg format(version 2):
+        +--------------------------------+
+        |\0\0\0|#|size(4 bytes)|..load..|
+        +--------------------------------+
+                      ^
+                      +--> the length of load, unsigned int in network order
+    the reader accepts msgs of both versions, and the writer uses the version
+    set by 'set_version', which is selected by 'multi_process'.
     '''
 
     BITS_OF_LEN = 3
     ## one bits represent one hex number 'f'
     MAX_SIZE = 16 ** BITS_OF_LEN - 1
+    HEAD = '\0' * BITS_OF_LEN + '*'
+
+    FMT_OF_LEN_V2 = '!I'
+    BITS_OF_LEN_V2 = struct.calcsize(FMT_OF_LEN_V2)
+    MAX_SIZE_V2 = 2 ** (8 * BITS_OF_LEN_V2) - 1
+    HEAD_V2 = '\0' * BITS_OF_LEN + '#'
+
+    VERSION = 1
+
+    ## Note that: msgs are not read byte by byte from the pipe, every fd owns
+    #  a receive buffer which is refilled by READ_CHUNK bytes once, and all
+    #  complete msgs in it are parsed into the queue <_frames>. the broken
+    #  msg at the tail is kept in buffer until the rest of it arrives.
+    #       <_rbuf>:    fd --> [[chunk, ...], nbytes, nbytes needed to parse]
+    READ_CHUNK = 64 * 1024
+    _rbuf = {}
+    _frames = {}
+    _nonblock_fds = set()
 
     @classmethod
-    def _read(cls, fdr, is_nonblock):
-        # set fdr non-blocking if is_nonblock is True
-        if is_nonblock:
-            fl = fcntl.fcntl(fdr, fcntl.F_GETFL)
-            fcntl.fcntl(fdr, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-
-        # step 1: find head '\0...', number is BITS_OF_LEN
-        n_continue_zero = 0
+    def set_version(cls, version):
+        if version not in (1, 2):
+            raise Exception('unsupported version <%s> of msg_trans_proto' %
+                            version)
+        cls.VERSION = version
+
+    @classmethod
+    def _parse(cls, fdr, buf):
+        frames = cls._frames.setdefault(fdr, collections.deque())
+        zeros = '\0' * cls.BITS_OF_LEN
+
+        # @need     the length of buf from <start> needed to make progress
+        pos = 0
         while True:
-            latest_byte = os.read(fdr, 1)
-            if latest_byte == '\0':
-                n_continue_zero += 1
-            elif n_continue_zero < cls.BITS_OF_LEN:
-                n_continue_zero = 0
-            elif latest_byte == '*':
+            start = buf.find(zeros, pos)
+            if start < 0:
+                # the tail may be the beginning of next head
+                start = max(pos, len(buf) - cls.BITS_OF_LEN + 1)
+                need = len(buf) - start + 1
                 break
-            else:
+            if buf[pos:start]:
+                Log.warning('<fdr:%d> drop invalid bytes <%r> in pipe' %
+                            (fdr, buf[pos:start]))
+
+            i_size = start + len(zeros) + 1
+            separator = buf[i_size-1:i_size]
+            if separator == '\0':
+                # more zeros before separator, skip one
+                pos = start + 1
+                continue
+            elif separator == '*':
+                i_load = i_size + cls.BITS_OF_LEN
+            elif separator == '#':
+                i_load = i_size + cls.BITS_OF_LEN_V2
+            elif separator:
                 raise Exception('the format of pipe msg is error!')
+            else:
+                need = i_size - start
+                break
+
+            if len(buf) < i_load:
+                need = i_load - start
+                break
+            if separator == '*':
+                size_oct = int(buf[i_size:i_load], 0x10)
+            else:
+                size_oct = struct.unpack(cls.FMT_OF_LEN_V2,
+                                         buf[i_size:i_load])[0]
+            if len(buf) < i_load + size_oct:
+                need = i_load + size_oct - start
+                break
 
-        # step 2: parse len from flow
-        size = os.read(fdr, cls.BITS_OF_LEN)
-        size_oct = int(size, 0x10)
+            frames.append(buf[i_load:i_load + size_oct])
+            pos = i_load + size_oct
 
-        # step 3: parse packet load from flow
-        load = os.read(fdr, size_oct)
-        return load
+        rest = buf[start:]
+        cls._rbuf[fdr] = [[rest], len(rest), need]
+        return frames
+
+    @classmethod
+    def _set_nonblock(cls, fdr):
+        # fdr is set non-blocking only once, waitting is done by poll
+        if fdr in cls._nonblock_fds:
+            return
+        fl = fcntl.fcntl(fdr, fcntl.F_GETFL)
+        fcntl.fcntl(fdr, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        cls._nonblock_fds.add(fdr)
+
+    @classmethod
+    def _wait(cls, fdr, timeout):
+        # block until fdr is readable or timeout(seconds, None is forever)
+        poller = select.poll()
+        poller.register(fdr, select.POLLIN | select.POLLPRI)
+        if timeout is not None:
+            timeout = int(math.ceil(timeout * 1000))
+        try:
+            poller.poll(timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    @classmethod
+    def _read(cls, fdr):
+        rbuf = cls._rbuf.setdefault(fdr, [[], 0, 1])
+        chunk = os.read(fdr, max(cls.READ_CHUNK, rbuf[2] - rbuf[1]))
+        if not chunk:
+            # the fd is carried as filename to find the broken pipe
+            raise OSError(errno.EPIPE, 'pipe closed by peer', fdr)
+
+        # join chunks only if they are enough to parse a msg, so that a
+        # large msg is not copied again on every read
+        rbuf[0].append(chunk)
+        rbuf[1] += len(chunk)
+        if rbuf[1] >= rbuf[2]:
+            frames = cls._parse(fdr, ''.join(rbuf[0]))
+            if frames:
+                return frames.popleft()
+        return None
+
+    @classmethod
+    def pending(cls, fdr):
+        # the number of complete msgs that can be read without syscall
+        return len(cls._frames.get(fdr, ()))
+
+    @classmethod
+    def reset(cls, fd):
+        # drop the buffered data when fd is closed, the number may be reused
+        cls._rbuf.pop(fd, None)
+        cls._frames.pop(fd, None)
+        cls._nonblock_fds.discard(fd)
 
     @classmethod
     def read(cls, fdr, timeout=0):
-        start_time = time.time()
+        '''
+        @timeout    < 0: block until one msg arrives
+                    = 0: return None at once if no complete msg
+                    > 0: wait for seconds at most, the waitting is done by
+                         poll, so it costs no CPU
+        '''
+        frames = cls._frames.get(fdr)
+        if frames:
+            buf = frames.popleft()
+            Log.debug('..-read-<pid:%s> read <%s>' % (os.getpid(), buf))
+            return buf
 
-        is_nonblock = True
-        if timeout < 0:
-            is_nonblock = False
+        cls._set_nonblock(fdr)
+        deadline = time.time() + timeout
 
         while True:
             try:
-                #return cls._read(fdr, is_nonblock)
-                buf = cls._read(fdr, is_nonblock)
-                Log.debug('..-read-<pid:%s> read <%s>' % (os.getpid(), buf))
-                return buf
+                buf = cls._read(fdr)
+                if buf is not None:
+                    Log.debug('..-read-<pid:%s> read <%s>' %
+                              (os.getpid(), buf))
+                    return buf
             except OSError as e:
                 if e.errno == errno.EAGAIN:
                     pass
+                elif e.errno == errno.EPIPE:
+                    raise
                 else:
                     err_msg = '<fdr:%d> read pipe failed due to <%d:%s>' % \
-                              (e.errno, e.strerror)
+                              (fdr, e.errno, e.strerror)
                     Log.error(err_msg)
                     raise pipe_link_exception(err_msg)
 
-            eplased_time = time.time() - start_time
-            if eplased_time >= timeout:
+            if timeout < 0:
+                cls._wait(fdr, None)
+                continue
+
+            remain_time = deadline - time.time()
+            if remain_time <= 0:
                 return None
+            cls._wait(fdr, remain_time)
 
     @classmethod
-    def write(cls, fdw, load):
+    def pack(cls, load):
+        if cls.VERSION == 2:
+            if len(load) > cls.MAX_SIZE_V2:
+                raise Exception('the size of load is larger than '
+                                '<limit:0x%.2X' % cls.MAX_SIZE_V2)
+            size = struct.pack(cls.FMT_OF_LEN_V2, len(load))
+            return '%s%s%s' % (cls.HEAD_V2, size, load)
+
         if len(load) > cls.MAX_SIZE:
             raise Exception('the size of load is larger than <limit:0x%.2X'
                             % cls.MAX_SIZE)
@@ -107,8 +251,20 @@ class msg_trans_proto(object):
         separator = '*'
         size_origin = '%X' % len(load)
         size = size_origin.zfill(cls.BITS_OF_LEN)
-        msg = '%s%s%s%s' % (head, separator, size, load)
-        os.write(fdw, msg)
+        return '%s%s%s%s' % (head, separator, size, load)
+
+    @classmethod
+    def write(cls, fdw, load):
+        msg = cls.pack(load)
+        # a large msg may be written partially into pipe
+        try:
+            n_written = os.write(fdw, msg)
+            while n_written < len(msg):
+                n_written += os.write(fdw, buffer(msg, n_written))
+        except OSError as e:
+            if e.errno == errno.EPIPE:
+                raise OSError(e.errno, e.strerror, fdw)
+            raise
         Log.debug('..-write-<pid:%s> write <%s>' % (os.getpid(), msg))
 
 
@@ -127,24 +283,52 @@ class multi_process(object):
     +----------------------------------+  <--handle --<pub_func>
     |               pub                |
     +----------------------------------+  <--end loop --<fin_func>
+
+    with <n_threads> greater than 1, every sub process runs <n_threads> subs
+    as threads(see <pipe_thread>), and msgs of them share the pipe of the
+    process by tagging every msg with the slot of thread:
+        <slot>:<msg>
+    publisher sees every thread as a subscriber linked by <pr, slot>.
+
+    watchdog asks publisher for links serving guest over their deadline
+    every WATCH_INTERVAL, the sub process of them is killed and restored by
+    <_restore_pipe>. the expired links of it are reported by <hd_timeout>,
+    and guests of the others are put back by <hd_requeue>.
     '''
 
-    MAX_CONCURRENCY = 32
-    TIMEOUT = 0
+    ## fds kept for log files, epoll and so on besides pipes of sub processes
+    RESERVED_FDS = 64
+    ## seconds to wait for events in epoll, <fin_func> is checked at least
+    #  once per TIMEOUT
+    TIMEOUT = 1
+    ## version of msg_trans_proto used between publisher and subscribers,
+    #  version 2 is able to carry load larger than 4095 bytes
+    PROTO_VERSION = 2
+    ## subs run as threads in every sub process
+    N_THREADS = 1
+    ## seconds between two checks of watchdog
+    WATCH_INTERVAL = 1
 
-    def __init__(self, concurrency, timeout=None):
+    def __init__(self, concurrency, timeout=None, proto_version=None,
+                 n_threads=None):
 
-        if concurrency > self.MAX_CONCURRENCY:
-            Log.error('number of concurrency is larger than the limit %d' %
-                      self.MAX_CONCURRENCY)
-            sys.exit(1)
         self.concurrency = concurrency
+        if n_threads:
+            self.N_THREADS = n_threads
+        # pr --> functions replying to threads of the sub process by slot
+        self.senders = {}
+        self._check_fd_limit()
         self.process_pool = {}
 
         if timeout:
             self.TIMEOUT = timeout
         self.epoll = select.epoll()
 
+        # sub processes inherit the version when they are forked
+        if proto_version:
+            self.PROTO_VERSION = proto_version
+        msg_trans_proto.set_version(self.PROTO_VERSION)
+
         # Note:
         #   *pub_func:      publisher --> publish msgs according the request
         #                   of subscriber.
@@ -173,6 +357,28 @@ class multi_process(object):
         self.sub_func_kwargs = None
 
         self.fin_func = None
+        # publisher without deadlines(expired_links) is not watched
+        self.watch_func = None
+        self.next_watch = 0
+
+        # fd --> callback when fd is readable, for fds other than pipes
+        # (e.g. socket of <job_server>)
+        self.readers = {}
+
+    def _check_fd_limit(self):
+        # every sub process holds two fds of pipe in monitor process, so the
+        # concurrency is only limited by RLIMIT_NOFILE
+        n_fds = 2 * self.concurrency + self.RESERVED_FDS
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY or n_fds <= soft:
+            return
+
+        if hard != resource.RLIM_INFINITY and n_fds > hard:
+            Log.error('number of concurrency:%d needs %d fds, it is larger '
+                      'than the limit %d' % (self.concurrency, n_fds, hard))
+            sys.exit(1)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (n_fds, hard))
+        Log.info('raise the limit of fds from %d to %d' % (soft, n_fds))
 
     def _exit(self):
         self._exit_process_in_pool()
@@ -187,6 +393,7 @@ class multi_process(object):
         self.pub_func_kwargs = kwargs
 
         self.fin_func = obj_pub.fin_func
+        self.watch_func = getattr(obj_pub, 'expired_links', None)
 
     def register_subscriber(self, obj_sub, *argv, **kwargs):
         self.subscriber = obj_sub
@@ -194,6 +401,14 @@ class multi_process(object):
         self.sub_func_argv = argv
         self.sub_func_kwargs = kwargs
 
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def remove_reader(self, fd):
+        if self.readers.pop(fd, None):
+            self.epoll.unregister(fd)
+
     def _sig_handler(self, sig, frame):
         Log.info('--> Caught kill signal <%s>, exit process' % sig)
         self._exit()
@@ -212,7 +427,23 @@ class multi_process(object):
             # for child process
             os.close(pr)
             os.close(pw)
-            self.sub_func(cr, cw, *self.sub_func_argv, **self.sub_func_kwargs)
+            # pipes of other sub processes are inherited, but never used
+            for fdr in self.process_pool.keys():
+                os.close(fdr)
+                os.close(self.process_pool[fdr]['pw'])
+            # and sub process must not kill others by handler of monitor
+            self.process_pool = {}
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if self.N_THREADS > 1:
+                engine = pipe_thread(self.N_THREADS, cr, cw)
+                engine.register_subscriber(self.subscriber,
+                                           *self.sub_func_argv,
+                                           **self.sub_func_kwargs)
+                engine.start()
+            else:
+                self.sub_func(cr, cw, *self.sub_func_argv,
+                              **self.sub_func_kwargs)
 
             Log.error('sub process should not run here')
             sys.exit(1)
@@ -224,6 +455,8 @@ class multi_process(object):
             os.close(cr)
             os.close(cw)
             self.process_pool[pr] = {'pid':pid, 'pw':pw}
+            self.senders[pr] = [functools.partial(self._write_tagged, pw, slot)
+                                for slot in xrange(self.N_THREADS)]
             self.epoll.register(pr, select.EPOLLIN)
 
             # register signal handler
@@ -236,28 +469,82 @@ class multi_process(object):
 
         pid = self.process_pool[fdr]['pid']
         os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        # fds are closed, so their numbers reused by the new pipes are never
+        # written by replies for the killed process
+        os.close(fdr)
+        os.close(self.process_pool[fdr]['pw'])
         self.process_pool.pop(fdr)
+        self.senders.pop(fdr, None)
+        msg_trans_proto.reset(fdr)
 
         self._create_new_pipe_pair()
 
+    def _pr_of(self, fd):
+        # pipe pair of sub process which fd(fdr or fdw) belongs to
+        if fd in self.process_pool:
+            return fd
+        for pr, process in self.process_pool.items():
+            if process['pw'] == fd:
+                return pr
+        return None
+
+    def _links_of(self, pr):
+        if self.N_THREADS == 1:
+            return [pr]
+        return [(pr, slot) for slot in xrange(self.N_THREADS)]
+
+    def _kill_links(self, pr, expired, reason):
+        # links in <expired> are reported with the reason of publisher, the
+        # others are killed with them since they share the sub process, and
+        # their guests are served again. all guests are failed by <reason>
+        # if the sub process is disconnected
+        if self.watch_func:
+            for link in self._links_of(pr):
+                if link in expired:
+                    self.publisher.hd_timeout(link)
+                elif expired:
+                    self.publisher.hd_requeue(link, reason)
+                else:
+                    self.publisher.hd_timeout(link, reason)
+        self._restore_pipe(pr)
+
+    def _watch(self):
+        now = time.time()
+        if not self.watch_func or now < self.next_watch:
+            return
+        self.next_watch = now + self.WATCH_INTERVAL
+
+        expired = set(self.watch_func(now))
+        prs = set()
+        for link in expired:
+            prs.add(link if self.N_THREADS == 1 else link[0])
+        for pr in prs:
+            Log.warning('--> kill sub process <pid:%d> serving guest over '
+                        'deadline' % self.process_pool[pr]['pid'])
+            self._kill_links(pr, expired,
+                             'killed with a timed out guest of the same sub '
+                             'process')
+
     def start(self):
         self._init_process_in_pool()
         # TODO: when pipe disconnected, it need to restore it by restarting
         #       new process
 
-        # to monitor which pair of pipe(fdr/fdw) is using when pipe breaking
-        self.runtime_pr = None
         while True:
             try:
                 self._manage_process_pool()
             except OSError as e:
-                if e.errno == errno.EPIPE:
+                # the pipe broken is carried by exception, it is not always
+                # the one being read, e.g. reply is written to another link
+                pr = self._pr_of(e.filename)
+                if e.errno == errno.EPIPE and pr is not None:
                     Log.warning('Pipe<pr:%d> disconnected with sub process'
                                 '<pid:%d> due to %s' %
-                                (self.runtime_pr,
-                                 self.process_pool[self.runtime_pr]['pid'],
+                                (pr, self.process_pool[pr]['pid'],
                                  e.strerror))
-                    self._restore_pipe(self.runtime_pr)
+                    self._kill_links(pr, (),
+                                     'down: sub process is disconnected')
                 else:
                     Log.error('Unexception failed!<%d:%s>' %
                               (e.errno, e.strerror))
@@ -277,17 +564,37 @@ class multi_process(object):
             if self.fin_func():
                 self._exit()
                 break
+            self._watch()
 
             events = self.epoll.poll(self.TIMEOUT)
             if not events:
                 continue;
 
             for pr, event in events:
-                self.runtime_pr = pr
+                if pr in self.readers:
+                    self.readers[pr]()
+                    continue
                 if event & select.EPOLLIN:
-                    pw = self.process_pool[pr]['pw']
-                    self.pub_func(pr, pw, *self.pub_func_argv,
-                                  **self.pub_func_kwargs)
+                    self._handle_pipe(pr)
+                    # msgs already in receive buffer would not wake up epoll
+                    while msg_trans_proto.pending(pr):
+                        self._handle_pipe(pr)
+
+    def _handle_pipe(self, pr):
+        if self.N_THREADS == 1:
+            pw = self.process_pool[pr]['pw']
+            self.pub_func(pr, pw, *self.pub_func_argv, **self.pub_func_kwargs)
+            return
+
+        req = msg_trans_proto.read(pr)
+        if req is None:
+            return
+        slot, msg = req.split(':', 1)
+        slot = int(slot)
+        self.publisher.dispatch((pr, slot), msg, self.senders[pr][slot])
+
+    def _write_tagged(self, pw, slot, msg):
+        msg_trans_proto.write(pw, '%d:%s' % (slot, msg))
 
     def _exit_process_in_pool(self):
         for pr in self.process_pool.keys():
@@ -297,6 +604,7 @@ class multi_process(object):
             os.kill(pid, signal.SIGKILL)
             os.close(pr)
             os.close(pw)
+            msg_trans_proto.reset(pr)
 
     def _init_process_in_pool(self):
         Log.info('init process poll with concurrency:%d' % self.concurrency)
@@ -304,30 +612,627 @@ class multi_process(object):
             self._create_new_pipe_pair()
 
     def daemonize(self):
-        Log.info('Daemonize process...')
+        return daemonize()
+
+
+class multi_thread(object):
+    '''
+    This is publisher-subscriber system running subs as threads
+    +----------------------------------+  <--handle --<sub_func>
+    |  t1       t2       t3       tn   |
+    | +---+    +---+    +---+    +---+ |
+    | |sub|    |sub|    |sub|    |sub| |  one sub is one thread
+    | +---+    +---+    +---+    +---+ |
+    +----------------------------------+
+       +-----+   |queue^
+       |inbox|   |msg  | no pipe, msgs are passed as they are
+       +-----+   v     |
+    +----------------------------------+  <--handle --<pub.dispatch>
+    |               pub                |
+    +----------------------------------+  <--end loop --<fin_func>
+
+    paramiko releases GIL while waitting for socket, so threads are enough
+    for subs which spend most of the time on waitting for remote hosts.
+    '''
+
+    ## seconds to wait for msgs of subs, <fin_func> is checked at least once
+    #  per TIMEOUT
+    TIMEOUT = 1
+
+    def __init__(self, concurrency, timeout=None):
+        self.concurrency = concurrency
+        if timeout:
+            self.TIMEOUT = timeout
+
+        # @to_pub       queue of <link, msg> from all subs to pub
+        # @inboxes      link --> queue of msgs from pub to the sub
+        # @senders      link --> function replying to the sub
+        self.to_pub = Queue.Queue()
+        self.inboxes = {}
+        self.senders = {}
+        self.thread_pool = {}
+
+        self.publisher = None
+        self.fin_func = None
+        self.subscriber = None
+        self.sub_func = None
+        self.sub_func_argv = None
+        self.sub_func_kwargs = None
+
+        # fd --> callback when fd is readable, fds are polled once per
+        # TIMEOUT at least since msgs of subs are waitted on queue
+        self.readers = {}
+
+    def register_publisher(self, obj_pub, *argv, **kwargs):
+        self.publisher = obj_pub
+        self.fin_func = obj_pub.fin_func
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def _run_readers(self):
+        if not self.readers:
+            return
+        readable = select.select(self.readers.keys(), [], [], 0)[0]
+        for fd in readable:
+            if fd in self.readers:
+                self.readers[fd]()
+
+    def register_subscriber(self, obj_sub, *argv, **kwargs):
+        self.subscriber = obj_sub
+        self.sub_func = obj_sub.handler
+        self.sub_func_argv = argv
+        self.sub_func_kwargs = kwargs
+
+    ## =======================================================================
+    #   used by threads of subscriber
+    def send_to_pub(self, link, msg):
+        self.to_pub.put((link, msg))
+
+    def get_inbox(self, link):
+        return self.inboxes[link]
+
+    ## =======================================================================
+    def _exit(self):
+        # threads of subs are daemon, they end with monitor
+        Log.info('..(&.&).. end monitor with %d threads' %
+                 len(self.thread_pool))
+        sys.exit(0)
+
+    def _run_sub(self, link, is_restored=False):
+        if is_restored:
+            # msgs to the dead thread are dropped until publisher ends it
+            inbox = self.inboxes[link]
+            while inbox.get() != 'end':
+                pass
+        try:
+            self.sub_func(link, self, *self.sub_func_argv,
+                          **self.sub_func_kwargs)
+        except Exception as e:
+            Log.error('sub thread <link:%d> exit due to %s' % (link, e))
+            # the guest of link is failed as the host is down, and a new
+            # thread serves the link instead
+            self.send_to_pub(link, 'down\r\r%s' % e)
+            self._start_thread(link, True)
+
+    def _create_new_thread(self, link):
+        self.inboxes[link] = Queue.Queue()
+        self.senders[link] = self.inboxes[link].put
+        self._start_thread(link)
+        Log.info('  (^_^) create sub thread <link:%d> successfully!' % link)
+
+    def _start_thread(self, link, is_restored=False):
+        thread = threading.Thread(target=self._run_sub,
+                                  args=(link, is_restored))
+        thread.daemon = True
+        thread.start()
+        self.thread_pool[link] = thread
+
+    def _init_thread_in_pool(self):
+        Log.info('init thread pool with concurrency:%d' % self.concurrency)
+        for link in xrange(self.concurrency):
+            self._create_new_thread(link)
+
+    def start(self):
+        self._init_thread_in_pool()
+        try:
+            self._manage_thread_pool()
+        except Exception as e:
+            msg = '%s' % e
+            if msg == 'pub:exit':
+                Log.info('...(^_^)> publisher exit..')
+            else:
+                Log.error('...(>_<!)> exit due to %s' % e)
+        self._exit()
+
+    def _manage_thread_pool(self):
+        while True:
+            # the time of breaking main loop is determined by publisher
+            if self.fin_func():
+                break
+            self._run_readers()
+
+            try:
+                link, msg = self.to_pub.get(timeout=self.TIMEOUT)
+            except Queue.Empty:
+                continue
+            self.publisher.dispatch(link, msg, self.senders[link])
+            # handle all msgs arrived meanwhile before checking <fin_func>
+            while True:
+                try:
+                    link, msg = self.to_pub.get_nowait()
+                except Queue.Empty:
+                    break
+                self.publisher.dispatch(link, msg, self.senders[link])
+
+
+class pipe_thread(multi_thread):
+    '''
+    threads of subs in one sub process of <multi_process>. msgs from threads
+    are tagged by slot and written to the pipe of the process, and msgs read
+    from the pipe are routed to the inbox of the thread by their tags.
+    '''
+    def __init__(self, n_threads, fdr, fdw):
+        multi_thread.__init__(self, n_threads)
+        self.fdr = fdr
+        self.fdw = fdw
+        # threads share one pipe, so a msg must be written at once
+        self.write_lock = threading.Lock()
+
+    def send_to_pub(self, link, msg):
+        with self.write_lock:
+            msg_trans_proto.write(self.fdw, '%d:%s' % (link, msg))
+
+    def start(self):
+        self._init_thread_in_pool()
+        # sub process exits once the pipe is broken by monitor
+        while True:
+            req = msg_trans_proto.read(self.fdr, timeout=-1)
+            slot, msg = req.split(':', 1)
+            self.inboxes[int(slot)].put(msg)
+
+
+def daemonize():
+    '''
+    detach from terminal, it must be called before threads are started
+    since only the calling thread survives fork
+    '''
+    Log.info('Daemonize process...')
+    try:
+        pid = os.fork()
+    except OSError as e:
+        raise Exception('fork failed due to %s:%s' % (e.errno, e.strerror))
+
+    if pid == 0:
+        os.setsid()
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
         try:
             pid = os.fork()
         except OSError as e:
-            raise Exception('fork failed due to %s:%s' % (e.errno, e.strerror))
+            raise Exception('fork failed due to %s:%s' %
+                            (e.errno, e.strerror))
 
         if pid == 0:
-            os.setsid()
-            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            os.chdir('/')
+            os.umask(0)
+        else:
+            os._exit(0)
+    else:
+        os._exit(0)
+
+    # it was originally necessary to turn off all fds to avoid side-effect
+    # but I wish this process can inherite fd open by 'Log'
+    return 0
 
+
+class line_reader(object):
+    '''
+    read lines of <fd>(e.g. terminal) through <add_reader> of engine, so the
+    main loop is not blocked while waitting for the lines. <on_line> is
+    called with every line, and its reply is written to <fdw> if it is set.
+    <on_close> is called once <fd> is closed(e.g. stdin is /dev/null)
+    '''
+    def __init__(self, fd, on_line, fdw=None, on_close=None):
+        self.fd = fd
+        self.on_line = on_line
+        self.fdw = fdw
+        self.on_close = on_close
+        self.engine = None
+        self.buf = ''
+
+    def attach(self, engine):
+        self.engine = engine
+        engine.add_reader(self.fd, self._on_read)
+
+    def close(self):
+        self.engine.remove_reader(self.fd)
+
+    def _on_read(self):
+        try:
+            data = os.read(self.fd, 0x1000)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        if not data:
+            Log.warning('<fd:%d> is closed, no more line is read' % self.fd)
+            self.close()
+            if self.on_close:
+                self.on_close()
+            return
+
+        lines = (self.buf + data).split('\n')
+        self.buf = lines.pop()
+        for line in lines:
+            reply = self.on_line(line)
+            if self.fdw is not None and reply:
+                os.write(self.fdw, reply)
+
+
+class job_server(object):
+    '''
+    accept jobs on a local unix socket for a long-lived engine. a client
+    sends one job as json and shuts down writing, then reads the reply:
+        {"hosts": [<host>, ...], "commands": [<cmd>, ...]}
+    or the answer of group confirmation if <on_confirm> is set:
+        {"confirm": <answer>}
+    sockets are watched by the engine through <add_reader>, so both
+    <multi_process> and <event_loop> are able to serve jobs.
+    '''
+    ## max bytes of one job
+    MAX_JOB_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path, on_job, on_confirm=None):
+        # @on_job       called with <hosts, cmds> of job, returns the reply
+        # @on_confirm   called with answer of confirmation, returns the reply
+        # @bufs         fd of connection --> [received chunks, size]
+        self.path = path
+        self.on_job = on_job
+        self.on_confirm = on_confirm
+        self.engine = None
+        self.bufs = {}
+
+        self._remove_stale(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # jobs are run by the ssh key of daemon, so only its user may
+        # connect. umask is 0 after daemonize, the socket is created under
+        # a restrictive one instead of being open to all users for a while
+        old_umask = os.umask(0177)
+        try:
+            self.sock.bind(path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(path, 0600)
+        self.sock.listen(16)
+        self.sock.setblocking(0)
+
+    def _remove_stale(self, path):
+        # only the socket left by a dead daemon is removed, any other file
+        # at <path> is kept
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        if not stat.S_ISSOCK(st.st_mode):
+            raise Exception('%s is existed and is not a socket' % path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error:
+            os.unlink(path)
+            return
+        finally:
+            sock.close()
+        raise Exception('%s is served by another daemon' % path)
+
+    def attach(self, engine):
+        self.engine = engine
+        engine.add_reader(self.sock.fileno(), self._on_accept)
+
+    def close(self):
+        self.engine.remove_reader(self.sock.fileno())
+        self.sock.close()
+        os.unlink(self.path)
+
+    def _on_accept(self):
+        try:
+            conn, addr = self.sock.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        conn.setblocking(0)
+        self.bufs[conn.fileno()] = [[], 0]
+        self.engine.add_reader(conn.fileno(),
+                               functools.partial(self._on_read, conn))
+
+    def _finish(self, conn, reply):
+        fd = conn.fileno()
+        self.engine.remove_reader(fd)
+        self.bufs.pop(fd, None)
+        try:
+            # reply is short, the client is waitting for it
+            conn.setblocking(1)
+            conn.sendall(reply)
+        except socket.error as e:
+            Log.warning('reply job failed due to %s' % e)
+        conn.close()
+
+    def _on_read(self, conn):
+        try:
+            data = conn.recv(0x10000)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self._finish(conn, '')
+            return
+
+        buf = self.bufs[conn.fileno()]
+        if data:
+            buf[0].append(data)
+            buf[1] += len(data)
+            if buf[1] > self.MAX_JOB_SIZE:
+                self._finish(conn, 'error: job is too large\n')
+            return
+
+        try:
+            job = json.loads(''.join(buf[0]))
+            if self.on_confirm and 'confirm' in job:
+                reply = self.on_confirm(
+                        ('%s' % job['confirm']).encode('utf-8'))
+            else:
+                reply = self._accept_job(job)
+        except Exception as e:
+            Log.warning('reject job due to %s' % e)
+            reply = 'error: %s\n' % e
+        self._finish(conn, reply)
+
+
+    def _accept_job(self, job):
+        for key in ('hosts', 'commands'):
+            if not isinstance(job.get(key), list):
+                raise Exception('<%s> of job must be a list' % key)
+        # msgs of pipes are byte strings
+        hosts = [host.encode('utf-8') for host in job['hosts']]
+        cmds = [cmd.encode('utf-8') for cmd in job['commands']]
+        return self.on_job(hosts, cmds)
+
+
+def submit_job(path, hosts, cmds):
+    '''
+    submit one job to <job_server> listening on <path>, return the reply
+    '''
+    return _request(path, {'hosts': hosts, 'commands': cmds})
+
+
+def submit_confirm(path, answer):
+    '''
+    answer the group confirmation of <job_server> listening on <path>
+    '''
+    return _request(path, {'confirm': answer})
+
+
+def _request(path, load):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(json.dumps(load))
+    sock.shutdown(socket.SHUT_WR)
+
+    reply = []
+    while True:
+        data = sock.recv(0x1000)
+        if not data:
+            break
+        reply.append(data)
+    sock.close()
+    return ''.join(reply)
+
+
+class thread_executor(object):
+    '''
+    run blocking functions by a fixed number of threads, the callback of
+    every function is not run by the thread, but queued in <done_queue> and
+    the owner is woken up by writing <wakeup_w>:
+        submit(func, callback) --> [task_queue] --> thread: func()
+                                                        |
+        run_callbacks() <-- wakeup_r <-- [done_queue] <-+
+    '''
+    def __init__(self, n_threads):
+        self.task_queue = Queue.Queue()
+        self.done_queue = collections.deque()
+
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+        for i in xrange(n_threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            func, callback = self.task_queue.get()
+            result = None
+            error = None
+            try:
+                result = func()
+            except Exception as e:
+                error = e
+            self.done_queue.append((callback, result, error))
             try:
-                pid = os.fork()
+                os.write(self.wakeup_w, 'x')
             except OSError as e:
-                raise Exception('fork failed due to %s:%s' %
-                                (e.errno, e.strerror))
+                # the pipe is full, and the owner is woken up already
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def submit(self, func, callback):
+        self.task_queue.put((func, callback))
 
-            if pid == 0:
-                os.chdir('/')
-                os.umask(0)
+    def run_callbacks(self):
+        try:
+            os.read(self.wakeup_r, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        while self.done_queue:
+            callback, result, error = self.done_queue.popleft()
+            callback(result, error)
+
+
+class event_loop(object):
+    '''
+    This is publisher-subscriber system running in one process
+    +----------------------------------+  <--handle --<sub_func>
+    |  s1       s2       s3       sn   |
+    | +---+    +---+    +---+    +---+ |
+    | |sub|    |sub|    |sub|    |sub| |  one sub is one session object
+    | +---+    +---+    +---+    +---+ |
+    +----------------------------------+
+       +-----+   |queue^
+       |epoll|   |msg  | no pipe, msgs are passed by two queues
+       +-----+   v     |
+    +----------------------------------+  <--handle --<pub.dispatch>
+    |               pub                |
+    +----------------------------------+  <--end loop --<fin_func>
+
+    subs never block the loop: fds they wait for(e.g. ssh channel) are
+    watched by epoll, and blocking calls(e.g. ssh handshake) are run by
+    <thread_executor> whose callbacks are run in the loop.
+    '''
+
+    ## seconds to wait for events in epoll
+    TIMEOUT = 1
+    ## seconds between two calls of tickers, only if there are tickers
+    TICK = 0.1
+    N_THREADS = 16
+
+    def __init__(self, concurrency, timeout=None, n_threads=None):
+        self.concurrency = concurrency
+        if timeout:
+            self.TIMEOUT = timeout
+        self.epoll = select.epoll()
+        self.executor = thread_executor(n_threads or self.N_THREADS)
+        self.epoll.register(self.executor.wakeup_r, select.EPOLLIN)
+
+        # @readers      fd --> callback when fd is readable
+        # @tickers      callbacks called every TICK
+        # @to_pub       queue of <link, msg> from subs to pub
+        # @to_sub       queue of <link, msg> from pub to subs
+        self.readers = {}
+        self.tickers = set()
+        self.to_pub = collections.deque()
+        self.to_sub = collections.deque()
+
+        self.publisher = None
+        self.fin_func = None
+        self.subscriber = None
+        self.sub_func = None
+        self.sub_func_argv = None
+        self.sub_func_kwargs = None
+
+        # link --> session of sub, and link --> function replying to it
+        self.sessions = {}
+        self.senders = {}
+
+    def register_publisher(self, obj_pub, *argv, **kwargs):
+        self.publisher = obj_pub
+        self.fin_func = obj_pub.fin_func
+
+    def register_subscriber(self, obj_sub, *argv, **kwargs):
+        self.subscriber = obj_sub
+        self.sub_func = obj_sub.handler
+        self.sub_func_argv = argv
+        self.sub_func_kwargs = kwargs
+
+    ## =======================================================================
+    #   used by sessions of subscriber
+    def send_to_pub(self, link, msg):
+        self.to_pub.append((link, msg))
+
+    def send_to_sub(self, link, msg):
+        self.to_sub.append((link, msg))
+
+    def run_in_executor(self, func, callback):
+        self.executor.submit(func, callback)
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def remove_reader(self, fd):
+        if self.readers.pop(fd, None):
+            self.epoll.unregister(fd)
+
+    def add_ticker(self, callback):
+        self.tickers.add(callback)
+
+    def remove_ticker(self, callback):
+        self.tickers.discard(callback)
+
+    ## =======================================================================
+    def _exit(self):
+        Log.info('..(&.&).. end event loop with <pid:%d>' % os.getpid())
+        sys.exit(0)
+
+    def _init_sessions(self):
+        Log.info('init sessions with concurrency:%d' % self.concurrency)
+        for link in xrange(self.concurrency):
+            self.senders[link] = functools.partial(self.send_to_sub, link)
+            self.sessions[link] = self.sub_func(link, self,
+                                                *self.sub_func_argv,
+                                                **self.sub_func_kwargs)
+
+    def _run_msgs(self):
+        while self.to_pub or self.to_sub:
+            while self.to_pub:
+                link, msg = self.to_pub.popleft()
+                self.publisher.dispatch(link, msg, self.senders[link])
+            while self.to_sub:
+                link, msg = self.to_sub.popleft()
+                self.sessions[link].on_msg(msg)
+
+    def start(self):
+        self._init_sessions()
+        try:
+            self._loop()
+        except Exception as e:
+            msg = '%s' % e
+            if msg == 'pub:exit':
+                Log.info('...(^_^)> publisher exit..')
             else:
-                os._exit(0)
-        else:
-            os._exit(0)
+                Log.error('...(>_<!)> exit due to %s' % e)
+        self._exit()
+
+    def _loop(self):
+        while True:
+            self._run_msgs()
+            # the time of breaking main loop is determined by publisher
+            if self.fin_func():
+                break
+
+            timeout = self.TIMEOUT
+            if self.tickers:
+                timeout = self.TICK
+            try:
+                events = self.epoll.poll(timeout)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
 
-        # it was originally necessary to turn off all fds to avoid side-effect
-        # but I wish this process can inherite fd open by 'Log'
-        return 0
+            for fd, event in events:
+                if fd == self.executor.wakeup_r:
+                    self.executor.run_callbacks()
+                elif fd in self.readers:
+                    self.readers[fd]()
+            for ticker in list(self.tickers):
+                ticker()
@@ -10,6 +10,9 @@ class tb_results(table_base):
     '''
     status: STATUS_OKAY: 0x00
             STATUS_FAIL: 0x01
+            STATUS_HDING: 0x02  --> result is still being streamed
+    blob:   id of <tb_blobs> holding the output, 0 means the output is in
+            <result>, e.g. it is still being streamed
     '''
     __tablename__ = 'results'
 
@@ -19,12 +22,38 @@ class tb_results(table_base):
         self.add_tb_entry('cmd', self.INT)
         self.add_tb_entry('status', self.INT)
         self.add_tb_entry('result', self.TEXT)
+        self.set_default('result', "''")
+        self.add_tb_entry('blob', self.INT)
+        self.set_default('blob', 0)
+
+        self.add_tb_index(['host', 'cmd'])
+        self.add_tb_index(['status'])
+        self.add_tb_index(['cmd', 'blob'])
+
+
+class tb_blobs(table_base):
+    '''
+    outputs are stored once by their digest, and shared by all results with
+    the identical output
+    codec:  CODEC_RAW:  0x00
+            CODEC_ZLIB: 0x01
+            CODEC_LZMA: 0x02    --> how <data> is compressed
+    '''
+    __tablename__ = 'blobs'
+
+    def create_table(self):
+        self.add_tb_entry('id', self.INT, cln_mode=self.CLN_FLG_PRIMARY)
+        self.add_tb_entry('digest', self.TEXT, cln_mode=self.CLN_FLG_UNIQUE)
+        self.add_tb_entry('data', self.TEXT)
+        self.add_tb_entry('codec', self.INT)
+        self.set_default('codec', 0)
 
 
 class tb_hosts(table_base):
     '''
     status:     0x01    --> this bit represent the ssh connection status, 1 is
                             connected, 0 is disconnected
+    duration:   seconds to serve the host in this run, 0 is not served
     '''
     __tablename__ = 'hosts'
 
@@ -32,6 +61,22 @@ class tb_hosts(table_base):
         self.add_tb_entry('id', self.INT, cln_mode=self.CLN_FLG_PRIMARY)
         self.add_tb_entry('hostname', self.TEXT, cln_mode=self.CLN_FLG_UNIQUE)
         self.add_tb_entry('status', self.INT)
+        self.add_tb_entry('duration', self.REAL)
+        self.set_default('duration', 0)
+
+
+class tb_durations(table_base):
+    '''
+    duration:   expected seconds to serve the host, learned from the previous
+                runs. the table is carried over when the database is replaced
+                by a new run
+    '''
+    __tablename__ = 'durations'
+
+    def create_table(self):
+        self.add_tb_entry('id', self.INT, cln_mode=self.CLN_FLG_PRIMARY)
+        self.add_tb_entry('hostname', self.TEXT, cln_mode=self.CLN_FLG_UNIQUE)
+        self.add_tb_entry('duration', self.REAL)
 
 
 class tb_commands(table_base):
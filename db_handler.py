@@ -1,8 +1,20 @@
 from log_x import LogX
+import hashlib
 import inspect
 import os
 import sqlite3 as db
 import sys
+import time
+import zlib
+
+# lzma is optional, it is in the standard library since python 3.3
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 
 Log = LogX(__name__)
@@ -28,6 +40,7 @@ class table_base(object):
 
     def __init__(self):
         self.entry_lst = []
+        self.index_lst = []
         self.create_table()
 
     def sql_str(self):
@@ -37,6 +50,21 @@ class table_base(object):
                   (self.__tablename__, sql_str))
         return sql_str
 
+    def index_sql_strs(self):
+        return self.index_lst
+
+    def add_tb_index(self, entries, is_unique=False):
+        # the name of index is composed of table and entries, e.g.
+        #   idx_results_host_cmd
+        flg_unique = ''
+        if is_unique:
+            flg_unique = ' unique'
+        sql_str = 'create%s index if not exists idx_%s_%s on %s (%s)' % \
+                  (flg_unique, self.__tablename__, '_'.join(entries),
+                   self.__tablename__, ', '.join(entries))
+        Log.debug('  ..would create index with <SQL:%s>' % sql_str)
+        self.index_lst.append(sql_str)
+
     def add_tb_entry(self, entry, type, cln_mode=0):
         # set default mode
         if cln_mode is 0:
@@ -82,7 +110,9 @@ class table_base(object):
 from db.main_db import tb_stastics,\
                        tb_hosts,\
                        tb_commands, \
-                       tb_results
+                       tb_results, \
+                       tb_blobs, \
+                       tb_durations
 class db_handler(object):
     '''
     Usage:
@@ -94,6 +124,8 @@ class db_handler(object):
             @tb_hosts:      record hosts need to be accessed
             @tb_commands:   record commands need to be executed
             @tb_results:    record the results returned from the remote host
+            @tb_blobs:      record the outputs of results once by digest
+            @tb_durations:  record the expected seconds of hosts of all runs
             @tb_stastics:   record the stastics of <host, commands, results>
     '''
     __tables__ = [
@@ -101,22 +133,159 @@ class db_handler(object):
             tb_hosts,
             tb_commands,
             tb_results,
+            tb_blobs,
+            tb_durations,
             ## self-defined below
             ]
 
-    def __init__(self, db_name, is_replace=False):
-        if is_replace and os.access(db_name, os.F_OK):
-            os.unlink(db_name)
+    ## status of result which is still being streamed
+    STATUS_HDING = 0x02
+
+    ## results are written behind, they are flushed in one transaction when
+    #  FLUSH_SIZE results are buffered or FLUSH_INTERVAL seconds passed
+    FLUSH_SIZE = 512
+    FLUSH_INTERVAL = 1
+
+    ## number of rows fetched once by <iter_results>
+    ITER_BATCH = 256
+
+    ## max number of <digest: blob id> cached, the cache is cleared when it
+    #  is full, so memory is bounded even if every output differs
+    BLOB_CACHE_SIZE = 0x10000
+
+    ## codecs of blobs, outputs shorter than COMPRESS_THRESHOLD bytes or not
+    #  shrunk by compression are stored raw
+    CODEC_RAW  = 0x00
+    CODEC_ZLIB = 0x01
+    CODEC_LZMA = 0x02
+    CODECS = {'zlib': CODEC_ZLIB, 'lzma': CODEC_LZMA}
+    COMPRESS_THRESHOLD = 1024
+
+    ## streamed outputs longer than it are left in <tb_results> if no blob
+    #  holds them, moving them would read and write them once again
+    MAX_STREAM_BLOB = 16 * 1024 * 1024
+
+    ## pragmas set when database is opened, in order:
+    #   @journal_mode   'wal' lets readers(e.g. dashboards) read the database
+    #                   while publisher is writing it
+    #   @synchronous    'normal' is safe in WAL mode, only the latest
+    #                   transactions may be lost by power failure
+    #   @cache_size     negative value means KiB
+    #   @mmap_size      bytes of database file mapped into memory
+    PRAGMAS = [
+            ('journal_mode', 'wal'),
+            ('synchronous', 'normal'),
+            ('cache_size', -16 * 1024),
+            ('mmap_size', 256 * 1024 * 1024),
+            ]
 
+    def __init__(self, db_name, is_replace=False, flush_size=None,
+                 flush_interval=None, pragmas=None, compress=None,
+                 compress_level=None, compress_threshold=None):
+        durations = self._read_durations(db_name)
+        if is_replace:
+            # journal files of WAL mode belong to the old database too
+            for file_name in (db_name, db_name + '-wal', db_name + '-shm'):
+                if os.access(file_name, os.F_OK):
+                    os.unlink(file_name)
+
+        # note that: all values are bound as parameters, so the SQL text of
+        #       every statement is constant and compiled only once by the
+        #       statement cache of sqlite3. outputs are stored as they are,
+        #       so they are not decoded as unicode.
+        self.db_name = db_name
         self.conn = db.connect(db_name)
+        self.conn.text_factory = str
         self.cursor = self.conn.cursor()
 
+        # pragmas in <pragmas> override the default ones in PRAGMAS, and
+        # None keeps the default value of sqlite
+        pragmas = dict(pragmas or {})
+        for name, dft_value in self.PRAGMAS:
+            self.set_pragma(name, pragmas.pop(name, dft_value))
+        for name, value in pragmas.items():
+            self.set_pragma(name, value)
+
+        # <(host, cmd): result id> of results being streamed, and their
+        # parts not written yet. parts are appended to the result at once
+        # when <flush_size> of them are buffered or by <flush>. the digest
+        # and size of every result are updated by its parts
+        self.part_ids = {}
+        self.part_bufs = {}
+        self.part_digests = {}
+
+        # cache of <hostname: id>, <command: id> and <digest: blob id>
+        self.host_ids = {}
+        self.cmd_ids = {}
+        self.blob_ids = {}
+
+        self.flush_size = flush_size or self.FLUSH_SIZE
+        self.flush_interval = flush_interval
+        if flush_interval is None:
+            self.flush_interval = self.FLUSH_INTERVAL
+        self.result_buf = []
+        self.flush_time = time.time()
+
+        # outputs are compressed by <compress>('zlib' or 'lzma') when they
+        # are written to blobs, and decompressed only when they are read.
+        # <compress_level> is the level of zlib or preset of lzma
+        self.codec = self.CODEC_RAW
+        if compress is not None:
+            self.codec = self.CODECS.get(compress)
+            if self.codec is None or \
+               (self.codec == self.CODEC_LZMA and lzma is None):
+                msg = 'compression <%s> is not supported' % compress
+                Log.fatal(msg)
+                raise db_exception(msg)
+        self.compress_level = compress_level
+        # invalid level is found at once instead of by the first output
+        # long enough to be compressed
+        if self.codec != self.CODEC_RAW:
+            try:
+                self._compress('')
+            except Exception as e:
+                msg = 'compression level <%s> is invalid: %s' % \
+                      (compress_level, e)
+                Log.fatal(msg)
+                raise db_exception(msg)
+        self.compress_threshold = compress_threshold
+        if compress_threshold is None:
+            self.compress_threshold = self.COMPRESS_THRESHOLD
+
         self._create_tables()
         self._init_tb_stastics()
+        self.cursor.executemany('insert or ignore into %s (hostname, '
+                                'duration) values (?, ?)' %
+                                (tb_durations.__tablename__), durations)
+        self.conn.commit()
+
+    def _read_durations(self, db_name):
+        # durations are kept across runs for <longest_first_sched>, so they
+        # are read before the old database is replaced. the database of old
+        # version only has durations of its own run in <tb_hosts>, they are
+        # moved to <tb_durations> even if the database is opened again
+        if not os.access(db_name, os.F_OK):
+            return []
+        conn = db.connect(db_name)
+        conn.text_factory = str
+        try:
+            for sql_str in ('select hostname, duration from %s' %
+                            (tb_durations.__tablename__),
+                            'select hostname, duration from %s '
+                            'where duration>0' % (tb_hosts.__tablename__)):
+                try:
+                    return conn.execute(sql_str).fetchall()
+                except db.Error:
+                    continue
+            return []
+        finally:
+            conn.close()
 
     def _init_tb_stastics(self):
-        self.cursor.execute("insert into %s (id, nhosts, ncommands, nresults) "
-                            "values (0, 0, 0, 0)" % (tb_stastics.__tablename__))
+        # the row is kept if database is opened again
+        self.cursor.execute('insert or ignore into %s (id, nhosts, ncommands, '
+                            'nresults) values (?, ?, ?, ?)' %
+                            (tb_stastics.__tablename__), (0, 0, 0, 0))
 
     def _create_tables(self):
 
@@ -128,15 +297,55 @@ class db_handler(object):
 
         for table in self.__tables__:
             table_name = table.__tablename__
+            tb_obj = table()
             if (unicode(table_name), ) in existed_tables:
                 Log.info('table %s is already existed' % table_name)
+                self._add_columns(tb_obj)
+            else:
+                c.execute(tb_obj.sql_str())
+                Log.debug('result is %s' % str(c.fetchall()))
+
+            # indexes may be declared after the table was created
+            for sql_str in tb_obj.index_sql_strs():
+                c.execute(sql_str)
+
+    def _add_columns(self, tb_obj):
+        # columns declared after the table was created by an old version are
+        # added, so that its database is still opened(e.g. by resume). note
+        # that the added column must be nullable or have a default value
+        c = self.cursor
+        c.execute('pragma table_info(%s)' % tb_obj.__tablename__)
+        existed_columns = set(row[1] for row in c.fetchall())
+        for entry in tb_obj.entry_lst:
+            if entry.split(' ')[0] in existed_columns:
                 continue
-
-            c.execute(table().sql_str())
-            Log.debug('result is %s' % str(c.fetchall()))
+            Log.info('add column <%s> to table %s' %
+                     (entry, tb_obj.__tablename__))
+            c.execute('alter table %s add column %s' %
+                      (tb_obj.__tablename__, entry))
 
     def commit(self):
-        self.conn.commit()
+        self.flush()
+
+    def set_pragma(self, name, value):
+        if value is None:
+            return
+        # pragma can not be bound as parameter
+        if not name.replace('_', '').isalnum() or \
+           not str(value).lstrip('-').isalnum():
+            msg = 'invalid <pragma:%s> or <value:%s>' % (name, value)
+            Log.fatal(msg)
+            raise db_exception(msg)
+        self.cursor.execute('pragma %s=%s' % (name, value))
+        Log.debug('  ..set <pragma:%s> to %s' % (name, value))
+
+    def get_pragma(self, name):
+        # some pragmas return no row, e.g. mmap_size of :memory:
+        self.cursor.execute('pragma %s' % name)
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
 
     ## =======================================================================
     #   used for public interface
@@ -144,13 +353,12 @@ class db_handler(object):
         c = self.cursor
         c.fetchall()
 
-        c.execute('select nhosts from %s where id=0' %
+        # id is assigned by sqlite as <integer primary key>
+        c.execute('insert into %s (hostname, status) values (?, ?)' %
+                  (tb_hosts.__tablename__), (host, status))
+        self.host_ids[host] = c.lastrowid
+        c.execute('update %s set nhosts=nhosts+1 where id=0' %
                   (tb_stastics.__tablename__))
-        cur_nhosts = c.fetchone()[0]
-        c.execute('insert into %s (id, hostname, status) values (%d, "%s", %d)' %
-                  (tb_hosts.__tablename__, cur_nhosts+1, host, status))
-        c.execute('update %s set nhosts=%d where id=0' %
-                           (tb_stastics.__tablename__, cur_nhosts+1))
 
         c.fetchall()
 
@@ -158,42 +366,229 @@ class db_handler(object):
         c = self.cursor
         c.fetchall()
 
-        c.execute('select ncommands from %s where id=0' %
+        c.execute('insert into %s (command) values (?)' %
+                  (tb_commands.__tablename__), (command, ))
+        self.cmd_ids.setdefault(command, c.lastrowid)
+        c.execute('update %s set ncommands=ncommands+1 where id=0' %
                   (tb_stastics.__tablename__))
-        cur_ncmds = c.fetchone()[0]
-        c.execute('insert into %s (id, command) values (%d, "%s")' %
-                  (tb_commands.__tablename__, cur_ncmds+1, command))
-        c.execute('update %s set ncommands=%d where id=0' %
-                           (tb_stastics.__tablename__, cur_ncmds+1))
 
         c.fetchall()
 
-    def put_result(self, host, cmd, status, result):
-        c = self.cursor
-        c.fetchall()
+    def put_host_duration(self, host, duration):
+        self.cursor.execute('update %s set duration=? where hostname=?' %
+                            (tb_hosts.__tablename__), (duration, host))
+        self.cursor.execute('insert or replace into %s (hostname, duration) '
+                            'values (?, ?)' % (tb_durations.__tablename__),
+                            (host, duration))
 
-        c.execute('select nresults from %s where id=0' %
-                  (tb_stastics.__tablename__))
-        cur_nresults = c.fetchone()[0]
+    def get_host_durations(self):
+        # <hostname: expected seconds> of hosts served by this run or the
+        # previous ones
+        c = self.cursor
+        c.execute('select hostname, duration from %s' %
+                  (tb_durations.__tablename__))
+        return dict(c.fetchall())
+
+    def has_host(self, host):
+        if host in self.host_ids:
+            return True
+        self.cursor.execute('select id from %s where hostname=?' %
+                            (tb_hosts.__tablename__), (host, ))
+        return self.cursor.fetchone() is not None
+
+    def has_command(self, command):
+        if command in self.cmd_ids:
+            return True
+        self.cursor.execute('select id from %s where command=?' %
+                            (tb_commands.__tablename__), (command, ))
+        return self.cursor.fetchone() is not None
+
+    def _get_host_id(self, host):
+        host_id = self.host_ids.get(host)
+        if host_id is None:
+            c = self.cursor
+            c.execute('select id from %s where hostname=?' %
+                      (tb_hosts.__tablename__), (host, ))
+            host_id = c.fetchone()[0]
+            self.host_ids[host] = host_id
+        return host_id
+
+    def _get_cmd_id(self, cmd):
+        cmd_id = self.cmd_ids.get(cmd)
+        if cmd_id is None:
+            c = self.cursor
+            c.execute('select id from %s where command=? order by id' %
+                      (tb_commands.__tablename__), (cmd, ))
+            cmd_id = c.fetchone()[0]
+            self.cmd_ids[cmd] = cmd_id
+        return cmd_id
+
+    def _encode(self, data):
+        # return <(codec, data)> to be stored
+        if self.codec == self.CODEC_RAW or \
+           len(data) < self.compress_threshold:
+            return self.CODEC_RAW, data
+
+        packed = self._compress(data)
+        if len(packed) >= len(data):
+            return self.CODEC_RAW, data
+        return self.codec, db.Binary(packed)
+
+    def _compress(self, data):
+        if self.codec == self.CODEC_ZLIB:
+            if self.compress_level is None:
+                return zlib.compress(data)
+            return zlib.compress(data, self.compress_level)
+        return lzma.compress(data, preset=self.compress_level)
+
+    @staticmethod
+    def _decode(codec, data):
+        if not codec:
+            return data
+        if codec == db_handler.CODEC_ZLIB:
+            return zlib.decompress(data)
+        if lzma is None:
+            raise db_exception('lzma is needed to read the result')
+        return lzma.decompress(data)
+
+    def _find_blob(self, digest):
+        # return id of the blob whose output has <digest>, or None
+        blob_id = self.blob_ids.get(digest)
+        if blob_id is not None:
+            return blob_id
 
-        # get host id
-        c.execute('select id from %s where hostname="%s"' %
-                  (tb_hosts.__tablename__, host))
-        host_id = c.fetchone()[0]
+        c = self.cursor
+        c.execute('select id from %s where digest=?' %
+                  (tb_blobs.__tablename__), (digest, ))
+        row = c.fetchone()
+        if row is not None:
+            self._cache_blob(digest, row[0])
+            return row[0]
+        return None
+
+    def _cache_blob(self, digest, blob_id):
+        if len(self.blob_ids) >= self.BLOB_CACHE_SIZE:
+            self.blob_ids.clear()
+        self.blob_ids[digest] = blob_id
+
+    def _put_blob(self, data):
+        # return id of the blob holding <data>, it is inserted only if no
+        # identical output is stored
+        digest = hashlib.sha1(data).hexdigest()
+        blob_id = self._find_blob(digest)
+        if blob_id is not None:
+            return blob_id
+
+        codec, data = self._encode(data)
+        self.cursor.execute('insert into %s (digest, data, codec) values '
+                            '(?, ?, ?)' % (tb_blobs.__tablename__),
+                            (digest, data, codec))
+        self._cache_blob(digest, self.cursor.lastrowid)
+        return self.cursor.lastrowid
 
-        # get command id
-        c.execute('select id from %s where command="%s"' %
-                  (tb_commands.__tablename__, cmd))
-        cmd_id = c.fetchone()[0]
+    def put_result(self, host, cmd, status, result):
+        c = self.cursor
 
-        c.execute('insert into %s (id, host, cmd, status, result) values '
-                  '(%d, %d, %d, %d, "%s")' %
-                  (tb_results.__tablename__, cur_nresults+1, host_id, cmd_id,
-                   status, result))
-        c.execute('update %s set nresults=%d where id=0' %
-                           (tb_stastics.__tablename__, cur_nresults+1))
+        # finish the result which is streamed by <put_result_part>
+        result_id = self.part_ids.pop((host, cmd), None)
+        if result_id is not None:
+            self._finish_parts((host, cmd), result_id, status, result)
+            return
+
+        # write behind, results are inserted by <flush> in batch
+        self.result_buf.append((self._get_host_id(host),
+                                self._get_cmd_id(cmd), status, result))
+        if len(self.result_buf) >= self.flush_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def put_result_part(self, host, cmd, part):
+        c = self.cursor
+        result_id = self.part_ids.get((host, cmd))
+        if result_id is None:
+            c.execute('insert into %s (host, cmd, status, result) values '
+                      '(?, ?, ?, ?)' % (tb_results.__tablename__),
+                      (self._get_host_id(host), self._get_cmd_id(cmd),
+                       self.STATUS_HDING, part))
+            self.part_ids[(host, cmd)] = c.lastrowid
+            self.part_digests[(host, cmd)] = [hashlib.sha1(part), len(part)]
+            c.execute('update %s set nresults=nresults+1 where id=0' %
+                      (tb_stastics.__tablename__))
+            return
+
+        digest = self.part_digests[(host, cmd)]
+        digest[0].update(part)
+        digest[1] += len(part)
+        # appending every part copies the whole result written before, so
+        # parts are buffered and appended together
+        parts = self.part_bufs.setdefault((host, cmd), [])
+        parts.append(part)
+        if len(parts) >= self.flush_size:
+            self._write_parts((host, cmd))
+
+    def _write_parts(self, key):
+        self.cursor.execute('update %s set result=result||? where id=?' %
+                            (tb_results.__tablename__),
+                            (''.join(self.part_bufs.pop(key)),
+                             self.part_ids[key]))
+
+    def _finish_parts(self, key, result_id, status, tail):
+        # the output is moved into blob, it is read back only if no blob
+        # holds it yet and it is not too long
+        c = self.cursor
+        digest, size = self.part_digests.pop(key)
+        digest.update(tail)
+        size += len(tail)
+        parts = self.part_bufs.pop(key, [])
+        parts.append(tail)
+
+        blob_id = self._find_blob(digest.hexdigest())
+        if blob_id is None and size <= self.MAX_STREAM_BLOB:
+            c.execute('select result from %s where id=?' %
+                      (tb_results.__tablename__), (result_id, ))
+            blob_id = self._put_blob(c.fetchone()[0] + ''.join(parts))
+        if blob_id is None:
+            c.execute('update %s set status=?, result=result||? where id=?' %
+                      (tb_results.__tablename__),
+                      (status, ''.join(parts), result_id))
+            return
+        c.execute('update %s set status=?, result=?, blob=? where id=?' %
+                  (tb_results.__tablename__), (status, '', blob_id, result_id))
+
+    def drop_result_part(self, host, cmd):
+        self.part_bufs.pop((host, cmd), None)
+        self.part_digests.pop((host, cmd), None)
+        result_id = self.part_ids.pop((host, cmd), None)
+        if result_id is not None:
+            self.cursor.execute('delete from %s where id=?' %
+                                (tb_results.__tablename__), (result_id, ))
+            self.cursor.execute('update %s set nresults=nresults-1 where id=0'
+                                % (tb_stastics.__tablename__))
+
+    def flush(self):
+        # insert buffered results and commit them in one transaction
+        c = self.cursor
+        if self.result_buf:
+            rows = [(host_id, cmd_id, status, self._put_blob(result))
+                    for host_id, cmd_id, status, result in self.result_buf]
+            # <result> is set since it has no default in old databases
+            c.executemany('insert into %s (host, cmd, status, result, blob) '
+                          'values (?, ?, ?, \'\', ?)' %
+                          (tb_results.__tablename__), rows)
+            c.execute('update %s set nresults=nresults+? where id=0' %
+                      (tb_stastics.__tablename__), (len(self.result_buf), ))
+            Log.debug('  ..flush %d results' % len(self.result_buf))
+            self.result_buf = []
+        # results being streamed are seen by readers of database in time
+        for key in self.part_bufs.keys():
+            self._write_parts(key)
+        self.conn.commit()
+        self.flush_time = time.time()
 
-        c.fetchall()
+    def flush_if_due(self):
+        if time.time() - self.flush_time >= self.flush_interval:
+            self.flush()
 
     def get_hosts(self):
         c = self.cursor
@@ -205,9 +600,126 @@ class db_handler(object):
         c.execute('select * from %s' % (tb_commands.__tablename__))
         return c.fetchall()
 
+    def _iter_rows(self, columns, host=None, cmd=None, status=None,
+                   offset=0, limit=None):
+        # rows are fetched by ITER_BATCH, so the whole table is never loaded
+        # into memory. results buffered are flushed once before the select
+        self.flush()
+
+        conditions = []
+        params = []
+        for entry, value in (('h.hostname', host), ('c.command', cmd),
+                             ('r.status', status)):
+            if value is not None:
+                conditions.append('%s=?' % entry)
+                params.append(value)
+        where = ''
+        if conditions:
+            where = 'where %s ' % ' and '.join(conditions)
+        if limit is None:
+            limit = -1
+
+        # the reader has its own connection, since results are still written
+        # and committed meanwhile(e.g. by publisher), and commit resets all
+        # cursors of the connection. it reads the snapshot of the database
+        # when the select starts, which is allowed by WAL mode. in other
+        # modes the reader is locked out by the writer, and :memory: is a
+        # new database for every connection, so rows are read by the
+        # connection of writer, and they must be read before next commit
+        conn = self.conn
+        if self.get_pragma('journal_mode') == 'wal':
+            conn = db.connect(self.db_name)
+            conn.text_factory = str
+        c = conn.cursor()
+        # the output is <b.data>, or <r.result> if it is not in blob
+        c.execute('select %s from %s r join %s h on r.host=h.id '
+                  'join %s c on r.cmd=c.id left join %s b on r.blob=b.id '
+                  '%sorder by r.id limit ? offset ?' %
+                  (columns, tb_results.__tablename__, tb_hosts.__tablename__,
+                   tb_commands.__tablename__, tb_blobs.__tablename__, where),
+                  params + [limit, offset])
+        try:
+            while True:
+                rows = c.fetchmany(self.ITER_BATCH)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            c.close()
+            if conn is not self.conn:
+                conn.close()
+
+    def iter_results(self, host=None, cmd=None, status=None, offset=0,
+                     limit=None):
+        '''
+        yield <(id, hostname, command, status, result)> of results matching
+        all given filters in order of id.
+            @offset, @limit     used for pagination
+        '''
+        # the result is decompressed when its row is yielded
+        for row in self._iter_rows('r.id, h.hostname, c.command, r.status, '
+                                   'coalesce(b.data, r.result), b.codec',
+                                   host, cmd, status, offset, limit):
+            yield row[:4] + (self._decode(row[5], row[4]), )
+
+    def iter_statuses(self):
+        '''
+        yield <(hostname, command, status)> of results in order of id, the
+        results still being streamed are excluded
+        '''
+        for row in self._iter_rows('h.hostname, c.command, r.status'):
+            if row[2] != self.STATUS_HDING:
+                yield row
+
+    def drop_unfinished_results(self):
+        # results left in streaming by a broken run are useless
+        self.flush()
+        c = self.cursor
+        c.execute('delete from %s where status=?' %
+                  (tb_results.__tablename__), (self.STATUS_HDING, ))
+        c.execute('update %s set nresults=nresults-? where id=0' %
+                  (tb_stastics.__tablename__), (c.rowcount, ))
+        self.part_ids = {}
+        self.part_bufs = {}
+        self.part_digests = {}
+        self.conn.commit()
+
+    def get_hosts_by_result(self, cmd, status):
+        # e.g. all hosts where <cmd> failed
+        return [row[0] for row in
+                self._iter_rows('h.hostname', cmd=cmd, status=status)]
+
+    def group_hosts_by_result(self, cmd, status=None):
+        '''
+        return <[(result, [hostname, ...]), ...]> of <cmd>, hosts with the
+        identical output are in one group, and larger groups come first.
+        results still being streamed are excluded
+        '''
+        groups = {}
+        for blob_id, host in self._iter_rows('r.blob, h.hostname', cmd=cmd,
+                                             status=status):
+            if blob_id:
+                groups.setdefault(blob_id, []).append(host)
+
+        c = self.cursor
+        lst_groups = []
+        for blob_id, hosts in sorted(groups.items(),
+                                     key=lambda group: len(group[1]),
+                                     reverse=True):
+            c.execute('select codec, data from %s where id=?' %
+                      (tb_blobs.__tablename__), (blob_id, ))
+            lst_groups.append((self._decode(*c.fetchone()), hosts))
+        return lst_groups
+
     def get_results(self):
+        # <(id, host id, cmd id, status, result)> of all results
+        self.flush()
         c = self.cursor
-        c.execute('select * from %s' %
-                  (tb_results.__tablename__))
-        return c.fetchall()
+        c.execute('select r.id, r.host, r.cmd, r.status, '
+                  'coalesce(b.data, r.result), b.codec from %s r '
+                  'left join %s b on r.blob=b.id order by r.id' %
+                  (tb_results.__tablename__, tb_blobs.__tablename__))
+        return [row[:4] + (self._decode(row[5], row[4]), )
+                for row in c.fetchall()]
 
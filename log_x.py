@@ -85,6 +85,9 @@ class LogX(object):
             raise LogXInitException('the <action:%s> is invalid' % action)
 
         method = getattr(self.logger, action)
+        # skip inspecting frame if the msg would be dropped by level
+        if not self.logger.isEnabledFor(getattr(logging, action.upper())):
+            return
 
         frame = sys._getframe(2)
         lineno = frame.f_lineno
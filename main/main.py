@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 import string
 import os
+import stat
 import getopt, sys
 
 sys.path.append(os.path.abspath('../'))
 from log_x import LogX
-from concur_handler import multi_process
-from pub_sub import publisher, subscriber
+from concur_handler import multi_process, multi_thread, event_loop, \
+                          job_server, submit_job, submit_confirm, \
+                          line_reader, daemonize
+from pub_sub import publisher, subscriber, thread_subscriber, \
+                    async_subscriber, fifo_sched, longest_first_sched, \
+                    conn_limiter
 from db_handler import db_handler
+from ssh_handler import ssh_pool
 
 
 Log = LogX(__name__)
@@ -15,20 +21,84 @@ log_file = './%s.log' % __file__.split('.')[0]
 Log.set_public_atrr(LogX.INFO, log_file)
 Log.open_global_stdout()
 
+## default MaxSessions of sshd
+MAX_PARALLEL = 10
+
 
 def usage():
     print """
     \r-h --help         print the help
     \r-c --concurrency  default is 1 workers(processes)
     \r-g --group        default not set group. setting group meanings you
-    \r                  should confirm every group of hosts to exec cmds
-
-    \r-o --hosts        file that defines the hostnames
-    \r-m --commands     file that defines the commands
+    \r                  should confirm every group of hosts to exec cmds. the
+    \r                  answer is read from terminal, or by '-j <socket> -a'
+    \r                  if it runs as daemon. hosts of the group are connected
+    \r                  while waitting for the answer
+
+    \r-o --hosts        file that defines the hostnames, a hostname may be
+    \r                  followed by a tag as its zone, e.g. '10.0.0.1 dc1'.
+    \r                  '-' reads them from stdin. hosts are read while they
+    \r                  are served, so the first one starts at once
+    \r-m --commands     file that defines the commands, the commands which do
+    \r                  not modify host are prefixed by '[ro] '
 
     \r-u --user         for ssh load
     \r-k --keyfile      ssh key file. (/path/to/.ssh/id_rsa)
     \r-p --password     password of ssh
+    \r-s --stream       stream output of cmds in chunks of this size(bytes),
+    \r                  default is to send the output when cmd finished
+    \r-w --window       send this number of cmds to worker at once, and the
+    \r                  results are streamed back without waitting for reply,
+    \r                  default is to send cmds one by one
+    \r-P --parallel     execute at most this number(1-10) of read-only
+    \r                  commands in a row in parallel on one host, sshd
+    \r                  limits sessions of one connection by MaxSessions
+    \r-e --engine       'process'(default) forks one process per worker,
+    \r                  'thread' runs one thread per worker,
+    \r                  'event' serves all workers in one event loop
+    \r-t --threads      default is 1. with engine 'process', every process
+    \r                  runs this number of workers as threads
+    \r-i --idle         seconds to keep released ssh connections for reuse,
+    \r                  default is 300 with daemon, otherwise 0 which means
+    \r                  closing them at once
+    \r-T --timeout      seconds to wait for output of every cmd, a cmd timed
+    \r                  out is failed, default is to wait forever
+    \r-C --connect-timeout
+    \r                  seconds to wait for connecting and authentication
+    \r-H --host-timeout seconds to serve one host at most, the worker over it
+    \r                  is killed and restarted(only with engine 'process')
+    \r-S --sched        'fifo'(default) serves hosts in order of file,
+    \r                  'longest' serves hosts slowest in the past first
+    \r-X --speculate    idle worker serves a copy of the host served over this
+    \r                  times of its expected seconds, if the rest commands
+    \r                  of it are all read-only. not used with stream
+    \r-R --rate         new ssh connections per second at most
+    \r-B --burst        new ssh connections made at once at most, default is
+    \r                  the rate
+    \r-Z --zone-cap     ssh connections alive at once per zone at most, zone
+    \r                  of host is its tag in hosts file, or its subnet
+    \r   --prefix-len   bits of subnet prefix as zone, default is 24
+
+    \r-z --compress     'zlib' or 'lzma' compresses outputs stored in database,
+    \r                  default is to store them raw
+    \r   --compress-level
+    \r                  level of zlib or preset of lzma, 0-9
+    \r   --compress-threshold
+    \r                  outputs shorter than this(bytes) are stored raw,
+    \r                  default is 1024
+
+    \r-r --resume       continue the run recorded in database, the pairs of host
+    \r                  and command which have results are skipped. hosts must
+    \r                  be set since they are recorded only once served,
+    \r                  commands are read from database if they are not set
+
+    \r-d --daemon       run as daemon which keeps workers and ssh connections
+    \r                  and accepts jobs on this unix socket, hosts and
+    \r                  commands are the first job if they are set
+    \r-j --job          submit hosts and commands as a job to the daemon
+    \r                  listening on this unix socket
+    \r-a --answer       with -j, answer the confirmation of group instead,
+    \r                  'y/Y' or 'all' confirms it, others refuse the rest
     """
 
 
@@ -38,7 +108,28 @@ def exit_with_info(info):
 
 
 def check_parameters_integrity(parameters):
-    if not parameters['hosts']or \
+    if parameters['job']:
+        if parameters['answer'] is not None:
+            return
+        if not parameters['hosts'] or not parameters['commands']:
+            exit_with_info('host and commands can not be None!')
+        return
+
+    if parameters['speculate'] and parameters['stream']:
+        exit_with_info('speculate can not be used with stream!')
+    # only processes of workers can be killed by watchdog
+    if parameters['host_timeout'] and parameters['engine'] != 'process':
+        exit_with_info('host timeout is only used with engine process!')
+
+    if parameters['daemon']:
+        if not parameters['user']:
+            exit_with_info('user can not be None!')
+        if parameters['engine'] == 'thread':
+            exit_with_info('engine thread can not run as daemon!')
+    elif parameters['resume']:
+        if not parameters['hosts'] or not parameters['user']:
+            exit_with_info('host and user can not be None!')
+    elif not parameters['hosts']or \
        not parameters['commands']or \
        not parameters['user']:
         exit_with_info('host, commands and user can not be None!')
@@ -59,13 +150,49 @@ def parse_argv():
         'user' : None,
         'keyfile' : None,
         'password' : None,
+
+        'stream' : None,
+        'window' : None,
+        'parallel' : None,
+        'engine' : 'process',
+        'threads' : 1,
+        'idle' : None,
+        'timeout' : None,
+        'connect_timeout' : None,
+        'host_timeout' : None,
+        'sched' : 'fifo',
+        'speculate' : None,
+        'rate' : None,
+        'burst' : None,
+        'zone_cap' : None,
+        'prefix_len' : 24,
+        'compress' : None,
+        'compress_level' : None,
+        'compress_threshold' : None,
+
+        'resume' : False,
+
+        'daemon' : None,
+        'job' : None,
+        'answer' : None,
             }
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hc:g:o:m:u:k:p:",
+        opts, args = getopt.getopt(sys.argv[1:],
+                                   "hc:g:o:m:u:k:p:s:w:P:e:t:i:T:C:H:S:X:"
+                                   "R:B:Z:z:rd:j:a:",
                                    ["help", "concurrency=", "group=", "hosts=",
                                     "commands=", "user=", "keyfile=",
-                                    "password="])
+                                    "password=", "stream=", "window=",
+                                    "parallel=",
+                                    "engine=", "threads=", "idle=",
+                                    "timeout=", "connect-timeout=",
+                                    "host-timeout=", "sched=", "speculate=",
+                                    "rate=", "burst=", "zone-cap=",
+                                    "prefix-len=", "compress=",
+                                    "compress-level=", "compress-threshold=",
+                                    "resume",
+                                    "daemon=", "job=", "answer="])
         for op, value in opts:
             if op in ("-h", "--help"):
                 usage()
@@ -77,7 +204,7 @@ def parse_argv():
             elif op in ("-o", "--hosts"):
                 hosts = value
                 parameters['hosts'] = hosts
-                if not os.access(hosts, os.F_OK):
+                if hosts != '-' and not os.access(hosts, os.F_OK):
                     exit_with_info('hosts file %s is not existed!' % hosts)
             elif op in ("-m", "--commands"):
                 commands = value
@@ -88,12 +215,71 @@ def parse_argv():
             elif op in ("-u", "--user"):
                 parameters['user'] = value
             elif op in ("-k", "--keyfile"):
-                keyfile = value
+                # the key is read by workers after cwd is changed by daemonize
+                keyfile = os.path.abspath(value)
                 parameters['keyfile'] = keyfile
                 if not os.access(keyfile, os.F_OK):
                     exit_with_info('keyfile file %s is not existed!' % keyfile)
             elif op in ("-p", "--password"):
                 parameters['password'] = value
+            elif op in ("-s", "--stream"):
+                parameters['stream'] = string.atoi(value)
+            elif op in ("-w", "--window"):
+                parameters['window'] = string.atoi(value)
+            elif op in ("-P", "--parallel"):
+                # cmds beyond MaxSessions of sshd wait for the former ones
+                parameters['parallel'] = string.atoi(value)
+                if not 1 <= parameters['parallel'] <= MAX_PARALLEL:
+                    exit_with_info('parallel %s is not in 1-%d!' %
+                                   (value, MAX_PARALLEL))
+            elif op in ("-e", "--engine"):
+                if value not in ('process', 'thread', 'event'):
+                    exit_with_info('engine %s is not supported!' % value)
+                parameters['engine'] = value
+            elif op in ("-t", "--threads"):
+                parameters['threads'] = string.atoi(value)
+            elif op in ("-i", "--idle"):
+                parameters['idle'] = string.atoi(value)
+            elif op in ("-T", "--timeout"):
+                parameters['timeout'] = string.atoi(value)
+            elif op in ("-C", "--connect-timeout"):
+                parameters['connect_timeout'] = string.atoi(value)
+            elif op in ("-H", "--host-timeout"):
+                parameters['host_timeout'] = string.atoi(value)
+            elif op in ("-S", "--sched"):
+                if value not in ('fifo', 'longest'):
+                    exit_with_info('sched %s is not supported!' % value)
+                parameters['sched'] = value
+            elif op in ("-X", "--speculate"):
+                parameters['speculate'] = string.atof(value)
+            elif op in ("-R", "--rate"):
+                parameters['rate'] = string.atof(value)
+            elif op in ("-B", "--burst"):
+                parameters['burst'] = string.atoi(value)
+            elif op in ("-Z", "--zone-cap"):
+                parameters['zone_cap'] = string.atoi(value)
+            elif op == "--prefix-len":
+                parameters['prefix_len'] = string.atoi(value)
+            elif op in ("-z", "--compress"):
+                if value not in ('zlib', 'lzma'):
+                    exit_with_info('compress %s is not supported!' % value)
+                parameters['compress'] = value
+            elif op == "--compress-level":
+                # level of zlib and preset of lzma are both in 0-9
+                parameters['compress_level'] = string.atoi(value)
+                if not 0 <= parameters['compress_level'] <= 9:
+                    exit_with_info('compress level %s is not in 0-9!' %
+                                   value)
+            elif op == "--compress-threshold":
+                parameters['compress_threshold'] = string.atoi(value)
+            elif op in ("-r", "--resume"):
+                parameters['resume'] = True
+            elif op in ("-d", "--daemon"):
+                parameters['daemon'] = os.path.abspath(value)
+            elif op in ("-j", "--job"):
+                parameters['job'] = value
+            elif op in ("-a", "--answer"):
+                parameters['answer'] = value
             else:
                 usage()
                 exit_with_info('can not handle this request "%s"' % op)
@@ -105,13 +291,45 @@ def parse_argv():
     return parameters
 
 
-def get_host_pool(hosts):
-    host_pool = []
+def get_host_pool(hosts, tags=None):
+    # hosts are yielded lazily, and the file is opened at once so that it is
+    # still read after cwd is changed by daemonize. '-' means stdin
+    if hosts == '-':
+        fp = sys.stdin
+    else:
+        fp = open(hosts, 'r')
+    return iter_hosts(fp, tags)
 
-    with open(hosts, 'r') as fp:
-        for line in fp:
-            host_pool.append(line.strip('\n'))
-    return host_pool
+
+def iter_hosts(fp, tags=None):
+    # tags of hosts are put into <tags> if it is given, before the host is
+    # yielded. blank lines are skipped. lines are read one by one, <for line
+    # in fp> reads ahead a block, so hosts piped in slowly would be held in
+    # it. the loop of publisher waits here until a line is read, so a slow
+    # producer of stdin stalls it
+    try:
+        for line in iter(fp.readline, ''):
+            host, sep, tag = line.strip('\n').partition(' ')
+            if not host:
+                continue
+            if tag.strip() and tags is not None:
+                tags[host] = tag.strip()
+            yield host
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+
+def open_console(hosts):
+    # answers of group confirmation are read from stdin, or from terminal if
+    # hosts are read from stdin or it is a regular file which can not be
+    # polled
+    if hosts != '-' and not stat.S_ISREG(os.fstat(0).st_mode):
+        return 0
+    try:
+        return os.open('/dev/tty', os.O_RDONLY)
+    except OSError:
+        return None
 
 
 def get_command_pool(commands):
@@ -126,21 +344,101 @@ def get_command_pool(commands):
 def main():
     argv = parse_argv()
 
+    if argv['job'] and argv['answer'] is not None:
+        print(submit_confirm(argv['job'], argv['answer']))
+        return
+    if argv['job']:
+        print(submit_job(argv['job'],
+                         list(get_host_pool(argv['hosts'])),
+                         get_command_pool(argv['commands'])))
+        return
+
     mode = 0x00
     mode |= publisher.PUB_FLG_IGNORE_FAIL
 
-    mlp= multi_process(argv['concurrency'])
-
-    pub = publisher(get_host_pool(argv['hosts']),
-                          get_command_pool(argv['commands']),
-                          argv['concurrency'],
+    hosts = []
+    tags = {}
+    commands = []
+    if argv['hosts']:
+        hosts = get_host_pool(argv['hosts'], tags)
+    if argv['commands']:
+        commands = get_command_pool(argv['commands'])
+
+    # cwd is changed to '/' by daemonize
+    db_name = os.path.abspath('%s.db' % __file__.split('.')[0])
+    if argv['daemon']:
+        mode |= publisher.PUB_FLG_DAEMON
+        daemonize()
+
+    # the database of broken run is kept to be continued
+    hdr = db_handler(db_name, is_replace=not argv['resume'],
+                     compress=argv['compress'],
+                     compress_level=argv['compress_level'],
+                     compress_threshold=argv['compress_threshold'])
+    if argv['resume'] and not argv['commands']:
+        commands = [row[1] for row in hdr.get_cmds()]
+
+    # connections are reused across hosts of one run only if user asks, but
+    # they are kept for later jobs of daemon by default
+    if argv['idle'] is None:
+        argv['idle'] = ssh_pool.IDLE_TIMEOUT if argv['daemon'] else 0
+    pool = None
+    if argv['idle'] > 0:
+        pool = ssh_pool(idle_timeout=argv['idle'])
+
+    if argv['engine'] == 'event':
+        mlp = event_loop(argv['concurrency'])
+        sub = async_subscriber(chunk_size=argv['stream'], pool=pool,
+                               timeout=argv['timeout'],
+                               connect_timeout=argv['connect_timeout'])
+    elif argv['engine'] == 'thread':
+        mlp = multi_thread(argv['concurrency'])
+        sub = thread_subscriber(chunk_size=argv['stream'], pool=pool,
+                                timeout=argv['timeout'],
+                                connect_timeout=argv['connect_timeout'])
+    elif argv['threads'] > 1:
+        mlp = multi_process(argv['concurrency'], n_threads=argv['threads'])
+        sub = thread_subscriber(chunk_size=argv['stream'], pool=pool,
+                                timeout=argv['timeout'],
+                                connect_timeout=argv['connect_timeout'])
+    else:
+        mlp = multi_process(argv['concurrency'])
+        sub = subscriber(chunk_size=argv['stream'], pool=pool,
+                         timeout=argv['timeout'],
+                         connect_timeout=argv['connect_timeout'])
+
+    # every thread of processes is a worker of publisher
+    n_workers = argv['concurrency']
+    if argv['engine'] == 'process':
+        n_workers *= argv['threads']
+
+    if argv['sched'] == 'longest':
+        sched = longest_first_sched()
+    else:
+        sched = fifo_sched()
+
+    limiter = None
+    if argv['rate'] or argv['zone_cap']:
+        limiter = conn_limiter(rate=argv['rate'],
+                               burst=argv['burst'],
+                               cap=argv['zone_cap'],
+                               tags=tags,
+                               prefix_len=argv['prefix_len'])
+
+    pub = publisher(hosts,
+                          commands,
+                          n_workers,
                           mode=mode,
-                          group=argv['group'])
-    db_name = '%s.db' % __file__.split('.')[0]
-    hdr = db_handler(db_name, is_replace=True)
+                          group=argv['group'],
+                          window=argv['window'],
+                          host_timeout=argv['host_timeout'],
+                          sched=sched,
+                          speculate=argv['speculate'],
+                          parallel=argv['parallel'],
+                          limiter=limiter)
     pub.set_db_handler(hdr)
-
-    sub = subscriber()
+    if argv['resume']:
+        pub.resume()
 
     mlp.register_publisher(pub)
     mlp.register_subscriber(sub,
@@ -148,6 +446,19 @@ def main():
                             argv['keyfile'],
                             argv['password'])
 
+    if argv['daemon']:
+        on_confirm = None
+        if argv['group']:
+            on_confirm = pub.confirm_group
+        server = job_server(argv['daemon'], pub.load_job, on_confirm)
+        server.attach(mlp)
+    elif argv['group']:
+        console = open_console(argv['hosts'])
+        if console is None:
+            exit_with_info('no terminal to confirm group!')
+        line_reader(console, pub.confirm_group, sys.stdout.fileno(),
+                    pub.close_confirmation).attach(mlp)
+
     mlp.start()
 
 
@@ -51,18 +51,218 @@ The protocol of publisher and subscriber is shown below:
          |-----------end------------>| disconnecting
          |                           |
          |<---------wait-------------| waitting
+
+
+   case 3: stream output of cmd in chunks(subscriber with chunk_size)
+         |         ......            |
+         |<------wait\\r<host>-------| connected
+         |----------cmd------------->|
+         |---------<cmd>------------>|
+         |<-part\\r<host>\\r<chunk>--| no reply, publisher appends
+         |       ...n chunks...      | chunk to the result
+         |<-okay\\r<host>\\r<chunk>--| the last chunk
+         |---------okay------------->|
+         |         ......            |
+
+
+   case 4: failed to connect host(async_subscriber)
+         |-------ack\\r<host>------->| connecting
+         |<-down\\r<host>\\r<reason>-| the waitting cmd is recorded fail
+         |-----------end------------>|
+         |<---------wait-------------| waitting
+
+
+   case 5: pipeline cmds in window(publisher with window)
+         |<------wait\\r<host>-------| connected
+         |--------cmds\\r<n>-------->|
+         |---------<cmd1>----------->|
+         |       ...n cmds...        |
+         |<-okay\\r<host>\\r<result>-| no reply for okay, the next cmd
+         |<-fail\\r<host>\\r<result>-| is executed at once
+         |---retry/ignore/end------->| replied as case 1 and 2
+         |       ...n results...     |
+         |<------wait\\r<host>-------| the next window or end
+
+
+   case 6: independent cmds in parallel(publisher with parallel)
+         |<------wait\\r<host>-------| connected
+         |--------pcmds\\r<n>------->| n read-only cmds in a row
+         |---------<cmd1>----------->|
+         |       ...n cmds...        | executed in parallel, and the
+         |<-okay\\r<host>\\r<result>-| results are replied in order as
+         |       ...n results...     | case 5
+         |<------wait\\r<host>-------|
 \r'''
 
 from log_x import LogX
 from concur_handler import msg_trans_proto as mtp
 from ssh_handler import ssh_handler
 
+import array
+import collections
+import functools
+import itertools
 import os
+import socket
+import struct
+import sys
+import time
 
 
 Log = LogX(__name__)
 
 
+class fifo_sched(object):
+    '''
+    scheduling policy of publisher, guests are served in order of queue.
+    seconds of serving every host are learned as
+        expected = (1 - ALPHA) * expected + ALPHA * duration
+    and used by publisher to find stragglers for speculation
+    '''
+    ALPHA = 0.5
+
+    def __init__(self):
+        # @durations    host --> expected seconds
+        self.durations = {}
+        self.total = 0.0
+
+    def load(self, durations):
+        # durations of previous runs read from database
+        for host, duration in durations.items():
+            self._set(host, duration)
+
+    def _set(self, host, duration):
+        self.total += duration - self.durations.get(host, 0)
+        self.durations[host] = duration
+
+    def finish(self, host, duration):
+        expected = self.durations.get(host)
+        if expected:
+            duration = (1 - self.ALPHA) * expected + self.ALPHA * duration
+        self._set(host, duration)
+        return duration
+
+    def expected(self, host):
+        # hosts never served are expected as the mean of others
+        expected = self.durations.get(host)
+        if expected is None and self.durations:
+            expected = self.total / len(self.durations)
+        return expected
+
+    def order(self, hosts):
+        return hosts
+
+
+class longest_first_sched(fifo_sched):
+    '''
+    guests expected to be served longest are served first, so that the
+    slow hosts are not left to the tail of run
+    '''
+    def order(self, hosts):
+        # all guests are read to be sorted
+        hosts = list(hosts)
+        expected = dict((host, self.expected(host) or 0) for host in hosts)
+        return sorted(hosts, key=expected.get, reverse=True)
+
+
+class conn_limiter(object):
+    '''
+    limit new ssh connections made by subscribers of publisher:
+        @rate       new connections per second, tokens of bucket are refilled
+                    by this rate, and every connection takes one
+        @burst      the max number of tokens in bucket
+        @cap        connections alive at once in one zone, e.g. behind one
+                    bastion. the zone of host is its tag, or its subnet of
+                    <prefix_len> bits if it is IPv4, or its domain
+    '''
+    def __init__(self, rate=None, burst=None, cap=None, tags=None,
+                 prefix_len=24):
+        self.rate = rate
+        self.burst = burst or max(rate or 1, 1)
+        self.tokens = self.burst
+        self.refill_time = time.time()
+
+        self.cap = cap
+        self.tags = tags or {}
+        self.mask = (0xffffffff << (32 - prefix_len)) & 0xffffffff
+        # zone --> the number of connections alive
+        self.n_conns = collections.defaultdict(int)
+
+    def zone(self, host):
+        tag = self.tags.get(host)
+        if tag is not None:
+            return tag
+        try:
+            addr = struct.unpack('!I', socket.inet_aton(host))[0]
+            return socket.inet_ntoa(struct.pack('!I', addr & self.mask))
+        except socket.error:
+            return host.partition('.')[2]
+
+    def has_token(self, now):
+        if not self.rate:
+            return True
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.refill_time) * self.rate)
+        self.refill_time = now
+        return self.tokens >= 1
+
+    def is_full(self, zone):
+        return self.cap and self.n_conns[zone] >= self.cap
+
+    def acquire(self, zone):
+        # called only if it has token and zone is not full
+        if self.rate:
+            self.tokens -= 1
+        self.n_conns[zone] += 1
+
+    def release(self, zone):
+        self.n_conns[zone] -= 1
+        if not self.n_conns[zone]:
+            del self.n_conns[zone]
+
+
+class guest_source(object):
+    '''
+    queue of guests read lazily from <guests>, which is any iterable, e.g.
+    list, file or generator, so that guests are dispatched before all of
+    them are read. guests put back by <append> are dequeued first. only
+    guests looked ahead or put back are held in memory
+    '''
+    def __init__(self, guests=()):
+        self.buf = collections.deque()
+        self.guests = iter(guests)
+
+    def _fill(self, n):
+        # read guests into buf until it holds <n> of them
+        while len(self.buf) < n:
+            try:
+                self.buf.append(next(self.guests))
+            except StopIteration:
+                return False
+        return True
+
+    def __nonzero__(self):
+        return self._fill(1)
+
+    def __iter__(self):
+        # consume the rest of guests
+        while self:
+            yield self.pop()
+
+    def pop(self):
+        if not self._fill(1):
+            raise IndexError('pop from empty guest source')
+        return self.buf.popleft()
+
+    def append(self, guest):
+        self.buf.appendleft(guest)
+
+    def peek(self, n):
+        # the next <n> guests to be dequeued at most
+        self._fill(n)
+        return list(itertools.islice(self.buf, n))
+
+
 class publisher(object):
     '''
           inqueue--->+------------------------------+
@@ -80,17 +280,40 @@ class publisher(object):
                      | +--+  +--+  +--+  +--+  +--+ |
                      +------------------------------+
                      ||  every process exec cmd in cmd_lst in order, and
-                     ||  modify map by response of executing cmd, every
-                     ||  process has four status:
-                     ||     @wait:  2#11
-                     ||     @hding: 2#10
-                     ||     @fail:  2#01
-                     ||     @okay:  2#00
+                     ||  modify its own row of status_tbl by response of
+                     ||  executing cmd, every cmd has four status:
+                     ||     @wait:  0x03
+                     ||     @hding: 0x02
+                     ||     @fail:  0x01
+                     ||     @okay:  0x00
                      ||      +-------------------------------+
-                     ||      | +------+----+   +------+----+ |
-        cmd_lst:     |+----->| |0xffff|cmd1|   |0xffff|cmdn| |
-                     +------>| +------+----+   +------+----+ |
+                     ||      |  cmd1    cmd2    ..    cmdn   |
+        status_tbl:  |+----->| +----+  +----+  +--+  +----+  | p1
+                     +------>| +----+  +----+  +--+  +----+  | p2
+                             |  ...                          | ..
                              +-------------------------------+
+        cursor:      index of the first cmd in status <wait> or <hding> of
+                     every process, so the next cmd is found in O(1)
+
+        guests are ordered by <sched> when they are queued. with <speculate>
+        set, a process asking for guest when the queue is empty serves a copy
+        of a straggler, whose rest cmds are all read-only(prefixed by
+        READ_ONLY_PREFIX), as its twin. the result of every cmd is recorded
+        by the copy finishing it first, and the copy finishing all cmds ends
+        the other one. msgs of copies are told apart by link, not by host.
+
+        with <limiter> set, guests are dequeued only when a new connection is
+        allowed by it. guests of full zones are deferred, and queued again
+        once a guest of their zone is released. at most MAX_DEFERRED guests
+        are deferred. subscribers parked meanwhile are woken up by
+        <fin_func>.
+
+        with <group> set, every group of guests is confirmed by
+        <confirm_group>, which is called by the reader of terminal or
+        control socket in the main loop, so msgs are still handled while the
+        prompt is waitting for answer. guests of the group are received and
+        connected meanwhile, but cmds are held until it is confirmed, and
+        the group after it is not received.
     '''
     STATUS_WAIT  = 0x03
     STATUS_HDING = 0x02
@@ -98,14 +321,27 @@ class publisher(object):
     STATUS_OKAY  = 0x00
 
     PUB_FLG_IGNORE_FAIL = 0x01
+    ## keep serving jobs loaded by <load_job> instead of finishing when all
+    #  guests are served, idle subscribers are parked until the next job
+    PUB_FLG_DAEMON      = 0x02
 
     MAX_RETRIES = 1
 
+    ## cmds prefixed by it do not modify the host, and may be executed again
+    READ_ONLY_PREFIX = '[ro] '
+
+    ## max number of guests deferred by <limiter>, guests are not read any
+    #  more when it is reached, so the inventory is never loaded into memory
+    #  even if it is mostly in full zones
+    MAX_DEFERRED = 4096
+
     def __init__(self, guest_queue, cmd_lst, concurrency, group=None,
-                 mode=0x00):
-        # Note that: for simplicity, I use 'list' to format 'guest_queue', the
-        #       'dequeue' operator would be replaced by 'list.pop'. So the
-        #       first entry to be handled need to be placed at tail.
+                 mode=0x00, window=None, host_timeout=None, sched=None,
+                 speculate=None, parallel=None, limiter=None):
+        # Note that: 'guest_queue' is any iterable of guests, e.g. a file or
+        #       a generator. it is read lazily by <guest_source>, so the
+        #       first guest is dispatched before the rest are read, and
+        #       guests are registered in database once they are dequeued.
         #
         #       @concurrency    the number of processes processed in parallel,
         #                       note that it is less or equal than the number
@@ -114,26 +350,108 @@ class publisher(object):
         #
         #       @group          the number of guests received per group. it is
         #                       greater or equal than the concurrency
-        self.guest_queue = guest_queue
-        self.guest_queue.reverse()
+        #
+        #       @window         the number of cmds sent to subscriber at once,
+        #                       results of them are streamed back without
+        #                       waitting for reply of okay
+        #
+        #       @host_timeout   seconds to serve one guest at most, the
+        #                       guest is failed by <hd_timeout> after it
+        #
+        #       @sched          scheduling policy, default is <fifo_sched>
+        #
+        #       @speculate      a guest served over <speculate> times of its
+        #                       expected seconds is a straggler
+        #
+        #       @parallel       the number of read-only cmds in a row which
+        #                       are executed in parallel on one guest at most
+        #
+        #       @limiter        <conn_limiter> of new connections
+        self.sched = sched or fifo_sched()
+        self.speculate = speculate
+        self.guest_queue = guest_source(self.sched.order(guest_queue))
         self.group = group
         if self.group:
             if concurrency > self.group:
                 raise Exception('the number of concurrency:%d > group:%d' %
                                 (concurrency, self.group))
-            self.n_received_guests = 0
-
-        # initialize cmd_lst
+        # used for group:
+        #       @n_received_guests  guests received in the latest group, the
+        #                           next guest starts a new group if it is
+        #                           not less than <group>
+        #       @group_seq          sequence of the latest group
+        #       @n_confirmed_groups groups before it(included) are confirmed
+        #       @refused_seq        sequence of the group refused
+        #       @p_groups           p_id --> sequence of group of its guest
+        #       @held_links         <link, send, host> waitting for cmd of
+        #                           guest of the group not confirmed
+        self.n_received_guests = self.group
+        self.group_seq = 0
+        self.n_confirmed_groups = 0
+        self.refused_seq = None
+        self.is_confirm_all = False
+        self.is_confirm_closed = False
+        self.p_groups = [0] * concurrency
+        self.held_links = collections.deque()
+
+        # zone --> queue of guests deferred by <limiter>
+        self.limiter = limiter
+        self.deferred = {}
+        self.n_deferred = 0
+
+        # initialize cmd_lst and status of cmds for every process
         self.concurrency = concurrency
-        p_map = 2 ** (2 * self.concurrency) - 1
-        self.cmd_lst = [[p_map, cmd] for cmd in cmd_lst]
-
-        # initialize recept_pool
+        self._parse_cmds(cmd_lst)
+        self.status_tbl = [array.array('B') for id in xrange(self.concurrency)]
+        self.cursor = [len(self.cmd_lst)] * self.concurrency
+
+        # initialize recept_pool, and indexes of it for O(1) lookup:
+        #       @host_pool      host --> p_id serving it
+        #       @fd_pool        link of subscriber(fdr of pipe) --> p_id
+        #       @p_fds          p_id --> link, the reverse of fd_pool
+        #       @free_pool      queue of p_id serving nothing
         self.recept_pool = [[id, None] for id in xrange(self.concurrency)]
+        self.host_pool = {}
+        self.fd_pool = {}
+        self.p_fds = [None] * self.concurrency
+        self.free_pool = collections.deque(xrange(self.concurrency))
 
-        # use to handle issue when remote exec cmd failed
+        # use to handle issue when remote exec cmd failed, retries are
+        # counted for every process
         self.mode = mode
-        self.n_retries = 0
+        self.n_retries = [0] * self.concurrency
+        self.window = window
+        self.parallel = parallel
+        # p_id --> index after the latest cmd sent in window or in parallel,
+        # okay of cmds before it is not replied
+        self.batch_ends = [0] * self.concurrency
+
+        # p_id --> deadline of serving guest, checked by <expired_links>
+        self.host_timeout = host_timeout
+        self.deadlines = {}
+
+        # host --> index of cmd to start from, set by <resume> and
+        # <_requeue_guest>
+        self.resume_cursors = {}
+
+        # used for speculation:
+        #       @start_times    p_id --> time of serving guest
+        #       @twins          p_id --> p_id serving the same guest
+        #       @lost_links     link --> n okays of cmds in batch not
+        #                       replied, of copies ended by their twins, they
+        #                       are replied <end> by the next msg
+        self.start_times = [None] * self.concurrency
+        self.twins = {}
+        self.lost_links = {}
+
+        # used for daemon:
+        #       @jobs           queue of <hosts, cmds> loaded by <load_job>
+        #       @idle_links     queue of <link, send> of subscribers asking
+        #                       for guest when there is no guest
+        self.jobs = collections.deque()
+        self.idle_links = collections.deque()
+        self.n_jobs = 0
+        self.is_job_running = bool(self.guest_queue)
 
         # database
         self.db_handler = None
@@ -149,18 +467,135 @@ class publisher(object):
 
     def set_db_handler(self, db_handler):
         self.db_handler = db_handler
+        self._register_job()
+
+        # guests are ordered again by durations of previous runs, it is
+        # skipped by <fifo_sched> so that guests are still read lazily
+        self.sched.load(self.db_handler.get_host_durations())
+        guests = self.sched.order(self.guest_queue)
+        if guests is not self.guest_queue:
+            self.guest_queue = guest_source(guests)
+
+    def resume(self):
+        '''
+        continue the run recorded in database: cmds which have results are
+        not executed again, every host starts from the first cmd without
+        result. in mode without PUB_FLG_IGNORE_FAIL, the host ended by a
+        failed cmd is not served again.
+        '''
+        self.db_handler.drop_unfinished_results()
+
+        # @counts       host --> cmd --> the number of results
+        # @statuses     host --> cmd --> status of the latest result
+        counts = {}
+        statuses = {}
+        for host, cmd, status in self.db_handler.iter_statuses():
+            host_counts = counts.setdefault(host, {})
+            host_counts[cmd] = host_counts.get(cmd, 0) + 1
+            statuses.setdefault(host, {})[cmd] = status
+
+        Log.info('(^_^)> resume with results of %d hosts' % len(counts))
+        self.guest_queue = guest_source(
+                self._iter_unserved(self.guest_queue, counts, statuses))
+
+    def _iter_unserved(self, guests, counts, statuses):
+        # filter guests lazily, and set the cursor of those partly served
+        n_cmds = len(self.cmd_lst)
+        for host in guests:
+            host_counts = counts.get(host)
+            if not host_counts:
+                yield host
+                continue
 
-        # init table <tb_hosts> and <tb_commands>
-        # note that <guest_queue> is reversed
-        len_guest_queue = len(self.guest_queue)
-        for i in xrange(len_guest_queue):
-            self.db_handler.put_host(self.guest_queue[len_guest_queue-i-1], 0)
-
-        for p_map, cmd in self.cmd_lst:
-            self.db_handler.put_command(cmd)
+            index = 0
+            while index < n_cmds and \
+                  host_counts.get(self.cmd_lst[index], 0) > 0:
+                host_counts[self.cmd_lst[index]] -= 1
+                index += 1
+            if index == n_cmds:
+                continue
+            if index > 0 and not self.mode & publisher.PUB_FLG_IGNORE_FAIL \
+               and statuses[host][self.cmd_lst[index-1]] == self.STATUS_FAIL:
+                continue
+            if index > 0:
+                Log.info('(^_^)> resume <host:%s> from <cmd:%s>' %
+                         (host, self.cmd_lst[index]))
+                self.resume_cursors[host] = index
+            yield host
+
+    def _parse_cmds(self, cmds):
+        # @ro_tail      cmds from this index to the end are all read-only
+        # @ro_ends      index --> index after the read-only cmds in a row
+        #               starting from it, independent cmds are found in O(1)
+        self.cmd_lst = []
+        self.ro_tail = 0
+        for cmd in cmds:
+            if cmd.startswith(self.READ_ONLY_PREFIX):
+                cmd = cmd[len(self.READ_ONLY_PREFIX):]
+            else:
+                self.ro_tail = len(self.cmd_lst) + 1
+            self.cmd_lst.append(cmd)
+
+        self.ro_ends = [0] * len(self.cmd_lst)
+        ro_end = len(self.cmd_lst)
+        for index in xrange(len(self.cmd_lst) - 1, -1, -1):
+            if not cmds[index].startswith(self.READ_ONLY_PREFIX):
+                ro_end = index
+            self.ro_ends[index] = ro_end
+
+    def _register_job(self):
+        # init table <tb_commands>, cmds are shared by jobs of daemon, so
+        # they are registered only once. hosts are registered by
+        # <_register_host> when they are dequeued
+        for cmd in self.cmd_lst:
+            if not self.db_handler.has_command(cmd):
+                self.db_handler.put_command(cmd)
+
+    def _register_host(self, host):
+        if not self.db_handler.has_host(host):
+            self.db_handler.put_host(host, 0)
+
+    def load_job(self, hosts, cmds):
+        '''
+        queue a job of daemon, it is started once the running job finished
+        '''
+        self.jobs.append((list(hosts), list(cmds)))
+        self.n_jobs += 1
+        Log.info('(^_^)> load <job:%d> with %d hosts and %d cmds' %
+                 (self.n_jobs, len(hosts), len(cmds)))
+        return 'job %d accepted, %d jobs queued\n' % (self.n_jobs,
+                                                      len(self.jobs))
+
+    def _start_next_job(self):
+        hosts, cmds = self.jobs.popleft()
+        self.guest_queue = guest_source(self.sched.order(hosts))
+        self._parse_cmds(cmds)
+        # every job is confirmed from its first group
+        self.n_received_guests = self.group
+        self.is_confirm_all = False
+        if self.db_handler:
+            self._register_job()
+        self.is_job_running = True
+        self._wake_all_idle_links()
+
+    def _wake_all_idle_links(self):
+        # wake up subscribers parked by <hd_waitting>, those which get no
+        # guest are parked again
+        idle_links = self.idle_links
+        self.idle_links = collections.deque()
+        for link, send in idle_links:
+            self._wake_link(link, 'wait', send)
+
+    def _wake_link(self, link, req, send):
+        # a broken link does not stop waking the others, it is killed by
+        # engine once the EOF of its pipe is read
+        try:
+            self.dispatch(link, req, send)
+        except OSError as e:
+            Log.warning('(>_<)> wake <link:%s> failed due to %s' % (link, e))
 
-    def _get_status(self, p_map, p_id):
-        status = (p_map & (0x3 << (2 * p_id))) >> (2 * p_id)
+    def _get_status(self, index, p_id):
+        status = self.status_tbl[p_id][index]
         Log.debug('....> status is %d' % status)
         if status is self.STATUS_WAIT:
             return 'wait'
@@ -171,43 +606,149 @@ class publisher(object):
         elif status is self.STATUS_OKAY:
             return 'okay'
 
+    # note that: cmds are executed in order, so the cmd finished is always
+    #       the one under cursor
     def _set_status_okay(self, index, p_id):
-        self.cmd_lst[index][0] &= (~(0x3 << (2 * p_id)))
+        self.status_tbl[p_id][index] = self.STATUS_OKAY
+        self.cursor[p_id] = index + 1
 
     def _set_status_fail(self, index, p_id):
-        self.cmd_lst[index][0] &= (~(0x1 << (2 * p_id + 1)))
-        self.cmd_lst[index][0] |= (0x1 << (2 * p_id))
+        self.status_tbl[p_id][index] = self.STATUS_FAIL
+        self.cursor[p_id] = index + 1
 
     def _set_status_hding(self, index, p_id):
-        self.cmd_lst[index][0] &= (~(0x1 << (2 * p_id)))
-        self.cmd_lst[index][0] |= (0x1 << (2 * p_id + 1))
+        self.status_tbl[p_id][index] = self.STATUS_HDING
 
-    def _set_status_wait(self, index, p_id):
-        self.cmd_lst[index][0] |= (0x3 << (2 * p_id))
+    def _set_status_wait_all(self, p_id):
+        self.status_tbl[p_id] = array.array('B', [self.STATUS_WAIT]) * \
+                                len(self.cmd_lst)
+        self.cursor[p_id] = 0
 
     def _find_next_waitted_cmd(self, p_id):
-        Log.debug('..>p_id:%d & cmd_lst is <%s>' % (p_id, str(self.cmd_lst)))
-        for p_map, cmd in self.cmd_lst:
-            status = self._get_status(p_map, p_id)
-            Log.debug('...><p_map:%d> <status:%s> <cmd:%s>' % (p_map, status, cmd))
-            if status == 'wait':
-                return (False, cmd)
-            elif status == 'hding':
-                return (True, cmd)
-        return (False, None)
-
-    def _get_p_id_by_host(self, host):
-        for p_id, guest in self.recept_pool:
-            if guest == host:
-                return p_id
+        index = self.cursor[p_id]
+        if index >= len(self.cmd_lst):
+            return (False, None)
+
+        status = self._get_status(index, p_id)
+        Log.debug('...><p_id:%d> <status:%s> <cmd:%s>' %
+                  (p_id, status, self.cmd_lst[index]))
+        return (status == 'hding', self.cmd_lst[index])
+
+    def _get_p_id(self):
+        # copies of speculation serve the same host, so the process is found
+        # by link of msg
+        return self.fd_pool.get(self.fdr)
+
+    def _recept_guest(self, p_id, host):
+        self.recept_pool[p_id][1] = host
+        # host_pool keeps the first copy of guest
+        self.host_pool.setdefault(host, p_id)
+        self.fd_pool[self.fdr] = p_id
+        self.p_fds[p_id] = self.fdr
+        self.start_times[p_id] = time.time()
+
+    def _release_guest(self, p_id):
+        host = self.recept_pool[p_id][1]
+        self.recept_pool[p_id][1] = None
+        twin = self.twins.pop(p_id, None)
+        if self.host_pool.get(host) == p_id:
+            self.host_pool.pop(host)
+            if twin is not None:
+                self.host_pool[host] = twin
+        if twin is not None:
+            self.twins.pop(twin)
+        if self.limiter:
+            # the next deferred guest of zone takes the connection
+            zone = self.limiter.zone(host)
+            self.limiter.release(zone)
+            deferred = self.deferred.get(zone)
+            if deferred:
+                self.guest_queue.append(deferred.popleft())
+                self.n_deferred -= 1
+        self.fd_pool.pop(self.p_fds[p_id], None)
+        self.p_fds[p_id] = None
+        self.deadlines.pop(p_id, None)
+        self.free_pool.append(p_id)
+
+    def _requeue_guest(self, p_id, is_first_copy):
+        host = self.recept_pool[p_id][1]
+        cursor = self.cursor[p_id]
+        self._release_guest(p_id)
+        if not is_first_copy:
+            return
+        if cursor > 0:
+            self.resume_cursors[host] = cursor
+        if self.group:
+            self.n_received_guests -= 1
+        self.guest_queue.append(host)
+
+    def _end_guest(self, p_id):
+        # the guest is ended by this copy, the twin of it is ended too
+        twin = self.twins.get(p_id)
+        if twin is not None:
+            # okays of cmds left in the batch of twin are still on the way
+            self.lost_links[self.p_fds[twin]] = \
+                    max(self.batch_ends[twin] - self.cursor[twin], 0)
+            self._release_guest(twin)
+        self.send('end')
+        self._release_guest(p_id)
+
+    def _pop_guest(self):
+        if not self.limiter:
+            return self.guest_queue.pop()
+
+        if not self.limiter.has_token(time.time()):
+            return None
+        while self.guest_queue and self.n_deferred < self.MAX_DEFERRED:
+            host = self.guest_queue.pop()
+            zone = self.limiter.zone(host)
+            if self.limiter.is_full(zone):
+                self.deferred.setdefault(zone, collections.deque()).append(
+                        host)
+                self.n_deferred += 1
+                continue
+            self.limiter.acquire(zone)
+            return host
         return None
 
-    def _get_waitting_cmd_index(self, host):
-        p_id = self._get_p_id_by_host(host)
-        for i in xrange(len(self.cmd_lst)):
-            status = self._get_status(self.cmd_lst[i][0], p_id)
-            if status == 'wait'or status == 'hding':
-                return i
+    def _wake_idle_links(self):
+        # subscribers parked by <limiter> ask for guest again, until one of
+        # them is parked again
+        while self.idle_links and self.guest_queue:
+            n_idle_links = len(self.idle_links)
+            link, send = self.idle_links.popleft()
+            self._wake_link(link, 'wait', send)
+            if len(self.idle_links) >= n_idle_links:
+                break
+
+    def _is_recorded(self, p_id, index):
+        # the result is recorded by twin if it has finished the cmd
+        twin = self.twins.get(p_id)
+        return twin is not None and self.cursor[twin] > index
+
+    def _find_straggler(self):
+        if not self.speculate:
+            return None
+
+        now = time.time()
+        straggler = None
+        max_delay = 0
+        for host, p_id in self.host_pool.iteritems():
+            if p_id in self.twins or self.cursor[p_id] < self.ro_tail:
+                continue
+            expected = self.sched.expected(host)
+            if not expected:
+                continue
+            delay = now - self.start_times[p_id] - self.speculate * expected
+            if delay > max_delay:
+                straggler = p_id
+                max_delay = delay
+        return straggler
+
+    def _get_waitting_cmd_index(self, p_id):
+        index = self.cursor[p_id]
+        if index < len(self.cmd_lst):
+            return index
         return None
 
     ## add record to database if connected
@@ -221,16 +762,46 @@ class publisher(object):
                  (host, cmd, status, result))
         self.db_handler.put_result(host, cmd, status, result)
 
-    def _prompt_group(self):
-        lst_host_group = []
-        for i in xrange(1, self.group+1):
-            try:
-                lst_host_group.append(self.guest_queue[-i])
-            except IndexError:
-                break
+    # append chunk to the result which is being streamed by subscriber
+    def _record_part(self, host, cmd, part):
+        if not self.db_handler:
+            Log.debug('--<host:%s> <part:%s>' % (host, part))
+            return
+        self.db_handler.put_result_part(host, cmd, part)
+
+    def _drop_part(self, host, cmd):
+        if self.db_handler:
+            self.db_handler.drop_result_part(host, cmd)
+
+    # result of failed cmd is its stderr only as that without stream, so
+    # chunks of stdout streamed before it are dropped
+    def _record_fail(self, host, cmd, result):
+        self._drop_part(host, cmd)
+        self._record_result(host, cmd, self.STATUS_FAIL, result)
+
+    def _start_group(self, first_guest):
+        self.group_seq += 1
+        self.n_received_guests = 0
+        if self.is_confirm_all:
+            self.n_confirmed_groups = self.group_seq
+            return
+        if self.is_confirm_closed:
+            # no answer would arrive, <first_guest> is ended once connected
+            self.confirm_group('')
+            return
+        self._prompt_group([first_guest] +
+                           self.guest_queue.peek(self.group - 1))
+
+    def _is_held(self, p_id):
+        return self.group and self.p_groups[p_id] > self.n_confirmed_groups
+
+    def _prompt_group(self, lst_host_group):
+        # the answer is passed to <confirm_group> without blocking main loop
+        Log.info('(^_^)> <group:%d> is waitting for confirmation' %
+                 self.group_seq)
         str_host_group = ', '.join(lst_host_group)
 
-        lst_cmds = [cmd for p_map, cmd in self.cmd_lst]
+        lst_cmds = self.cmd_lst
         str_cmds = ', '.join(lst_cmds)
 
         print(\
@@ -243,158 +814,497 @@ class publisher(object):
             ''' %
             (64*'*', str_host_group, 64*'-', str_cmds, 64*'*')
             )
-        confirm = raw_input('do you confirm to execute those cmds on the '
-                            'hosts?(y/Y/all):')
-        if confirm in ['y', 'Y']:
-            print('...okay, execute now')
-            return
-        else:
-            raise Exception('pub:exit')
+        sys.stdout.write('do you confirm to execute those cmds on the '
+                         'hosts?(y/Y/all):')
+        sys.stdout.flush()
+
+    def confirm_group(self, answer):
+        '''
+        answer the confirmation of the latest group, return the reply:
+            @y/Y    the group is confirmed, held cmds are sent at once
+            @all    the group and all groups after it are confirmed
+            others  the group is refused, its guests and the rest of guests
+                    are dropped, guests being served are still finished
+        '''
+        answer = answer.strip()
+        if not self.group or self.group_seq <= self.n_confirmed_groups:
+            return 'no group is waitting for confirmation\n'
+
+        seq = self.group_seq
+        self.n_confirmed_groups = seq
+        if answer not in ('y', 'Y', 'all'):
+            self._refuse_group()
+            return 'group %d is refused, the rest hosts are dropped\n' % seq
+        if answer == 'all':
+            self.is_confirm_all = True
+        Log.info('(^_^)> <group:%d> is confirmed, execute now' % seq)
+
+        # guests are served from now on
+        now = time.time()
+        for p_id in xrange(self.concurrency):
+            if self.recept_pool[p_id][1] is not None and \
+               self.p_groups[p_id] == seq:
+                self.start_times[p_id] = now
+                if self.host_timeout:
+                    self.deadlines[p_id] = now + self.host_timeout
+
+        held_links = self.held_links
+        self.held_links = collections.deque()
+        for link, send, host in held_links:
+            self._wake_link(link, 'wait\r%s' % host, send)
+        self._wake_all_idle_links()
+        return 'group %d is confirmed\n' % seq
+
+    def close_confirmation(self):
+        '''
+        no more answer arrives(e.g. stdin is closed), the group waitting for
+        confirmation and groups after it are refused
+        '''
+        Log.warning('(>_<)> confirmation is closed, groups are refused')
+        self.is_confirm_closed = True
+        if self.group and self.group_seq > self.n_confirmed_groups:
+            self.confirm_group('')
+
+    def _refuse_group(self):
+        Log.info('(>_<)> <group:%d> is refused, drop the rest guests' %
+                 self.group_seq)
+        self.refused_seq = self.group_seq
+        self.guest_queue = guest_source()
+        self.deferred = {}
+        self.n_deferred = 0
+
+        # guests still connecting are ended once they ask for cmd
+        held_links = self.held_links
+        self.held_links = collections.deque()
+        for link, send, host in held_links:
+            self.fdr = link
+            self.send = send
+            p_id = self._get_p_id()
+            try:
+                self._end_guest(p_id)
+            except OSError as e:
+                Log.warning('(>_<)> end <link:%s> failed due to %s' %
+                            (link, e))
+                self._release_guest(p_id)
 
     def handler(self, fdr, fdw):
-        self.fdr = fdr
-        self.fdw = fdw
-
         req = mtp.read(fdr)
+        if req is None:
+            # the rest of msg has not arrived yet
+            return
+        # send is kept with the link if it is parked, so fdw is bound to it
+        self.dispatch(fdr, req, functools.partial(mtp.write, fdw))
+
+    def dispatch(self, link, req, send):
+        '''
+        handle one msg of subscriber, independent of how msgs are carried
+            @link       identity of subscriber, e.g. fdr of pipe
+            @req        msg from subscriber
+            @send       function used to reply msg to this subscriber
+        '''
+        self.fdr = link
+        self.send = send
+
         if req == 'wait':
             # allocate host to this process
             self.hd_waitting()
             return
 
-        head = req.split('\r')[0]
-        host = req.split('\r')[1]
+        # note that: the result may contain '\r' and be very large, so split
+        #       the msg only once
+        fields = req.split('\r', 2)
+        head = fields[0]
+        host = fields[1]
+
+        if link in self.lost_links:
+            # the twin of this copy has served the guest, only msgs waitting
+            # for reply are replied, okay of cmd in batch is not
+            if head == 'okay' and self.lost_links[link] > 0:
+                self.lost_links[link] -= 1
+            elif head in ('wait', 'okay', 'fail', 'down'):
+                self.lost_links.pop(link)
+                self.send('end')
+            return
 
         if head == 'wait':
             self.hd_connected_wait(host)
         elif head == 'okay':
-            result = req.split('\r')[2]
-            self.hd_connected_okay(host, result)
+            self.hd_connected_okay(host, fields[2])
         elif head == 'fail':
-            result = req.split('\r')[2]
-            self.hd_connected_fail(host, result)
+            self.hd_connected_fail(host, fields[2])
+        elif head == 'part':
+            self.hd_connected_part(host, fields[2])
+        elif head == 'down':
+            self.hd_connected_down(host, fields[2])
 
     # check if main loop need to be break
     def fin_func(self):
-        if len(self.guest_queue) > 0:
+        # it is called on every loop, so results written behind are flushed
+        # in time even if no more result arrives
+        if self.db_handler:
+            self.db_handler.flush_if_due()
+
+        if self.guest_queue or self.n_deferred > 0:
+            if self.limiter:
+                self._wake_idle_links()
             return False
 
-        for p_id, guest in self.recept_pool:
-            if guest:
-                return False
+        if len(self.host_pool) > 0:
+            return False
+
+        if self.is_job_running:
+            Log.info('(^_^)> all guests are served')
+            self.is_job_running = False
+            if self.db_handler:
+                self.db_handler.flush()
 
+        if self.mode & publisher.PUB_FLG_DAEMON:
+            if len(self.jobs) > 0:
+                self._start_next_job()
+            return False
         return True
 
     def hd_waitting(self):
         if len(self.cmd_lst) == 0:
+            self.idle_links.append((self.fdr, self.send))
             return
 
         # find free process in recept_pool
-        for p_id, host in self.recept_pool:
-            if not host:
-                break
+        if len(self.free_pool) == 0:
+            Log.warning('(>_<)> No free process in recept_pool')
+            return
+
+        # used for group. the next group is not received until the latest
+        # one is confirmed
+        if self.group and self.n_received_guests >= self.group and \
+           self.group_seq > self.n_confirmed_groups and self.guest_queue:
+            self.idle_links.append((self.fdr, self.send))
+            return
 
-        # used for group.
-        if self.group and self.n_received_guests >= self.group:
-            self.n_received_guests = 0
-        if self.group and self.n_received_guests is 0:
-            self._prompt_group()
+        twin = None
+        new_guest = None
+        if self.guest_queue:
+            new_guest = self._pop_guest()
 
-        if len(self.guest_queue) > 0:
-            new_guest = self.guest_queue.pop()
+        if new_guest is not None:
+            if self.group and self.n_received_guests >= self.group:
+                self._start_group(new_guest)
             if self.group:
                 self.n_received_guests += 1
-        else:
-            Log.info('(^_^)> No guest need to be servered')
+        elif self.guest_queue or self.n_deferred > 0:
+            Log.debug('(^_^)> new connection is limited, waitting')
+            self.idle_links.append((self.fdr, self.send))
             return
+        else:
+            twin = self._find_straggler()
+            if twin is not None and self.limiter:
+                zone = self.limiter.zone(self.recept_pool[twin][1])
+                if self.limiter.is_full(zone) or \
+                   not self.limiter.has_token(time.time()):
+                    twin = None
+                else:
+                    self.limiter.acquire(zone)
+            if twin is None:
+                Log.info('(^_^)> No guest need to be servered')
+                self.idle_links.append((self.fdr, self.send))
+                return
+            new_guest = self.recept_pool[twin][1]
+            Log.info('(^_^)> speculate straggler <host:%s>' % new_guest)
+
+        if twin is None and self.db_handler:
+            self._register_host(new_guest)
+
+        p_id = self.free_pool.popleft()
+        self._recept_guest(p_id, new_guest)
+        self._set_status_wait_all(p_id)
+        if self.resume_cursors:
+            self.cursor[p_id] = self.resume_cursors.pop(new_guest, 0)
+        self.p_groups[p_id] = self.group_seq
+        if twin is not None:
+            # the copy starts from the cmd being executed by straggler
+            self.cursor[p_id] = self.cursor[twin]
+            self.twins[p_id] = twin
+            self.twins[twin] = p_id
+            self.p_groups[p_id] = self.p_groups[twin]
 
-        self.recept_pool[p_id][1] = new_guest
-        for i in xrange(len(self.cmd_lst)):
-            self._set_status_wait(i, p_id)
-
-        mtp.write(self.fdw, 'ack\r%s' % new_guest)
-        self.n_retries = 0
+        try:
+            self.send('ack\r%s' % new_guest)
+        except OSError:
+            # the guest is never attempted, so it is queued again instead of
+            # being failed with the subscriber
+            self._requeue_guest(p_id, twin is None)
+            raise
+        self.n_retries[p_id] = 0
+        self.batch_ends[p_id] = 0
+        # guest of group not confirmed is timed from the confirmation
+        if self.host_timeout and not self._is_held(p_id):
+            self.deadlines[p_id] = time.time() + self.host_timeout
 
     def hd_connected_wait(self, host):
         # find which process recept this guest
-        p_id = self._get_p_id_by_host(host)
+        p_id = self._get_p_id()
+
+        if self.group and self.p_groups[p_id] == self.refused_seq:
+            self._end_guest(p_id)
+            return
+        if self._is_held(p_id):
+            # cmds are sent once the group is confirmed by <confirm_group>
+            self.held_links.append((self.fdr, self.send, host))
+            return
 
         is_hding, next_waitted_cmd = self._find_next_waitted_cmd(p_id)
         if is_hding:
             return
 
-        if next_waitted_cmd:
-            mtp.write(self.fdw, 'cmd')
-            mtp.write(self.fdw, next_waitted_cmd)
-            index = self._get_waitting_cmd_index(host)
+        index = self._get_waitting_cmd_index(p_id)
+        if next_waitted_cmd and self.parallel and \
+           self.ro_ends[index] - index > 1:
+            n_cmds = min(self.ro_ends[index] - index, self.parallel)
+            self._send_batch('pcmds', index, n_cmds, p_id)
+        elif next_waitted_cmd and self.window:
+            self._send_batch('cmds', index, self.window, p_id)
+        elif next_waitted_cmd:
+            self.send('cmd')
+            self.send(next_waitted_cmd)
             self._set_status_hding(index, p_id)
         else:
             Log.info('  ..(^_^)<host:%s> exec all cmds completely!' % host)
-            mtp.write(self.fdw, 'end')
-            self.recept_pool[p_id][1] = None
+            duration = self.sched.finish(host,
+                                         time.time() - self.start_times[p_id])
+            if self.db_handler:
+                self.db_handler.put_host_duration(host, duration)
+            self._end_guest(p_id)
+
+    def _send_batch(self, head, index, n_cmds, p_id):
+        cmds = self.cmd_lst[index:index + n_cmds]
+        self.send('%s\r%d' % (head, len(cmds)))
+        for cmd in cmds:
+            self.send(cmd)
+            self._set_status_hding(index, p_id)
+            index += 1
+        self.batch_ends[p_id] = index
 
     def hd_connected_okay(self, host, result):
-        p_id = self._get_p_id_by_host(host)
-        index = self._get_waitting_cmd_index(host)
+        p_id = self._get_p_id()
+        index = self._get_waitting_cmd_index(p_id)
+        if not self._is_recorded(p_id, index):
+            self._record_result(host, self.cmd_lst[index], self.STATUS_OKAY,
+                                result)
         self._set_status_okay(index, p_id)
 
-        self._record_result(host, self.cmd_lst[index][1], self.STATUS_OKAY,
-                            result)
-
-        mtp.write(self.fdw, 'okay')
+        # subscriber goes on with the next cmd of window without reply
+        if index >= self.batch_ends[p_id]:
+            self.send('okay')
         return
 
     def hd_connected_fail(self, host, result):
-        p_id = self._get_p_id_by_host(host)
+        p_id = self._get_p_id()
+        index = self._get_waitting_cmd_index(p_id)
         if self.mode & publisher.PUB_FLG_IGNORE_FAIL:
-            mtp.write(self.fdw, 'ignore')
-            index = self._get_waitting_cmd_index(host)
+            self.send('ignore')
+            if not self._is_recorded(p_id, index):
+                self._record_fail(host, self.cmd_lst[index], result)
             self._set_status_fail(index, p_id)
-            self._record_result(host, self.cmd_lst[index][1], self.STATUS_FAIL,
-                                result)
             return
 
-        if self.n_retries < self.MAX_RETRIES:
-            mtp.write(self.fdw, 'retry')
-            self.n_retries += 1
+        if self.n_retries[p_id] < self.MAX_RETRIES:
+            # chunks streamed by the failed attempt are useless
+            self._drop_part(host, self.cmd_lst[index])
+            self.send('retry')
+            self.n_retries[p_id] += 1
             return
         else:
-            index = self._get_waitting_cmd_index(host)
-            self._record_result(host, self.cmd_lst[index][1], self.STATUS_FAIL,
-                                result)
-            mtp.write(self.fdw, 'end')
-            self.recept_pool[p_id][1] = None
+            if not self._is_recorded(p_id, index):
+                self._record_fail(host, self.cmd_lst[index], result)
+            self._end_guest(p_id)
+
+
+    def hd_connected_part(self, host, part):
+        # output of copies is not streamed into the same result
+        p_id = self._get_p_id()
+        if self.host_pool.get(host) != p_id:
+            return
+        index = self._get_waitting_cmd_index(p_id)
+        self._record_part(host, self.cmd_lst[index], part)
+
+    def hd_connected_down(self, host, reason):
+        # subscriber can not connect to guest, the cmd waitting is failed,
+        # unless its twin is still serving the guest
+        p_id = self._get_p_id()
+        if p_id is None:
+            # subscriber is down without guest, e.g. its thread exits
+            self.idle_links = collections.deque(
+                    (link, send) for link, send in self.idle_links
+                    if link != self.fdr)
+            self.send('end')
+            return
+        # host is not carried by subscriber whose thread exits
+        host = self.recept_pool[p_id][1]
+        index = self._get_waitting_cmd_index(p_id)
+        if index is not None and p_id not in self.twins:
+            self._record_fail(host, self.cmd_lst[index], reason)
+        self.send('end')
+        self._release_guest(p_id)
+
+    def expired_links(self, now):
+        '''
+        links of subscribers serving guest over <host_timeout>, they are
+        killed by watchdog of engine, and reported by <hd_timeout>. the
+        other links killed with them are reported by <hd_requeue>
+        '''
+        return [self.p_fds[p_id] for p_id, deadline in self.deadlines.items()
+                if deadline <= now]
+
+    def hd_timeout(self, link, reason=None):
+        # the subscriber of link is killed, the cmd waitting is failed and
+        # the rest of cmds are not executed, the same as <end>
+        if reason is None:
+            reason = 'timeout: guest is not served in %ss' % self.host_timeout
+        self.idle_links = collections.deque((l, send) for l, send in
+                                            self.idle_links if l != link)
+        self.lost_links.pop(link, None)
+        p_id = self.fd_pool.get(link)
+        if p_id is None:
+            return
+        host = self.recept_pool[p_id][1]
+        Log.warning('  ..(>_<)<host:%s> %s' % (host, reason))
+        index = self._get_waitting_cmd_index(p_id)
+        if index is not None and p_id not in self.twins:
+            self._record_fail(host, self.cmd_lst[index], reason)
+        self._release_guest(p_id)
+
+    def hd_requeue(self, link, reason):
+        # the subscriber of link is killed with another one, the guest is
+        # served again from the cmd waitting, chunks of it are dropped
+        self.idle_links = collections.deque((l, send) for l, send in
+                                            self.idle_links if l != link)
+        self.lost_links.pop(link, None)
+        p_id = self.fd_pool.get(link)
+        if p_id is None:
+            return
+        host = self.recept_pool[p_id][1]
+        Log.warning('  ..(>_<)<host:%s> %s, serve it again' % (host, reason))
+        index = self._get_waitting_cmd_index(p_id)
+        if index is not None and p_id not in self.twins:
+            self._drop_part(host, self.cmd_lst[index])
+        self._requeue_guest(p_id, p_id not in self.twins)
 
 
 class subscriber(object):
-    def __init__(self):
+    def __init__(self, chunk_size=None, pool=None, timeout=None,
+                 connect_timeout=None):
         # used for ssh loading
         self.host = None
         self.port = None
         self.user = None
         self.key_file = None
         self.password = None
-        self.ssh_handler = ssh_handler()
+        # transports released to <ssh_pool> are reused by the next guest on
+        # the same host, instead of handshaking again
+        self.pool = pool
+        self.ssh_handler = ssh_handler(pool)
 
         self.fdr = None
         self.fdw = None
         self.latest_cmd = None
 
+        # stream output in chunks of <chunk_size> bytes if it is set, so
+        # that the output of cmd is never held entirely by sub process
+        self.chunk_size = chunk_size
+
+        # seconds to wait for connecting and for every cmd, a cmd timed out
+        # is replied as fail, so it is retried or ignored as others
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+
+    def _send(self, msg):
+        mtp.write(self.fdw, msg)
+
+    def _recv(self):
+        return mtp.read(self.fdr, timeout=-1)
+
+    def _connect(self, **kwargs):
+        # if connecting failed, exiting this sub process
+        self.ssh_handler.create_ssh_channel(**kwargs)
+        return True
+
     def _rmt_exec_cmd(self):
         Log.info('    @<pid:%d><host:%s> exec <%s>' %
                   (os.getpid(), self.host, self.latest_cmd))
-        stdout, stderr = self.ssh_handler.exec_cmd(self.latest_cmd)
-
-        str_buf = stderr.read()
-        if len(str_buf):
+        # timeout of channel only limits seconds of waitting for every read,
+        # so the whole cmd is waited until a deadline instead
+        output = self.ssh_handler.exec_cmd_output(self.latest_cmd,
+                                                  self.timeout)
+        if output is None:
+            return False, self._timeout_result()
+
+        stdout, stderr = output
+        if len(stderr):
             Log.warning('  ..@_@.<host:%s> exec <%s> return fail' %
                         (self.host, self.latest_cmd))
-            Log.warning('  --> stderr:%s' % str_buf)
-            return False, str_buf
+            Log.warning('  --> stderr:%s' % stderr)
+            return False, stderr
+        Log.info('  --> stdout:%s' % stdout)
+        return True, stdout
 
-        str_buf = stdout.read()
-        Log.info('  --> stdout:%s' % str_buf)
-        return True, str_buf
+    def _rmt_exec_cmd_stream(self):
+        Log.info('    @<pid:%d><host:%s> exec <%s> in stream' %
+                  (os.getpid(), self.host, self.latest_cmd))
+        stream = self.ssh_handler.exec_cmd_stream(self.latest_cmd,
+                                                  self.chunk_size,
+                                                  self.timeout)
+
+        # only the latest chunk of stdout is kept, the previous one is sent
+        # once a new chunk arrives, and stderr is truncated by chunk_size
+        chunk = ''
+        err_buf = ''
+        try:
+            for fd_name, data in stream:
+                if fd_name == 'stderr':
+                    err_buf = (err_buf + data)[:self.chunk_size]
+                    continue
+                if chunk:
+                    self._send('part\r%s\r%s' % (self.host, chunk))
+                chunk = data
+        except socket.timeout:
+            # chunks sent already are dropped by publisher if it retries
+            return False, self._timeout_result()
+
+        if len(err_buf):
+            Log.warning('  ..@_@.<host:%s> exec <%s> return fail' %
+                        (self.host, self.latest_cmd))
+            Log.warning('  --> stderr:%s' % err_buf)
+            return False, err_buf
+        return True, chunk
+
+    def _timeout_result(self):
+        Log.warning('  ..@_@.<host:%s> exec <%s> timed out in %ss' %
+                    (self.host, self.latest_cmd, self.timeout))
+        return 'timeout: cmd is not finished in %ss' % self.timeout
+
+    def _check_output(self, output):
+        # turn <(stdout, stderr)> of cmd executed in parallel into result,
+        # with chunk_size set, stdout is sent in chunks as it is streamed
+        if output is None:
+            return False, self._timeout_result()
+
+        stdout, stderr = output
+        chunks = [stdout]
+        if self.chunk_size:
+            stderr = stderr[:self.chunk_size]
+            chunks = [stdout[i:i + self.chunk_size]
+                      for i in xrange(0, len(stdout), self.chunk_size)] or ['']
+
+        if len(stderr):
+            Log.warning('  ..@_@.<host:%s> exec <%s> return fail' %
+                        (self.host, self.latest_cmd))
+            Log.warning('  --> stderr:%s' % stderr)
+            return False, stderr
 
+        for chunk in chunks[:-1]:
+            self._send('part\r%s\r%s' % (self.host, chunk))
+        Log.info('  --> stdout:%s' % stdout)
+        return True, chunks[-1]
 
     def handler(self, fdr, fdw, user, key_file, password, port=22):
         self.fdr = fdr
@@ -412,11 +1322,11 @@ class subscriber(object):
 
     def hd_waitting(self):
         Log.debug('sub process <pid:%d> waitting for task...' % os.getpid())
-        mtp.write(self.fdw, 'wait')
+        self._send('wait')
 
     def hd_connecting(self):
         while True:
-            rsp = mtp.read(self.fdr, timeout=-1)
+            rsp = self._recv()
             head = rsp.split('\r')[0]
             load = rsp.split('\r')[1]
 
@@ -435,31 +1345,397 @@ class subscriber(object):
                 'username':     self.user,
                 'key_filename': self.key_file,
                 'password':     self.password,
+                'timeout':      self.connect_timeout,
                 }
-        # if connecting failed, exiting this sub process
-        self.ssh_handler.create_ssh_channel(**kwargs)
+        if not self._connect(**kwargs):
+            return
         Log.info('<pid:%d> connected <host:%s> successfully!' %
                  (os.getpid(), self.host))
 
-        mtp.write(self.fdw, 'wait\r%s' % self.host)
+        self._send('wait\r%s' % self.host)
         while True:
-            reply = mtp.read(self.fdr, timeout=-1)
+            reply = self._recv()
             if reply == 'okay' or reply == 'ignore':
-                mtp.write(self.fdw, 'wait\r%s' % self.host)
+                self._send('wait\r%s' % self.host)
                 continue
             elif reply == 'end':
                 return
             elif reply == 'cmd':
-                self.latest_cmd = mtp.read(self.fdr, timeout=-1)
+                self.latest_cmd = self._recv()
                 Log.debug('  ..*_* subscriber exec <cmd:%s>' % self.latest_cmd)
+            elif reply.startswith('cmds\r'):
+                n_cmds = int(reply.split('\r')[1])
+                cmds = [self._recv() for i in xrange(n_cmds)]
+                if not self._exec_window(cmds):
+                    return
+                self._send('wait\r%s' % self.host)
+                continue
+            elif reply.startswith('pcmds\r'):
+                n_cmds = int(reply.split('\r')[1])
+                cmds = [self._recv() for i in xrange(n_cmds)]
+                if not self._exec_parallel(cmds):
+                    return
+                self._send('wait\r%s' % self.host)
+                continue
             elif reply == 'retry':
                 pass
 
+            self._exec_latest_cmd()
+
+    def _exec_latest_cmd(self):
+        if self.chunk_size:
+            status, str_buf = self._rmt_exec_cmd_stream()
+        else:
             status, str_buf = self._rmt_exec_cmd()
-            if status:
-                mtp.write(self.fdw, 'okay\r%s\r%s' % (self.host, str_buf))
-            else:
-                mtp.write(self.fdw, 'fail\r%s\r%s' % (self.host, str_buf))
+        return self._reply_result(status, str_buf)
+
+    def _reply_result(self, status, str_buf):
+        if status:
+            self._send('okay\r%s\r%s' % (self.host, str_buf))
+        else:
+            self._send('fail\r%s\r%s' % (self.host, str_buf))
+        return status
+
+    def _wait_retry(self, status):
+        # failed cmd of batch is executed again until it is ignored, False
+        # is returned if it is ended
+        while not status:
+            reply = self._recv()
+            if reply == 'ignore':
+                break
+            elif reply != 'retry':
+                return False
+            status = self._exec_latest_cmd()
+        return True
+
+    def _exec_window(self, cmds):
+        # results of okay are not replied, so cmds are executed one by one
+        # until a failed one is replied by end
+        for cmd in cmds:
+            self.latest_cmd = cmd
+            Log.debug('  ..*_* subscriber exec <cmd:%s>' % self.latest_cmd)
+            if not self._wait_retry(self._exec_latest_cmd()):
+                return False
+        return True
+
+    def _exec_parallel(self, cmds):
+        # cmds are executed by channels of one transport at once, and their
+        # results are replied in order as those of window
+        Log.info('    @<pid:%d><host:%s> exec %d cmds in parallel' %
+                 (os.getpid(), self.host, len(cmds)))
+        outputs = self.ssh_handler.exec_cmds(cmds, self.timeout)
+        for cmd, output in zip(cmds, outputs):
+            self.latest_cmd = cmd
+            status = self._reply_result(*self._check_output(output))
+            if not self._wait_retry(status):
+                return False
+        return True
 
     def hd_disconnecting(self):
         self.ssh_handler.disconnect_ssh_channel()
+
+
+class thread_subscriber(subscriber):
+    '''
+    subscriber running as a thread of <concur_handler.multi_thread>. it is
+    the same as <subscriber> except that msgs are passed by in-memory queues
+    of the engine instead of pipes, and failure of connecting is reported to
+    publisher as <down> since exiting would only end the thread.
+    '''
+    def __init__(self, chunk_size=None, pool=None, timeout=None,
+                 connect_timeout=None):
+        subscriber.__init__(self, chunk_size, pool, timeout, connect_timeout)
+        self.engine = None
+        self.link = None
+        self.inbox = None
+
+    def handler(self, link, engine, user, key_file, password, port=22):
+        # every thread serves guests with its own session and ssh handler
+        session = thread_subscriber(self.chunk_size, self.pool, self.timeout,
+                                    self.connect_timeout)
+        session.link = link
+        session.engine = engine
+        session.inbox = engine.get_inbox(link)
+        subscriber.handler(session, None, None, user, key_file, password,
+                           port)
+
+    def _send(self, msg):
+        self.engine.send_to_pub(self.link, msg)
+
+    def _recv(self):
+        return self.inbox.get()
+
+    def _connect(self, **kwargs):
+        try:
+            self.ssh_handler.connect(**kwargs)
+        except Exception as e:
+            Log.warning('  ..@_@.<link:%s> connect <host:%s> failed: %s' %
+                        (self.link, self.host, e))
+            self._send('down\r%s\r%s' % (self.host, e))
+            while self._recv() != 'end':
+                pass
+            return False
+        return True
+
+
+class async_subscriber(subscriber):
+    '''
+    subscriber driven by <concur_handler.event_loop>. one session serves one
+    guest at a time like the process of <subscriber>, and speaks the same
+    protocol, but it never blocks the loop:
+        @msgs           are passed by the loop, and handled by <on_msg>
+        @handshake      and opening channel are run by executor of the loop
+        @output         of cmd is read when fileno of channel is readable
+    '''
+    def __init__(self, chunk_size=None, pool=None, timeout=None,
+                 connect_timeout=None):
+        subscriber.__init__(self, chunk_size, pool, timeout, connect_timeout)
+        self.loop = None
+        self.link = None
+
+        # status of session:
+        #   waitting -> connecting -> connected <-> executing
+        #                          -> down
+        self.status = None
+        self.is_cmd_next = False
+        # cmds of window waitting to be executed, and the number of cmds of
+        # window which have not arrived yet
+        self.window = None
+        self.n_window_cmds = 0
+        # cmds of window are executed in parallel if it is set, and their
+        # <cmd, output> waitting to be replied
+        self.is_parallel = False
+        self.outputs = collections.deque()
+        self.chan = None
+        self.deadline = None
+        self.out_buf = []
+        self.err_buf = ''
+        self.chunk = ''
+
+    def handler(self, link, loop, user, key_file, password, port=22):
+        # start a new session serving guests through <loop>
+        session = async_subscriber(self.chunk_size, self.pool, self.timeout,
+                                   self.connect_timeout)
+        session.link = link
+        session.loop = loop
+        session.user = user
+        session.key_file = key_file
+        session.password = password
+        session.port = port
+
+        session.hd_waitting()
+        return session
+
+    def _send(self, msg):
+        self.loop.send_to_pub(self.link, msg)
+
+    def on_msg(self, msg):
+        if self.status == 'waitting':
+            self.hd_connecting(msg)
+        elif self.status == 'connected':
+            self.hd_connected(msg)
+        elif self.status == 'down' and msg == 'end':
+            self.hd_waitting()
+
+    def hd_waitting(self):
+        Log.debug('session <link:%s> waitting for task...' % self.link)
+        self.status = 'waitting'
+        self._send('wait')
+
+    def hd_connecting(self, rsp):
+        fields = rsp.split('\r')
+        if fields[0] != 'ack' or len(fields) < 2 or not fields[1]:
+            self.hd_waitting()
+            return
+
+        self.host = fields[1]
+        self.status = 'connecting'
+        Log.debug('session <link:%s> is connecting <host:%s>...' %
+                  (self.link, self.host))
+        kwargs = {
+                'addr':         self.host,
+                'port':         self.port,
+                'username':     self.user,
+                'key_filename': self.key_file,
+                'password':     self.password,
+                'timeout':      self.connect_timeout,
+                }
+        handler = ssh_handler(self.pool)
+        self.loop.run_in_executor(lambda: handler.connect(**kwargs),
+                                  lambda result, error:
+                                  self._on_connected(handler, error))
+
+    def _on_connected(self, handler, error):
+        if error:
+            Log.warning('  ..@_@.<link:%s> connect <host:%s> failed: %s' %
+                        (self.link, self.host, error))
+            self.status = 'down'
+            self._send('down\r%s\r%s' % (self.host, error))
+            return
+
+        Log.info('<link:%s> connected <host:%s> successfully!' %
+                 (self.link, self.host))
+        self.ssh_handler = handler
+        self.status = 'connected'
+        self._send('wait\r%s' % self.host)
+
+    def hd_connected(self, reply):
+        if self.n_window_cmds:
+            self.window.append(reply)
+            self.n_window_cmds -= 1
+            if not self.n_window_cmds and self.is_parallel:
+                self._exec_parallel()
+            elif not self.n_window_cmds:
+                self._exec_next_in_window()
+            return
+        elif self.is_cmd_next:
+            self.is_cmd_next = False
+            self.latest_cmd = reply
+            Log.debug('  ..*_* session exec <cmd:%s>' % self.latest_cmd)
+        elif reply == 'okay' or reply == 'ignore':
+            self._exec_next_in_window()
+            return
+        elif reply == 'end':
+            self.window = None
+            self.outputs.clear()
+            self.hd_disconnecting()
+            return
+        elif reply == 'cmd':
+            self.is_cmd_next = True
+            return
+        elif reply.startswith('cmds\r') or reply.startswith('pcmds\r'):
+            self.window = collections.deque()
+            self.n_window_cmds = int(reply.split('\r')[1])
+            self.is_parallel = reply.startswith('pcmds\r')
+            return
+        elif reply != 'retry':
+            return
+
+        self._rmt_exec_cmd()
+
+    def _exec_parallel(self):
+        Log.info('    @<link:%s><host:%s> exec %d cmds in parallel' %
+                 (self.link, self.host, len(self.window)))
+        self.status = 'executing'
+        self.is_parallel = False
+        handler = self.ssh_handler
+        cmds = list(self.window)
+        timeout = self.timeout
+        self.window.clear()
+        self.loop.run_in_executor(lambda: handler.exec_cmds(cmds, timeout),
+                                  lambda outputs, error:
+                                  self._on_parallel_done(cmds, outputs, error))
+
+    def _on_parallel_done(self, cmds, outputs, error):
+        self.status = 'connected'
+        if error:
+            outputs = [('', '%s' % error)] * len(cmds)
+        self.outputs.extend(zip(cmds, outputs))
+        self._exec_next_in_window()
+
+    def _exec_next_in_window(self):
+        # outputs of cmds executed in parallel are replied first, and a
+        # failed one waits for reply
+        while self.outputs:
+            self.latest_cmd, output = self.outputs.popleft()
+            if not self._reply_result(*self._check_output(output)):
+                return
+        if self.window:
+            self.latest_cmd = self.window.popleft()
+            self._rmt_exec_cmd()
+            return
+        self.window = None
+        self._send('wait\r%s' % self.host)
+
+    def _rmt_exec_cmd(self):
+        Log.info('    @<link:%s><host:%s> exec <%s>' %
+                 (self.link, self.host, self.latest_cmd))
+        self.status = 'executing'
+        self.out_buf = []
+        self.err_buf = ''
+        self.chunk = ''
+
+        handler = self.ssh_handler
+        cmd = self.latest_cmd
+        timeout = self.timeout
+        if timeout:
+            self.deadline = time.time() + timeout
+        self.loop.run_in_executor(lambda: handler.open_cmd_channel(cmd,
+                                                                   timeout),
+                                  self._on_channel_opened)
+
+    def _on_channel_opened(self, chan, error):
+        if error:
+            self._finish_cmd(False, '%s' % error)
+            return
+
+        self.chan = chan
+        self.loop.add_reader(chan.fileno(), self._on_readable)
+        # fileno of channel is only readable by stdout, so stderr and
+        # deadline of cmd are checked by ticker too
+        self.loop.add_ticker(self._on_readable)
+
+    def _close_chan(self):
+        self.loop.remove_reader(self.chan.fileno())
+        self.loop.remove_ticker(self._on_readable)
+        self.chan.close()
+        self.chan = None
+
+    def _on_readable(self):
+        chan = self.chan
+        if self.deadline and time.time() > self.deadline:
+            self._close_chan()
+            self._finish_cmd(False, self._timeout_result())
+            return
+        size = self.chunk_size or 0x8000
+        while chan.recv_stderr_ready():
+            if self.chunk_size:
+                # stderr is truncated by chunk_size in stream
+                self.err_buf = (self.err_buf +
+                                chan.recv_stderr(size))[:self.chunk_size]
+            else:
+                self.err_buf += chan.recv_stderr(size)
+        while chan.recv_ready():
+            data = chan.recv(size)
+            if not self.chunk_size:
+                self.out_buf.append(data)
+                continue
+            if self.chunk:
+                self._send('part\r%s\r%s' % (self.host, self.chunk))
+            self.chunk = data
+
+        # output arrives before exit status
+        if chan.exit_status_ready() and not chan.recv_ready() and \
+           not chan.recv_stderr_ready():
+            self._close_chan()
+
+            if len(self.err_buf):
+                Log.warning('  ..@_@.<host:%s> exec <%s> return fail' %
+                            (self.host, self.latest_cmd))
+                Log.warning('  --> stderr:%s' % self.err_buf)
+                self._finish_cmd(False, self.err_buf)
+            elif self.chunk_size:
+                self._finish_cmd(True, self.chunk)
+            else:
+                self._finish_cmd(True, ''.join(self.out_buf))
+
+    def _finish_cmd(self, status, str_buf):
+        self.status = 'connected'
+        self.deadline = None
+        self.out_buf = []
+        self.err_buf = ''
+        self.chunk = ''
+        if status:
+            self._send('okay\r%s\r%s' % (self.host, str_buf))
+            # okay is not replied in window
+            if self.window is not None:
+                self._exec_next_in_window()
+        else:
+            self._send('fail\r%s\r%s' % (self.host, str_buf))
+
+    def hd_disconnecting(self):
+        handler = self.ssh_handler
+        self.ssh_handler = None
+        self.loop.run_in_executor(handler.disconnect_ssh_channel,
+                                  lambda result, error: None)
+        self.hd_waitting()
@@ -1,63 +1,308 @@
 from log_x import LogX
 from sys import exit
 import paramiko
+import select
+import socket
+import threading
+import time
 
 LOG = LogX(__name__)
 
 
+class ssh_pool(object):
+    '''
+        \rkeep authenticated transports alive after they are released, so
+        \rthat connecting the same <addr, port, username> again skips the
+        \rhandshake. idle transports are closed after IDLE_TIMEOUT, and
+        \rkeepalive is sent every KEEPALIVE seconds to hold them open.
+        \rparsed private keys are cached by file name as well.
+    '''
+    KEEPALIVE = 30
+    IDLE_TIMEOUT = 300
+
+    def __init__(self, keepalive=None, idle_timeout=None):
+        if keepalive is not None:
+            self.KEEPALIVE = keepalive
+        if idle_timeout is not None:
+            self.IDLE_TIMEOUT = idle_timeout
+        # <addr, port, username> --> [<trans, released time>, ...]
+        self.idle_pool = {}
+        self.pkeys = {}
+        # handlers in threads and executors share one pool
+        self.lock = threading.Lock()
+
+    def load_key(self, key_filename, password=None):
+        with self.lock:
+            pkey = self.pkeys.get(key_filename)
+        if pkey is None:
+            pkey = paramiko.RSAKey.from_private_key_file(key_filename,
+                                                         password=password)
+            with self.lock:
+                self.pkeys[key_filename] = pkey
+        return pkey
+
+    def _evict(self, now):
+        # called with lock held
+        for key in self.idle_pool.keys():
+            alive = []
+            for trans, released in self.idle_pool[key]:
+                if now - released > self.IDLE_TIMEOUT or \
+                   not trans.is_active():
+                    LOG.debug('close idle transport of %s@%s:%d' %
+                              (key[2], key[0], key[1]))
+                    trans.close()
+                else:
+                    alive.append((trans, released))
+            if alive:
+                self.idle_pool[key] = alive
+            else:
+                self.idle_pool.pop(key)
+
+    def get(self, addr, port, username):
+        '''
+            \rreturn an idle transport of <addr, port, username>, or None
+        '''
+        with self.lock:
+            self._evict(time.time())
+            idle = self.idle_pool.get((addr, port, username))
+            if idle:
+                LOG.debug('reuse transport of %s@%s:%d' %
+                          (username, addr, port))
+                return idle.pop()[0]
+        return None
+
+    def put(self, addr, port, username, trans):
+        if not trans.is_active():
+            trans.close()
+            return
+        trans.set_keepalive(self.KEEPALIVE)
+        with self.lock:
+            self.idle_pool.setdefault((addr, port, username), []).append(
+                    (trans, time.time()))
+            self._evict(time.time())
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle_pool.values():
+                for trans, released in idle:
+                    trans.close()
+            self.idle_pool = {}
+
+
 class ssh_handler(object):
     '''
         \rUsed to create ssh channel and get the output by executing cmd in
         \rremote host
     '''
-    def __init__(self):
+    STREAM_INTERVAL = 0.1
+    ## bytes read from channel once
+    READ_SIZE = 0x8000
+
+    def __init__(self, pool=None):
         self.trans = None
+        # transports are released to <pool> instead of being closed if set
+        self.pool = pool
 
     def create_ssh_channel(self, **kwargs):
-        if self.trans:
-            self.trans.close()
+        try:
+            self.connect(**kwargs)
+        except Exception:
+            exit(1)
+
+    def connect(self, **kwargs):
+        '''
+            \rthe same as <create_ssh_channel>, but exception is raised
+            \rinstead of exiting when failed. <timeout> in kwargs limits
+            \rseconds of tcp connecting, banner and authentication each
+        '''
+        self.disconnect_ssh_channel()
         try:
             self.addr = kwargs['addr']
             self.port = kwargs.get('port', 22)
             self.username = kwargs['username']
             self.key_filename = kwargs.get('key_filename', None)
             self.password = kwargs.get('password', None)
+            timeout = kwargs.get('timeout', None)
         except KeyError as e:
             LOG.error('parse kwargs failed with exception: %s' % e)
             LOG.debug('the kwargs is %s' % kwargs)
-            exit(1)
+            raise
 
         LOG.info('ssh %s@%s:%d' % (self.username, self.addr, self.port))
         if not self.key_filename and not self.password:
             LOG.warning('permission denied, please provide password or key')
-            exit(1)
+            raise Exception('permission denied, no password or key')
+
+        if self.pool:
+            self.trans = self.pool.get(self.addr, self.port, self.username)
+            if self.trans:
+                return
 
+        sock = None
+        trans = None
         try:
-            trans = paramiko.Transport((self.addr, self.port))
+            sock = socket.create_connection((self.addr, self.port), timeout)
+            trans = paramiko.Transport(sock)
+            if timeout:
+                trans.banner_timeout = timeout
+                trans.auth_timeout = timeout
             if self.password:
                 trans.connect(username=self.username, password=self.password)
             else:
-                pkey = paramiko.RSAKey.from_private_key_file(
-                        self.key_filename,
-                        password=self.password)
+                if self.pool:
+                    pkey = self.pool.load_key(self.key_filename)
+                else:
+                    pkey = paramiko.RSAKey.from_private_key_file(
+                            self.key_filename,
+                            password=self.password)
                 trans.connect(username=self.username, pkey=pkey)
         except Exception as e:
             LOG.error("create ssh connection failed due to: <class:%s> %s" %
                       (e.__class__, e))
+            # the socket is closed by transport, or alone if transport is
+            # not created
             try:
-                trans.close()
+                if trans:
+                    trans.close()
+                elif sock:
+                    sock.close()
             except:
                 pass
-            exit(1)
+            raise
         self.trans = trans
 
-    def exec_cmd(self, cmd, timeout=None):
+    def open_cmd_channel(self, cmd, timeout=None):
         chan = self.trans.open_session(timeout=timeout)
         chan.settimeout(timeout)
         chan.exec_command(cmd)
+        return chan
+
+    def exec_cmd(self, cmd, timeout=None):
+        '''
+            \rreturn file objects of stdout and stderr, <timeout> limits
+            \rseconds of every read instead of the whole cmd
+        '''
+        chan = self.open_cmd_channel(cmd, timeout)
         stdout = chan.makefile('r', -1)
         stderr = chan.makefile_stderr('r', -1)
         return stdout, stderr
 
+    def exec_cmd_output(self, cmd, timeout=None):
+        '''
+            \rreturn <(stdout, stderr)> of cmd once it is finished, or None if
+            \rit is not finished in <timeout> seconds
+        '''
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+        chan = self.open_cmd_channel(cmd, timeout)
+        return self._wait_cmd_channels([chan], deadline)[0]
+
+    def _wait_cmd_channels(self, chans, deadline):
+        try:
+            outs = [[] for chan in chans]
+            errs = [[] for chan in chans]
+            running = set(xrange(len(chans)))
+            while running:
+                if deadline and time.time() > deadline:
+                    break
+                for i in list(running):
+                    # one read every time, so the deadline is checked even
+                    # if output keeps coming
+                    chan = chans[i]
+                    if chan.recv_stderr_ready():
+                        errs[i].append(chan.recv_stderr(self.READ_SIZE))
+                    if chan.recv_ready():
+                        outs[i].append(chan.recv(self.READ_SIZE))
+                    # output arrives before exit status
+                    if chan.exit_status_ready() and \
+                       not chan.recv_ready() and \
+                       not chan.recv_stderr_ready():
+                        running.discard(i)
+                if running:
+                    select.select([chans[i] for i in running], [], [],
+                                  self.STREAM_INTERVAL)
+        finally:
+            for chan in chans:
+                chan.close()
+
+        return [None if i in running else (''.join(outs[i]), ''.join(errs[i]))
+                for i in xrange(len(chans))]
+
+    def exec_cmd_stream(self, cmd, chunk_size, timeout=None):
+        '''
+            \ryield <('stdout'|'stderr', data)> as soon as output arrives, and
+            \rthe length of data is not larger than chunk_size. socket.timeout
+            \ris raised if cmd is not finished in <timeout> seconds
+        '''
+        chan = self.open_cmd_channel(cmd, timeout)
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+        try:
+            while True:
+                if deadline and time.time() > deadline:
+                    raise socket.timeout('cmd is not finished in %ss' %
+                                         timeout)
+                if chan.recv_stderr_ready():
+                    yield 'stderr', chan.recv_stderr(chunk_size)
+                elif chan.recv_ready():
+                    yield 'stdout', chan.recv(chunk_size)
+                elif chan.exit_status_ready():
+                    # output arrives before exit status, check it again
+                    if not chan.recv_ready() and \
+                       not chan.recv_stderr_ready():
+                        break
+                else:
+                    # fileno of channel is only readable by stdout, so
+                    # stderr is checked every STREAM_INTERVAL at least
+                    select.select([chan], [], [], self.STREAM_INTERVAL)
+        finally:
+            chan.close()
+
+    def exec_cmds(self, cmds, timeout=None):
+        '''
+            execute cmds in parallel by channels of the same transport, and
+            return <(stdout, stderr)> of every cmd in order, it is None if
+            the cmd is not finished in <timeout> seconds. if sshd refuses
+            sessions beyond its MaxSessions, the rest cmds are executed once
+            the opened ones are finished
+        '''
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+        outputs = []
+        while len(outputs) < len(cmds):
+            if deadline and time.time() > deadline:
+                outputs.extend([None] * (len(cmds) - len(outputs)))
+                break
+            chans = self._open_cmd_channels(cmds[len(outputs):], timeout)
+            outputs.extend(self._wait_cmd_channels(chans, deadline))
+        return outputs
+
+    def _open_cmd_channels(self, cmds, timeout):
+        # channels are opened until sshd refuses one, at least one channel
+        # must be opened
+        chans = []
+        try:
+            for cmd in cmds:
+                chans.append(self.open_cmd_channel(cmd, timeout))
+        except paramiko.ChannelException as e:
+            if not chans:
+                raise
+            LOG.warning('%s@%s refuses session %d due to %s, the rest cmds '
+                        'wait' % (self.username, self.addr, len(chans) + 1, e))
+        except:
+            for chan in chans:
+                chan.close()
+            raise
+        return chans
+
     def disconnect_ssh_channel(self):
-        self.trans.close()
+        if not self.trans:
+            return
+        if self.pool:
+            self.pool.put(self.addr, self.port, self.username, self.trans)
+        else:
+            self.trans.close()
+        self.trans = None
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+import os
+import random
+import select
+import sqlite3
+import sys
+import time
+
+sys.path.append(os.path.abspath('../'))
+from log_x import LogX
+from db_handler import db_handler, lzma
+
+
+Log = LogX(__name__)
+log_file = './log/%s.log' % __file__.split('.')[0]
+Log.set_public_atrr(LogX.INFO, log_file)
+Log.open_global_stdout()
+
+
+class unit_test(object):
+    def __init__(self):
+        self.db_name = 'log/bench_.db'
+        self.hosts = ['host%d' % i for i in xrange(2000)]
+        self.cmds = ['rpm -qa', 'cat /etc/passwd', 'dmesg | tail -n 50',
+                     'echo "quoted" \'output\'']
+
+        # multi-KB outputs with quotes, newlines and non-ascii bytes
+        line = 'kernel: [    0.000000] "%s" it\'s done \xe2\x9c\x93\n'
+        self.outputs = [''.join([line % (i * j) for j in xrange(20 * i)])
+                        for i in xrange(1, len(self.cmds) + 1)]
+
+    def _open(self, **kwargs):
+        hdr = db_handler(self.db_name, is_replace=True, **kwargs)
+        for host in self.hosts:
+            hdr.put_host(host, 0)
+        for cmd in self.cmds:
+            hdr.put_command(cmd)
+        hdr.commit()
+        return hdr
+
+    def _db_size(self, hdr):
+        # pages in WAL are moved into the database first
+        hdr.cursor.execute('pragma wal_checkpoint(truncate)').fetchall()
+        return os.path.getsize(self.db_name)
+
+    def _report(self, name, n_results, elapsed):
+        Log.info('--> %-10s %d results in %.3fs, %.0f inserts/sec' %
+                 (name, n_results, elapsed, n_results / elapsed))
+
+    def case_formatted(self):
+        # the way of inserting before parameters were bound: SQL text differs
+        # for every result, and quotes need to be escaped
+        hdr = self._open()
+        c = hdr.cursor
+
+        start_time = time.time()
+        for host_id in xrange(1, len(self.hosts) + 1):
+            for cmd_id in xrange(1, len(self.cmds) + 1):
+                result = self.outputs[cmd_id - 1].replace('"', '""')
+                c.execute('insert into results (host, cmd, status, result) '
+                          'values (%d, %d, %d, "%s")' %
+                          (host_id, cmd_id, 0, result))
+        hdr.conn.commit()
+        self._report('formatted', len(self.hosts) * len(self.cmds),
+                     time.time() - start_time)
+        Log.info('    database is %d bytes' % self._db_size(hdr))
+
+    def case_bound(self):
+        hdr = self._open()
+
+        start_time = time.time()
+        for host in self.hosts:
+            for cmd, output in zip(self.cmds, self.outputs):
+                hdr.put_result(host, cmd, 0, output)
+        hdr.commit()
+        self._report('bound', len(self.hosts) * len(self.cmds),
+                     time.time() - start_time)
+
+        # identical outputs of hosts are stored once
+        n_blobs = hdr.cursor.execute('select count(*) from blobs').fetchone()
+        Log.info('    %d blobs, database is %d bytes' %
+                 (n_blobs[0], self._db_size(hdr)))
+
+        # outputs must be stored exactly
+        outputs = dict(zip(self.cmds, self.outputs))
+        for id, host, cmd, status, result in hdr.iter_results():
+            if result != outputs[cmd]:
+                raise Exception('result of <host:%s> <cmd:%s> is broken' %
+                                (host, cmd))
+
+    def _fork_reader(self):
+        # a dashboard process reading the database until it is told to stop
+        stop_r, stop_w = os.pipe()
+        count_r, count_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            conn = sqlite3.connect(self.db_name, timeout=60)
+            n_reads = 0
+            while not select.select([stop_r], [], [], 0)[0]:
+                conn.execute('select count(*), sum(length(result)) '
+                             'from results').fetchall()
+                n_reads += 1
+            os.write(count_w, '%d' % n_reads)
+            os._exit(0)
+        return pid, stop_w, count_r
+
+    def _stop_reader(self, pid, stop_w, count_r):
+        os.write(stop_w, 'x')
+        os.waitpid(pid, 0)
+        n_reads = int(os.read(count_r, 64))
+        os.close(stop_w)
+        os.close(count_r)
+        return n_reads
+
+    def case_pragmas(self):
+        modes = [
+                ('delete/full', {'journal_mode': 'delete',
+                                 'synchronous': 'full'}),
+                ('wal/full', {'journal_mode': 'wal', 'synchronous': 'full'}),
+                ('wal/normal', {}),
+                ]
+        for name, pragmas in modes:
+            hdr = self._open(pragmas=pragmas, flush_size=64)
+            reader = self._fork_reader()
+
+            start_time = time.time()
+            for host in self.hosts:
+                for cmd, output in zip(self.cmds, self.outputs):
+                    hdr.put_result(host, cmd, 0, output)
+            hdr.commit()
+            elapsed = time.time() - start_time
+
+            n_reads = self._stop_reader(*reader)
+            self._report(name, len(self.hosts) * len(self.cmds), elapsed)
+            Log.info('    and reader finished %d reads meanwhile' % n_reads)
+
+    def _logs(self, n_hosts, n_lines):
+        # logs differ on every host, so they are not deduplicated
+        rand = random.Random(0)
+        line = '%s kernel: [%12.6f] eth%d: link up, rx=%d tx=%d drop=%d\n'
+        for i in xrange(n_hosts):
+            yield ''.join([line % (time.ctime(1500000000 + j), j * 0.37,
+                                   rand.randint(0, 3), rand.randint(0, 1e9),
+                                   rand.randint(0, 1e9), rand.randint(0, 9))
+                           for j in xrange(n_lines)])
+
+    def case_compress(self):
+        logs = list(self._logs(400, 400))
+        codecs = [
+                ('raw', {}),
+                ('zlib/1', {'compress': 'zlib', 'compress_level': 1}),
+                ('zlib/6', {'compress': 'zlib', 'compress_level': 6}),
+                ]
+        if lzma is not None:
+            codecs.append(('lzma/1', {'compress': 'lzma',
+                                      'compress_level': 1}))
+        Log.info('--> %d logs of %d bytes' % (len(logs), sum(map(len, logs))))
+
+        for name, kwargs in codecs:
+            hdr = self._open(**kwargs)
+            start_time = time.time()
+            for host, log in zip(self.hosts, logs):
+                hdr.put_result(host, 'dmesg | tail -n 50', 0, log)
+            hdr.commit()
+            elapsed = time.time() - start_time
+            self._report(name, len(logs), elapsed)
+
+            start_time = time.time()
+            for row, log in zip(hdr.iter_results(), logs):
+                if row[4] != log:
+                    raise Exception('result of <host:%s> is broken' % row[1])
+            Log.info('    read in %.3fs, database is %d bytes' %
+                     (time.time() - start_time, self._db_size(hdr)))
+
+    def case(self):
+        self.case_formatted()
+        self.case_bound()
+        self.case_pragmas()
+        self.case_compress()
+
+
+unit_test().case()
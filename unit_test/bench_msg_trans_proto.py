@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+import errno
+import fcntl
+import os
+import signal
+import sys
+import time
+
+sys.path.append(os.path.abspath('../'))
+from log_x import LogX
+from concur_handler import msg_trans_proto
+
+
+Log = LogX(__name__)
+log_file = './log/%s.log' % __file__.split('.')[0]
+Log.set_public_atrr(LogX.INFO, log_file)
+Log.open_global_stdout()
+
+
+def legacy_read(fdr):
+    '''
+    the reader used before the receive buffer was introduced, it issues one
+    syscall per byte to find the head. the load is read in a loop here, or
+    else it would be broken by short read and the benchmark can not finish.
+    '''
+    bits = msg_trans_proto.BITS_OF_LEN
+    n_continue_zero = 0
+    while True:
+        latest_byte = os.read(fdr, 1)
+        if latest_byte == '\0':
+            n_continue_zero += 1
+        elif n_continue_zero < bits:
+            n_continue_zero = 0
+        elif latest_byte == '*':
+            break
+        else:
+            raise Exception('the format of pipe msg is error!')
+
+    size_oct = int(os.read(fdr, bits), 0x10)
+    load = ''
+    while len(load) < size_oct:
+        load += os.read(fdr, size_oct - len(load))
+    Log.debug('..-read-<pid:%s> read <%s>' % (os.getpid(), load))
+    return load
+
+
+def legacy_wait(fdr, timeout):
+    '''
+    the waitting of reader with timeout before poll was used, it spins on
+    EAGAIN and sets fdr non-blocking on every attempt.
+    '''
+    start_time = time.time()
+    while True:
+        try:
+            fl = fcntl.fcntl(fdr, fcntl.F_GETFL)
+            fcntl.fcntl(fdr, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+            return os.read(fdr, 1)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        if time.time() - start_time >= timeout:
+            return None
+
+
+class unit_test(object):
+    def __init__(self):
+        self.n_frames = 100000
+        self.loads = ['wait', 'okay\r172.17.0.2\r%s' % ('x' * 64),
+                      'fail\r172.17.0.3\r%s' % ('y' * 1024)]
+
+    def _fork_writer(self):
+        fdr, fdw = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(fdr)
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            # pack all msgs in advance so that the writer is not the bottleneck
+            n_loads = len(self.loads)
+            stream = ''.join([msg_trans_proto.pack(self.loads[i % n_loads])
+                              for i in xrange(self.n_frames)])
+            for i in xrange(0, len(stream), 0x10000):
+                os.write(fdw, stream[i:i + 0x10000])
+            os._exit(0)
+        os.close(fdw)
+        return pid, fdr
+
+    def _run(self, name, read_func):
+        pid, fdr = self._fork_writer()
+
+        start_time = time.time()
+        for i in xrange(self.n_frames):
+            load = read_func(fdr)
+            if load != self.loads[i % len(self.loads)]:
+                raise Exception('<%s> frame %d is broken: %r' %
+                                (name, i, load))
+        elapsed = time.time() - start_time
+
+        os.waitpid(pid, 0)
+        os.close(fdr)
+        msg_trans_proto.reset(fdr)
+
+        Log.info('--> %-8s %d frames in %.3fs, %.0f frames/sec' %
+                 (name, self.n_frames, elapsed, self.n_frames / elapsed))
+        return elapsed
+
+    def case_partial_frame(self):
+        fdr, fdw = os.pipe()
+        msg = '\0\0\0*00Chello,'
+        os.write(fdw, msg)
+        if msg_trans_proto.read(fdr) is not None:
+            raise Exception('partial frame should not be returned')
+
+        os.write(fdw, ' world\0\0\0*004wait')
+        load = msg_trans_proto.read(fdr)
+        Log.info('--> read <%s> after the rest arrived' % load)
+        if load != 'hello, world' or msg_trans_proto.pending(fdr) != 1:
+            raise Exception('partial frame is not restored correctly')
+        msg_trans_proto.read(fdr)
+
+        os.close(fdr)
+        os.close(fdw)
+        msg_trans_proto.reset(fdr)
+
+    def case_large_load(self):
+        # version 2 carries multi-megabyte load through the pipe
+        msg_trans_proto.set_version(2)
+        load = ''.join([chr(i % 256) for i in xrange(256)]) * (16 * 1024)
+
+        fdr, fdw = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(fdr)
+            msg_trans_proto.write(fdw, load)
+            os._exit(0)
+        os.close(fdw)
+
+        start_time = time.time()
+        buf = msg_trans_proto.read(fdr, timeout=-1)
+        elapsed = time.time() - start_time
+        os.waitpid(pid, 0)
+        os.close(fdr)
+        msg_trans_proto.reset(fdr)
+        msg_trans_proto.set_version(1)
+
+        if buf != load:
+            raise Exception('large load is broken')
+        Log.info('--> read load of %d bytes in %.3fs' % (len(load), elapsed))
+
+    def _idle_cpu(self, wait_func, timeout):
+        # cpu time of a sub process which waits for msg that never arrives
+        fdr, fdw = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(fdw)
+            wait_func(fdr, timeout)
+            os._exit(0)
+        os.close(fdr)
+        rusage = os.wait4(pid, 0)[2]
+        os.close(fdw)
+        return rusage.ru_utime + rusage.ru_stime
+
+    def case_idle_wait(self):
+        timeout = 2
+        legacy = self._idle_cpu(legacy_wait, timeout)
+        polled = self._idle_cpu(msg_trans_proto.read, timeout)
+        Log.info('--> cpu time of waitting %ds: legacy %.3fs, poll %.3fs' %
+                 (timeout, legacy, polled))
+
+    def case(self):
+        legacy = self._run('legacy', legacy_read)
+        buffered = self._run('buffered',
+                             lambda fdr: msg_trans_proto.read(fdr, timeout=-1))
+        Log.info('--> speed up x%.1f' % (legacy / buffered))
+
+
+test = unit_test()
+test.case_partial_frame()
+test.case_large_load()
+test.case_idle_wait()
+test.case()
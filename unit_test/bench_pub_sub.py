@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import functools
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath('../'))
+from log_x import LogX
+from concur_handler import msg_trans_proto as mtp
+from pub_sub import publisher
+
+
+Log = LogX(__name__)
+log_file = './log/%s.log' % __file__.split('.')[0]
+Log.set_public_atrr(LogX.INFO, log_file)
+Log.open_global_stdout()
+
+
+class unit_test(object):
+    '''
+    drive the dispatch of publisher without sub processes: every process is
+    represented by a fake fdr, and all msgs of publisher are written into
+    /dev/null. so only the cost of dispatch itself is measured.
+    '''
+    def __init__(self):
+        self.fdw = os.open('/dev/null', os.O_WRONLY)
+        self.n_hosts = 4096
+
+    def _dispatch(self, concurrency, n_cmds, window=None):
+        hosts = ['10.0.%d.%d' % (i / 256, i % 256)
+                 for i in xrange(self.n_hosts)]
+        cmds = ['cmd%d' % i for i in xrange(n_cmds)]
+        pub = publisher(hosts, cmds, concurrency, window=window)
+        pub.fdw = self.fdw
+        pub.send = functools.partial(mtp.write, self.fdw)
+
+        n_msgs = 0
+        start_time = time.time()
+        while not pub.fin_func():
+            # every process asks for a guest, and then executes all cmds
+            busy = []
+            for fdr in xrange(concurrency):
+                pub.fdr = fdr
+                pub.hd_waitting()
+                n_msgs += 1
+                p_id = pub.fd_pool.get(fdr)
+                if p_id is not None:
+                    busy.append((fdr, pub.recept_pool[p_id][1]))
+
+            # in window, results are streamed back after one wait
+            step = window or 1
+            for i in xrange(0, n_cmds, step):
+                for fdr, host in busy:
+                    pub.fdr = fdr
+                    pub.hd_connected_wait(host)
+                    n_msgs += 1
+                    for j in xrange(min(step, n_cmds - i)):
+                        pub.hd_connected_okay(host, 'okay')
+                        n_msgs += 1
+
+            for fdr, host in busy:
+                pub.fdr = fdr
+                pub.hd_connected_wait(host)
+                n_msgs += 1
+        elapsed = time.time() - start_time
+
+        Log.info('--> <concurrency:%4d> <cmds:%3d> <window:%4s> %d msgs in '
+                 '%.3fs, %.2fus per msg' % (concurrency, n_cmds, window,
+                                            n_msgs, elapsed,
+                                            elapsed * 1000000 / n_msgs))
+        return elapsed
+
+    def case(self):
+        for concurrency in (32, 512, 2048):
+            for n_cmds in (4, 64):
+                elapsed = self._dispatch(concurrency, n_cmds)
+                elapsed_window = self._dispatch(concurrency, n_cmds,
+                                                window=n_cmds)
+                Log.info('--> speed up x%.1f by window' %
+                         (elapsed / elapsed_window))
+
+
+unit_test().case()
@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 
 import os
+import sqlite3
 import sys
 import time
 
 sys.path.append(os.path.abspath('../'))
 from log_x import LogX
-from db_handler import db_handler
+from db_handler import db_handler, db_exception
 
 
 Log = LogX(__name__)
@@ -43,4 +44,272 @@ class unit_test(object):
         print('--> cmds are %s' % str(rcmds))
         print('--> rresults are %s' % str(rresults))
 
-unit_test().case()
+    def case_query(self):
+        db_name = 'log/test_query_.db'
+        hdr = db_handler(db_name, is_replace=True)
+
+        hosts = ['host%d' % i for i in xrange(10)]
+        commands = ['uname -r', 'cat /etc/hosts']
+        for host in hosts:
+            hdr.put_host(host, 0)
+        for command in commands:
+            hdr.put_command(command)
+
+        # <cat /etc/hosts> fails on odd hosts
+        for i, host in enumerate(hosts):
+            hdr.put_result(host, commands[0], 0, 'x.y.z')
+            hdr.put_result(host, commands[1], i % 2, 'output of %s' % host)
+        hdr.commit()
+
+        failed_hosts = hdr.get_hosts_by_result(commands[1], 1)
+        print('--> hosts failed to <%s> are %s' % (commands[1], failed_hosts))
+        assert failed_hosts == hosts[1::2]
+
+        rresults = list(hdr.iter_results(host='host3'))
+        print('--> results of host3 are %s' % str(rresults))
+        assert [row[2] for row in rresults] == commands
+
+        page = list(hdr.iter_results(status=0, offset=10, limit=5))
+        print('--> page of results are %s' % str(page))
+        assert len(page) == 5
+
+    def case_iter_writing(self):
+        db_name = 'log/test_iter_writing_.db'
+        hdr = db_handler(db_name, is_replace=True)
+        hdr.put_command('date')
+        for i in xrange(600):
+            hdr.put_host('host%d' % i, 0)
+            hdr.put_result('host%d' % i, 'date', 0, 'output %d' % i)
+
+        # results committed while iterating do not break the reader, and it
+        # reads the results before it starts
+        n_rows = 0
+        for row in hdr.iter_results():
+            hdr.put_result(row[1], 'date', 1, 'again')
+            hdr.commit()
+            n_rows += 1
+        print('--> %d results are read while writing' % n_rows)
+        assert n_rows == 600
+        assert len(hdr.get_results()) == 1200
+
+    def case_memory(self):
+        # pragmas which return no row on :memory: do not break opening it
+        hdr = db_handler(':memory:')
+        print('--> journal mode of :memory: is %s' %
+              hdr.get_pragma('journal_mode'))
+        assert hdr.get_pragma('journal_mode') == 'memory'
+        hdr.put_host('host1', 0)
+        hdr.commit()
+        assert len(hdr.get_hosts()) == 1
+
+    def case_iter_journal(self):
+        # without WAL, results are read by the connection of writer
+        for db_name, pragmas in ((':memory:', None),
+                                 ('log/test_journal_.db',
+                                  {'journal_mode': 'delete'})):
+            hdr = db_handler(db_name, is_replace=True, pragmas=pragmas)
+            hdr.put_command('date')
+            for i in xrange(3):
+                hdr.put_host('host%d' % i, 0)
+                hdr.put_result('host%d' % i, 'date', 0, 'output %d' % i)
+            # the writer is still in transaction
+            hdr.put_host('host3', 0)
+            rows = [row[1:] for row in hdr.iter_results()]
+            print('--> results of %s are %s' % (db_name, rows))
+            assert rows == [('host%d' % i, 'date', 0, 'output %d' % i)
+                            for i in xrange(3)]
+
+    def case_durations(self):
+        db_name = 'log/test_durations_.db'
+        if os.access(db_name, os.F_OK):
+            os.unlink(db_name)
+        hdr = db_handler(db_name, is_replace=True)
+
+        for host in ('host1', 'host2', 'host3'):
+            hdr.put_host(host, 0)
+        hdr.put_host_duration('host1', 1.5)
+        hdr.put_host_duration('host3', 30)
+        hdr.commit()
+
+        # hosts never served are not returned
+        durations = hdr.get_host_durations()
+        print('--> durations are %s' % durations)
+        assert durations == {'host1': 1.5, 'host3': 30}
+
+        # durations are kept by the next run which replaces the database
+        hdr = db_handler(db_name, is_replace=True)
+        hdr.put_host('host1', 0)
+        hdr.put_host_duration('host1', 2.5)
+        assert hdr.get_host_durations() == {'host1': 2.5, 'host3': 30}
+
+    def case_reopen(self):
+        db_name = 'log/test_reopen_.db'
+        hdr = db_handler(db_name, is_replace=True)
+        hdr.put_host('host1', 0)
+        hdr.put_command('date')
+        hdr.put_command('ls')
+        hdr.put_result('host1', 'date', 0, 'xxxxx')
+        hdr.put_result_part('host1', 'ls', 'part of ls')
+        hdr.commit()
+
+        # the result being streamed is dropped when the run is continued
+        hdr = db_handler(db_name)
+        hdr.drop_unfinished_results()
+        statuses = list(hdr.iter_statuses())
+        print('--> statuses are %s' % statuses)
+        assert statuses == [('host1', 'date', 0)]
+        assert len(hdr.get_results()) == 1
+
+    def case_stream(self):
+        db_name = 'log/test_stream_.db'
+        hdr = db_handler(db_name, is_replace=True, flush_size=4)
+        hdr.put_host('host1', 0)
+        hdr.put_command('cat log')
+
+        # parts are buffered, and written in time by flush
+        for i in xrange(10):
+            hdr.put_result_part('host1', 'cat log', 'line %d\n' % i)
+        hdr.commit()
+        rows = list(hdr.iter_results())
+        print('--> result being streamed is %s' % str(rows))
+        assert rows[0][3] == db_handler.STATUS_HDING
+        assert rows[0][4] == ''.join('line %d\n' % i for i in xrange(10))
+
+        hdr.put_result_part('host1', 'cat log', 'line 10\n')
+        hdr.put_result('host1', 'cat log', 0, 'line 11\n')
+        rows = list(hdr.iter_results())
+        assert len(rows) == 1
+        assert rows[0][4] == ''.join('line %d\n' % i for i in xrange(12))
+
+        # an output streamed longer than MAX_STREAM_BLOB is left in results,
+        # unless a blob holds the same one
+        hdr.MAX_STREAM_BLOB = 16
+        output = 'line 0\nline 1\nline 2\n'
+        for host in ('host2', 'host3', 'host4'):
+            hdr.put_host(host, 0)
+        hdr.put_result_part('host2', 'cat log', 'line 0\n')
+        hdr.put_result('host2', 'cat log', 0, 'line 1\nline 2\n')
+        hdr.put_result('host3', 'cat log', 0, output)
+        hdr.flush()
+        hdr.put_result_part('host4', 'cat log', 'line 0\n')
+        hdr.put_result_part('host4', 'cat log', 'line 1\n')
+        hdr.put_result('host4', 'cat log', 0, 'line 2\n')
+        hdr.commit()
+        rows = hdr.cursor.execute('select blob, result from results '
+                                  'order by id').fetchall()
+        print('--> long results streamed are %s' % str(rows))
+        assert rows[1] == (0, output)
+        assert rows[2][0] != 0 and rows[3] == (rows[2][0], '')
+        rows = list(hdr.iter_results())
+        assert [row[4] for row in rows[1:]] == [output] * 3
+
+    def case_dedup(self):
+        db_name = 'log/test_dedup_.db'
+        hdr = db_handler(db_name, is_replace=True)
+
+        hosts = ['host%d' % i for i in xrange(6)]
+        for host in hosts:
+            hdr.put_host(host, 0)
+        hdr.put_command('uname -r')
+
+        # host0 streams the same output in parts
+        hdr.put_result_part('host0', 'uname -r', '3.10.0-')
+        hdr.put_result('host0', 'uname -r', 0, '957.el7')
+        for host in hosts[1:]:
+            output = '3.10.0-957.el7'
+            if host == 'host5':
+                output = '4.18.0-80.el8'
+            hdr.put_result(host, 'uname -r', 0, output)
+        hdr.commit()
+
+        n_blobs = hdr.cursor.execute('select count(*) from blobs').fetchone()
+        print('--> %d results are stored in %d blobs' %
+              (len(hdr.get_results()), n_blobs[0]))
+        assert n_blobs[0] == 2
+
+        groups = hdr.group_hosts_by_result('uname -r')
+        print('--> hosts grouped by output are %s' % groups)
+        assert groups == [('3.10.0-957.el7', hosts[:5]),
+                          ('4.18.0-80.el8', ['host5'])]
+        assert [row[4] for row in hdr.iter_results(host='host0')] == \
+               ['3.10.0-957.el7']
+
+    def case_compress(self):
+        db_name = 'log/test_compress_.db'
+        hdr = db_handler(db_name, is_replace=True, compress='zlib',
+                         compress_threshold=64)
+        hdr.put_host('host1', 0)
+        hdr.put_command('date')
+        hdr.put_command('dmesg')
+
+        # the short output is stored raw
+        log = ''.join(['[%8d] eth0: link up\n' % i for i in xrange(100)])
+        hdr.put_result('host1', 'date', 0, 'Mon Jan  1 00:00:00 UTC 2018')
+        hdr.put_result('host1', 'dmesg', 0, log)
+        hdr.commit()
+
+        codecs = hdr.cursor.execute('select codec, length(data) from blobs '
+                                    'order by id').fetchall()
+        print('--> codecs and sizes of blobs are %s' % codecs)
+        assert codecs[0][0] == db_handler.CODEC_RAW
+        assert codecs[1][0] == db_handler.CODEC_ZLIB
+        assert codecs[1][1] < len(log)
+        assert [row[4] for row in hdr.iter_results()] == \
+               ['Mon Jan  1 00:00:00 UTC 2018', log]
+
+        # invalid level is refused when database is opened
+        try:
+            db_handler(db_name, is_replace=True, compress='zlib',
+                       compress_level=12)
+        except db_exception as e:
+            print('--> %s' % e)
+        else:
+            raise Exception('invalid level should be refused')
+
+    def case_migrate(self):
+        # tables written by the version without durations and blobs
+        db_name = 'log/test_migrate_.db'
+        if os.access(db_name, os.F_OK):
+            os.unlink(db_name)
+        conn = sqlite3.connect(db_name)
+        conn.executescript('''
+            create table stastics (id integer primary key not null,
+                nhosts integer not null, ncommands integer not null,
+                nresults integer not null);
+            create table hosts (id integer primary key not null,
+                hostname text unique, status integer not null);
+            create table commands (id integer primary key not null,
+                command text not null);
+            create table results (id integer primary key not null,
+                host integer not null, cmd integer not null,
+                status integer not null, result text not null);
+            insert into stastics values (0, 1, 1, 1);
+            insert into hosts values (1, 'host1', 0);
+            insert into commands values (1, 'uname -r');
+            insert into results values (1, 1, 1, 0, '3.10.0-957.el7');
+            ''')
+        conn.commit()
+        conn.close()
+
+        hdr = db_handler(db_name)
+        hdr.put_host('host2', 0)
+        hdr.put_result('host2', 'uname -r', 0, '3.10.0-957.el7')
+        hdr.put_host_duration('host2', 2.5)
+        results = [row[1:] for row in hdr.iter_results()]
+        print('--> results after migration are %s' % results)
+        assert results == [('host1', 'uname -r', 0, '3.10.0-957.el7'),
+                           ('host2', 'uname -r', 0, '3.10.0-957.el7')]
+        assert hdr.get_host_durations() == {'host2': 2.5}
+
+test = unit_test()
+test.case()
+test.case_query()
+test.case_iter_writing()
+test.case_memory()
+test.case_iter_journal()
+test.case_durations()
+test.case_reopen()
+test.case_stream()
+test.case_dedup()
+test.case_compress()
+test.case_migrate()
@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
+import errno
 import os
+import shutil
+import socket
+import stat
 import sys
+import tempfile
 import time
 
 sys.path.append(os.path.abspath('../'))
 from log_x import LogX
-from concur_handler import multi_process
-from pub_sub import publisher, subscriber
+from concur_handler import multi_process, job_server, submit_job
+from pub_sub import publisher, subscriber, thread_subscriber, guest_source, \
+                    conn_limiter, longest_first_sched
 from db_handler import db_handler
 
 
@@ -17,6 +23,128 @@ Log.set_public_atrr(LogX.INFO, log_file)
 Log.open_global_stdout()
 
 
+class fake_link(object):
+    '''
+    link of subscriber driven by test without ssh: msgs are dispatched to
+    publisher at once, and all msgs replied to it are kept in <replies>,
+    including those replied later, e.g. when it is woken up. replies to a
+    link which <is_broken> fail as writing to the pipe of a dead process
+    '''
+    def __init__(self, pub, link):
+        self.pub = pub
+        self.link = link
+        self.host = None
+        self.replies = []
+        self.is_broken = False
+
+    def _reply(self, msg):
+        if self.is_broken:
+            raise OSError(errno.EPIPE, 'Broken pipe', self.link)
+        if msg.startswith('ack\r'):
+            self.host = msg[4:]
+        self.replies.append(msg)
+
+    def pop(self):
+        replies = self.replies
+        self.replies = []
+        return replies
+
+    def send(self, msg):
+        self.pub.dispatch(self.link, msg, self._reply)
+        return self.pop()
+
+    def ask(self):
+        # return the guest received, or None if the link is parked
+        self.host = None
+        self.send('wait')
+        return self.host
+
+    def run(self, replies=None):
+        # exec cmds of the guest okay until it is ended, return cmds executed
+        cmds = []
+        if replies is None:
+            replies = self.send('wait\r%s' % self.host)
+        while replies[:1] == ['cmd']:
+            cmds.append(replies[1])
+            assert self.send('okay\r%s\r%s' % (self.host, replies[1])) == \
+                   ['okay']
+            replies = self.send('wait\r%s' % self.host)
+        assert replies == ['end'], replies
+        self.host = None
+        return cmds
+
+
+class fake_session(object):
+    '''
+    session of subscriber without ssh, every cmd takes DELAY seconds and
+    its output is <cmd@host>. cmds on hosts named 'hang*' never finish
+    '''
+    DELAY = 0.2
+
+    def _connect(self, **kwargs):
+        return True
+
+    def _rmt_exec_cmd(self):
+        if self.host.startswith('hang'):
+            time.sleep(3600)
+        time.sleep(self.DELAY)
+        return True, '%s@%s' % (self.latest_cmd, self.host)
+
+
+class fake_subscriber(fake_session, subscriber):
+    pass
+
+
+class fake_thread_subscriber(fake_session, thread_subscriber):
+    def handler(self, link, engine, user, key_file, password, port=22):
+        session = fake_thread_subscriber()
+        session.link = link
+        session.engine = engine
+        session.inbox = engine.get_inbox(link)
+        subscriber.handler(session, None, None, user, key_file, password,
+                           port)
+
+
+class recorder(publisher):
+    '''
+    publisher keeping results in <results> instead of database, links which
+    sent msgs in <links>, and links whose guests are put back in <requeued>.
+    daemon is finished once <n_results> results are kept
+    '''
+    def __init__(self, *argv, **kwargs):
+        publisher.__init__(self, *argv, **kwargs)
+        self.results = []
+        self.links = set()
+        self.requeued = []
+        self.n_results = None
+
+    def fin_func(self):
+        is_fin = publisher.fin_func(self)
+        return is_fin or len(self.results) == self.n_results
+
+    def dispatch(self, link, req, send):
+        self.links.add(link)
+        publisher.dispatch(self, link, req, send)
+
+    def _record_result(self, host, cmd, status, result):
+        self.results.append((host, cmd, status, result))
+
+    def hd_requeue(self, link, reason):
+        if self.fd_pool.get(link) is not None:
+            self.requeued.append(link)
+        publisher.hd_requeue(self, link, reason)
+
+
+def run_engine(engine, pub, sub):
+    # the engine exits the process once publisher is finished
+    engine.register_publisher(pub)
+    engine.register_subscriber(sub, 'root', None, 'rootroot')
+    try:
+        engine.start()
+    except SystemExit:
+        pass
+
+
 class unit_test(object):
     def __init__(self):
         # ssh argvs
@@ -66,5 +194,276 @@ class unit_test(object):
                                               self.password)
         self.multi_process.start()
 
+    def case_pipe_thread(self):
+        # every sub process runs threads, msgs of them share its pipe
+        cmds = ['date', 'uptime']
+        hosts = ['host%d' % i for i in xrange(12)]
+        pub = recorder(list(hosts), cmds, 6)
+        engine = multi_process(2, timeout=0.1, n_threads=3)
+        run_engine(engine, pub, fake_thread_subscriber())
+
+        print('--> links of threads are %s' % sorted(pub.links))
+        assert len(pub.links) == 6
+        assert len(set(pr for pr, slot in pub.links)) == 2
+        assert sorted(r[:3] for r in pub.results) == \
+               sorted((host, cmd, publisher.STATUS_OKAY) for host in hosts
+                      for cmd in cmds)
+        assert all(r[3] == '%s@%s' % (r[1], r[0]) for r in pub.results)
+
+    def case_broken_wake(self):
+        # links parked by daemon are woken by the next job, one of them is
+        # broken meanwhile
+        pub = publisher([], [], 3, mode=publisher.PUB_FLG_DAEMON)
+        links = [fake_link(pub, i) for i in xrange(3)]
+        for link in links:
+            assert link.ask() is None
+        links[0].is_broken = True
+        pub.load_job(['host1', 'host2', 'host3'], ['date'])
+        assert not pub.fin_func()
+
+        # the guest not acked is served by others instead of being failed
+        hosts = [link.host for link in links]
+        print('--> guests received after waking are %s' % hosts)
+        assert hosts == [None, 'host1', 'host2']
+        assert list(pub.guest_queue) == ['host3']
+        pub.hd_timeout(0, 'down: sub process is disconnected')
+        assert sorted(pub.host_pool) == ['host1', 'host2']
+
+    def case_job_server(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self._serve_jobs(os.path.join(tmp_dir, 'job.sock'))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def _serve_jobs(self, path):
+        # the socket left by a dead daemon is replaced, but not a live one
+        # or any other file
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        pub = recorder([], [], 2, mode=publisher.PUB_FLG_DAEMON)
+        server = job_server(path, pub.load_job)
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0600
+        for other in (path, os.path.dirname(path)):
+            try:
+                job_server(other, pub.load_job)
+            except Exception as e:
+                print('--> serving %s is refused: %s' % (other, e))
+            else:
+                assert False
+
+        # the job is submitted by another process, its reply is passed back
+        # by pipe
+        hosts = ['host0', 'host1', 'host2']
+        cmds = ['date', 'uptime']
+        fdr, fdw = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(fdr)
+            os.write(fdw, submit_job(path, hosts, cmds))
+            os._exit(0)
+        os.close(fdw)
+
+        engine = multi_process(2, timeout=0.1)
+        server.attach(engine)
+        pub.n_results = len(hosts) * len(cmds)
+        run_engine(engine, pub, fake_subscriber())
+        os.waitpid(pid, 0)
+        reply = os.read(fdr, 0x1000)
+        os.close(fdr)
+        server.close()
+
+        print('--> reply of job is %r' % reply)
+        assert reply == 'job 1 accepted, 1 jobs queued\n'
+        assert sorted(r[:3] for r in pub.results) == \
+               sorted((host, cmd, publisher.STATUS_OKAY) for host in hosts
+                      for cmd in cmds)
+        assert not os.path.exists(path)
+
+    def case_watch(self):
+        # the guest over deadline is killed with the other thread of its sub
+        # process, whose guest is served again from the cmd killed
+        cmds = ['date', 'uptime', 'hostname']
+        hosts = ['hang0'] + ['host%d' % i for i in xrange(6)]
+        pub = recorder(list(hosts), cmds, 2, host_timeout=1.5,
+                       mode=publisher.PUB_FLG_IGNORE_FAIL)
+        engine = multi_process(1, timeout=0.1, n_threads=2)
+        engine.WATCH_INTERVAL = 0.1
+        run_engine(engine, pub, fake_thread_subscriber())
+
+        print('--> links put back are %s' % pub.requeued)
+        assert len(pub.requeued) == 1
+        failed = [r for r in pub.results if r[2] != publisher.STATUS_OKAY]
+        assert [r[:2] for r in failed] == [('hang0', 'date')]
+        assert failed[0][3].startswith('timeout')
+        okays = sorted(r[:2] for r in pub.results if r not in failed)
+        assert okays == sorted((host, cmd) for host in hosts[1:]
+                               for cmd in cmds)
+
+    def case_lost_links(self):
+        # the copy of straggler with window finishes before it
+        sched = longest_first_sched()
+        sched.load({'host0': 0.001})
+        pub = publisher(['host0'], ['[ro] date', '[ro] uptime'], 2,
+                        window=2, sched=sched, speculate=1)
+        links = [fake_link(pub, i) for i in xrange(2)]
+        assert links[0].ask() == 'host0'
+        assert links[0].send('wait\rhost0') == ['cmds\r2', 'date', 'uptime']
+        time.sleep(0.01)
+        assert links[1].ask() == 'host0'
+        assert links[1].send('wait\rhost0') == ['cmds\r2', 'date', 'uptime']
+        for cmd in ('date', 'uptime'):
+            assert links[1].send('okay\rhost0\r%s' % cmd) == []
+        assert links[1].send('wait\rhost0') == ['end']
+
+        # okay of the straggler in window is not replied, but its wait is
+        for cmd in ('date', 'uptime'):
+            assert links[0].send('okay\rhost0\r%s' % cmd) == []
+        assert links[0].send('wait\rhost0') == ['end']
+        assert not pub.lost_links
+        assert pub.fin_func()
+
+        # single cmd is sent even with parallel, its okay is replied
+        pub = publisher(['host0'], ['[ro] date'], 2, parallel=2, sched=sched,
+                        speculate=1)
+        links = [fake_link(pub, i) for i in xrange(2)]
+        for link in links:
+            assert link.ask() == 'host0'
+            assert link.send('wait\rhost0') == ['cmd', 'date']
+            time.sleep(0.01)
+        assert links[1].run(['cmd', 'date']) == ['date']
+        assert links[0].send('okay\rhost0\rdate') == ['end']
+        assert pub.fin_func()
+
+    def case_limiter(self):
+        # one connection is allowed in a subnet at once
+        limiter = conn_limiter(cap=1)
+        pub = publisher(['10.0.0.1', '10.0.0.2', '10.0.1.1'], ['date'], 3,
+                        limiter=limiter)
+        links = [fake_link(pub, i) for i in xrange(3)]
+        hosts = [link.ask() for link in links]
+        print('--> guests received are %s' % hosts)
+        assert hosts == ['10.0.0.1', '10.0.1.1', None]
+        assert pub.n_deferred == 1
+
+        # the deferred guest takes the connection released, and the link
+        # parked is woken up for it
+        assert links[0].run() == ['date']
+        assert not pub.fin_func()
+        assert links[2].pop() == ['ack\r10.0.0.2']
+        assert links[1].run() == ['date']
+        assert links[2].run() == ['date']
+        assert pub.n_deferred == 0
+
+    def case_resume(self):
+        db_name = 'log/test_resume_.db'
+        hdr = db_handler(db_name, is_replace=True)
+        for host in ('host1', 'host2', 'host3', 'host4'):
+            hdr.put_host(host, 0)
+        for cmd in ('date', 'uptime'):
+            hdr.put_command(cmd)
+        # host1 is served, host2 is broken after date, date failed on host3
+        hdr.put_result('host1', 'date', 0, 'okay')
+        hdr.put_result('host1', 'uptime', 0, 'okay')
+        hdr.put_result('host2', 'date', 0, 'okay')
+        hdr.put_result_part('host2', 'uptime', 'part of uptime')
+        hdr.put_result('host3', 'date', 1, 'fail')
+        hdr.commit()
+
+        hdr = db_handler(db_name)
+        pub = publisher(['host1', 'host2', 'host3', 'host4'],
+                        ['date', 'uptime'], 1)
+        pub.set_db_handler(hdr)
+        pub.resume()
+        link = fake_link(pub, 0)
+        served = {}
+        host = link.ask()
+        while host is not None:
+            served[host] = link.run()
+            host = link.ask()
+        print('--> cmds executed by resume are %s' % served)
+        assert served == {'host2': ['uptime'], 'host4': ['date', 'uptime']}
+        assert pub.fin_func()
+
+    def case_guest_source(self):
+        src = guest_source(iter(['host1', 'host2', 'host3']))
+        src.append('host0')
+        assert src.peek(2) == ['host0', 'host1']
+        assert list(src) == ['host0', 'host1', 'host2', 'host3']
+        assert not src
+
+        # guests are read only when they are dequeued
+        n_read = [0]
+        def inventory():
+            for i in xrange(100):
+                n_read[0] += 1
+                yield 'host%d' % i
+        pub = publisher(inventory(), ['date', 'uptime'], 2)
+        links = [fake_link(pub, i) for i in xrange(2)]
+        assert [link.ask() for link in links] == ['host0', 'host1']
+        print('--> %d guests are read when 2 are served' % n_read[0])
+        assert n_read[0] <= 3
+
+        served = []
+        while not pub.fin_func():
+            for link in links:
+                if link.host is None:
+                    continue
+                served.append(link.host)
+                assert link.run() == ['date', 'uptime']
+                link.ask()
+        assert sorted(served) == sorted('host%d' % i for i in xrange(100))
+
+    def case_group(self):
+        pub = publisher(['host0', 'host1', 'host2', 'host3'], ['date'], 2,
+                        group=2)
+        links = [fake_link(pub, i) for i in xrange(2)]
+        assert [link.ask() for link in links] == ['host0', 'host1']
+
+        # cmds are held until the group is confirmed
+        for link in links:
+            assert link.send('wait\r%s' % link.host) == []
+        assert pub.confirm_group('y') == 'group 1 is confirmed\n'
+        for link in links:
+            assert link.run(link.pop()) == ['date']
+
+        # the refused group is ended, and the rest guests are dropped
+        assert links[0].ask() == 'host2'
+        assert pub.confirm_group('n').startswith('group 2 is refused')
+        assert links[0].run() == []
+        assert links[1].ask() is None
+        assert pub.fin_func()
+
+    def case_broken_group(self):
+        # the link holding cmds is broken before the group is answered
+        for answer, replies in (('y', ['cmd', 'date']), ('n', ['end'])):
+            pub = publisher(['host0', 'host1', 'host2', 'host3'], ['date'],
+                            3, group=3)
+            links = [fake_link(pub, i) for i in xrange(3)]
+            for link in links:
+                link.ask()
+                assert link.send('wait\r%s' % link.host) == []
+            links[0].is_broken = True
+            pub.confirm_group(answer)
+            assert [link.pop() for link in links[1:]] == [replies, replies]
+
+            # the guest of broken link is released by engine
+            pub.hd_timeout(0, 'down: sub process is disconnected')
+            if answer == 'n':
+                assert not pub.host_pool
+                assert pub.fin_func()
+
 
-unit_test().case_with_db()
+test = unit_test()
+test.case_pipe_thread()
+test.case_broken_wake()
+test.case_job_server()
+test.case_watch()
+test.case_lost_links()
+test.case_limiter()
+test.case_resume()
+test.case_guest_source()
+test.case_group()
+test.case_broken_group()
+test.case_with_db()
@@ -2,10 +2,11 @@
 
 import os
 import sys
+import time
 
 sys.path.append(os.path.abspath('../'))
 from log_x import LogX
-from ssh_handler import ssh_handler
+from ssh_handler import ssh_handler, ssh_pool
 
 
 Log = LogX(__name__)
@@ -44,7 +45,25 @@ class unit_test(object):
             Log.error('--> %s' % stderr.read())
         Log.info('output--> %s' % stdout.read())
 
+    def case3(self):
+        # the second connecting reuses the transport released to pool
+        kwargs = {
+                'addr': '172.17.0.6',
+                'port': 22,
+                'username': 'root',
+                'password': 'rootroot',}
+        handler = ssh_handler(ssh_pool())
+        for i in xrange(2):
+            start_time = time.time()
+            handler.connect(**kwargs)
+            stdout, stderr = handler.exec_cmd('hostname')
+            Log.info('output--> %s in %.3fs' %
+                     (stdout.read(), time.time() - start_time))
+            handler.disconnect_ssh_channel()
+        handler.pool.close()
+
 
 test=unit_test()
 test.case1()
 test.case2()
+test.case3()